@@ -0,0 +1,220 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas
+
+import loader
+
+DIMENSIONS = ['UNIT', 'day_week', 'hour', 'rain', 'DATEn']
+MEASURE = 'ENTRIESn_hourly'
+
+# Edges of the fixed histogram bins of the measure, the same as the bins of
+# visualization.plot_histogram. Values outside the edges are not counted.
+HIST_BINS = np.arange(0, 15000, 500)
+
+# Bump when the cube layout changes, so old cubes are rebuilt
+CUBE_VERSION = 2
+
+# Arrays of a cube, saved as one .npy file each
+ARRAYS = ('codes', 'sums', 'counts', 'hist_cells', 'hist_bins', 'hist_counts', 'bins')
+
+# Sums, counts and histograms of the measure for every combination of the
+# dimension values present in the data. Each cell is one such combination:
+# 'codes' holds the index of its value in 'categories' for each dimension.
+# With DATEn among the dimensions there are about as many cells as rows, and
+# most histogram bins of a cell are empty, so the histograms are stored
+# sparsely: 'hist_counts[i]' rows of cell 'hist_cells[i]' fall in bin
+# 'hist_bins[i]'.
+class TurnstileCube(object):
+
+    def __init__(self, dimensions, categories, codes, sums, counts, hist_cells, hist_bins, hist_counts, bins):
+        self.dimensions = list(dimensions)
+        self.categories = categories
+        self.codes = codes
+        self.sums = sums
+        self.counts = counts
+        self.hist_cells = hist_cells
+        self.hist_bins = hist_bins
+        self.hist_counts = hist_counts
+        self.bins = np.asarray(bins)
+
+    # Aggregate the rows of the frame in one vectorized pass. Like pandas
+    # groupby, rows with a missing dimension value or measure are left out.
+    @classmethod
+    def build(cls, frame, dimensions=DIMENSIONS, bins=HIST_BINS):
+        values = np.asarray(frame[MEASURE], dtype=float)
+        valid = ~np.isnan(values)
+        categories = {}
+        dim_codes = []
+        for d in dimensions:
+            codes, uniques = pandas.factorize(frame[d], sort=True)
+            categories[d] = [u.item() if hasattr(u, 'item') else u for u in uniques]
+            # factorize gives -1 for missing values
+            valid &= codes >= 0
+            dim_codes.append(codes)
+        shape = [len(categories[d]) for d in dimensions]
+        values = values[valid]
+
+        # One cell per combination of dimension values that occurs
+        keys = np.ravel_multi_index([c[valid] for c in dim_codes], shape)
+        cell_keys, cells = np.unique(keys, return_inverse=True)
+        codes = np.column_stack(np.unravel_index(cell_keys, shape)).astype(np.int32)
+
+        sums = np.bincount(cells, weights=values, minlength=len(cell_keys))
+        counts = np.bincount(cells, minlength=len(cell_keys))
+
+        # Same bins as np.histogram: the last one includes its right edge
+        bins = np.asarray(bins)
+        nbins = len(bins) - 1
+        b = np.searchsorted(bins, values, side='right') - 1
+        b[values == bins[-1]] = nbins - 1
+        inside = (b >= 0) & (b < nbins)
+        hist_keys, hist_counts = np.unique(cells[inside].astype(np.int64) * nbins + b[inside], return_counts=True)
+        hist_cells, hist_bins = np.divmod(hist_keys, nbins)
+        return cls(dimensions, categories, codes, sums, counts, hist_cells.astype(np.int32),
+                   hist_bins.astype(np.int16), hist_counts.astype(np.int32), bins)
+
+    def __len__(self):
+        return len(self.counts)
+
+    # Mask of the cells matching 'where', a dictionary of dimension -> value
+    # or list of values
+    def _mask(self, where):
+        mask = np.ones(len(self), dtype=bool)
+        for d, values in (where or {}).items():
+            if not isinstance(values, (list, tuple, set)):
+                values = [values]
+            categories = self.categories[d]
+            wanted = [categories.index(v) for v in values if v in categories]
+            mask &= np.in1d(self.codes[:, self.dimensions.index(d)], wanted)
+        return mask
+
+    # Sum and count of the measure by the 'by' dimensions over the cells
+    # matching 'where'. Returns a DataFrame with the 'by' columns, the sum of
+    # the measure (named after it), 'count' and 'mean'.
+    def query(self, by=(), where=None):
+        mask = self._mask(where)
+        by = list(by)
+        columns = [self.dimensions.index(d) for d in by]
+        if by and not mask.any():
+            # np.unique with axis=0 fails on an empty selection
+            groups, index = np.zeros((0, len(by)), dtype=np.int32), np.zeros(0, dtype=np.intp)
+        elif by:
+            groups, index = np.unique(self.codes[mask][:, columns], axis=0, return_inverse=True)
+        else:
+            groups, index = np.zeros((1, 0), dtype=np.int32), np.zeros(mask.sum(), dtype=np.intp)
+        sums = np.bincount(index, weights=self.sums[mask], minlength=len(groups))
+        counts = np.bincount(index, weights=self.counts[mask], minlength=len(groups)).astype(np.int64)
+
+        result = pandas.DataFrame(dict((d, np.array(self.categories[d])[groups[:, i]]) for i, d in enumerate(by)),
+                                  columns=by)
+        result[MEASURE] = sums
+        result['count'] = counts
+        result['mean'] = sums / np.maximum(counts, 1)
+        return result
+
+    # Histogram counts of the measure over the cells matching 'where', one per bin
+    def histogram(self, where=None):
+        selected = self._mask(where)[self.hist_cells]
+        return np.bincount(self.hist_bins[selected], weights=self.hist_counts[selected],
+                           minlength=len(self.bins) - 1).astype(np.int64)
+
+    def save(self, path, key=None):
+        tmp = path + '.tmp'
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        for name in ARRAYS:
+            np.save(os.path.join(tmp, name + '.npy'), getattr(self, name))
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump({'key': key, 'dimensions': self.dimensions, 'categories': self.categories}, f)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp, path)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        mode = 'r' if mmap else None
+        arrays = [np.load(os.path.join(path, name + '.npy'), mmap_mode=mode)
+                  for name in ARRAYS]
+        return cls(meta['dimensions'], meta['categories'], *arrays)
+
+def _read_key(path):
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            return json.load(f)['key']
+    except (IOError, ValueError):
+        return None
+
+# Load the cube of a turnstile CSV file from '<csv_file>.cube', building and
+# saving it first if the file or the cube layout changed since it was built
+def load_cube(csv_file, dimensions=DIMENSIONS, bins=HIST_BINS):
+    path = csv_file + '.cube'
+    key = loader.cache_key(csv_file, loader.SCHEMA)
+    key.update({'cube_version': CUBE_VERSION, 'dimensions': list(dimensions), 'bins': np.asarray(bins).tolist()})
+    if _read_key(path) != json.loads(json.dumps(key)):
+        frame = loader.load(csv_file, list(dimensions) + [MEASURE])
+        TurnstileCube.build(frame, dimensions, bins).save(path, key)
+    return TurnstileCube.load(path)
+
+# The cube of the data: a TurnstileCube is used as is, a DataFrame is aggregated
+def as_cube(data, dimensions=None):
+    if isinstance(data, TurnstileCube):
+        return data
+    if dimensions is None:
+        dimensions = [d for d in DIMENSIONS if d in data.columns]
+    return TurnstileCube.build(data, dimensions)
+
+# The cube must give the same day_week sums as pandas and the same rain
+# histograms as np.histogram, also after a save and load, and with missing
+# dimension values and measures in the data
+def test(rows=20000, seed=0):
+    import tempfile
+    rnd = np.random.RandomState(seed)
+    dates = ['05-%02d-11' % d for d in range(1, 32)]
+    frame = pandas.DataFrame({'UNIT': rnd.choice(['R%03d' % u for u in range(40)], rows),
+                              'day_week': rnd.randint(0, 7, rows),
+                              'hour': rnd.choice([0, 4, 8, 12, 16, 20], rows),
+                              'rain': rnd.randint(0, 2, rows),
+                              'DATEn': rnd.choice(dates, rows),
+                              MEASURE: np.round(rnd.exponential(1500, rows))},
+                             columns=DIMENSIONS + [MEASURE])
+    frame.loc[rnd.rand(rows) < 0.01, 'DATEn'] = np.nan
+    frame.loc[rnd.rand(rows) < 0.01, MEASURE] = np.nan
+    frame.loc[:10, MEASURE] = HIST_BINS[-1]
+
+    tmpdir = tempfile.mkdtemp()
+    csv_file = os.path.join(tmpdir, 'turnstile.csv')
+    try:
+        built = TurnstileCube.build(frame)
+        frame.to_csv(csv_file, index=False)
+        for cube in (built, load_cube(csv_file), load_cube(csv_file)):
+            assert len(cube.hist_counts) <= rows
+            complete = frame.dropna()
+            expected = complete.groupby('day_week')[MEASURE].agg(['sum', 'count'])
+            result = cube.query(by=['day_week']).set_index('day_week')
+            assert np.allclose(result[MEASURE], expected['sum'])
+            assert (result['count'] == expected['count']).all()
+
+            for rain in (0, 1):
+                values = complete[MEASURE][complete['rain'] == rain]
+                assert (cube.histogram({'rain': rain}) == np.histogram(values, HIST_BINS)[0]).all()
+            # Selections that match no cell give empty groups
+            for where in ({'rain': 5}, {'DATEn': '06-01-11'}, {'DATEn': dates[0], 'hour': 3}):
+                empty = cube.query(by=['day_week', 'DATEn'], where=where)
+                assert list(empty.columns) == ['day_week', 'DATEn', MEASURE, 'count', 'mean'] and len(empty) == 0
+                total = cube.query(where=where)
+                assert total[MEASURE].tolist() == [0] and total['count'].tolist() == [0]
+                assert not cube.histogram(where).any()
+            # A DATEn slice is derived from the same sparse histograms
+            where = {'rain': 1, 'DATEn': dates[:3], 'hour': 8}
+            values = complete[MEASURE][(complete['rain'] == 1) & complete['DATEn'].isin(dates[:3]) &
+                                       (complete['hour'] == 8)]
+            assert (cube.histogram(where) == np.histogram(values, HIST_BINS)[0]).all()
+    finally:
+        shutil.rmtree(tmpdir)
+        shutil.rmtree(csv_file + '.cube', ignore_errors=True)
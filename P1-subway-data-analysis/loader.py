@@ -0,0 +1,203 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas
+
+# Bump when SCHEMA or the cache layout changes, so old caches are rebuilt
+SCHEMA_VERSION = 1
+
+# Column types of the turnstile CSV files (turnstile_weather_v2.csv and
+# turnstile_data_master_with_weather.csv). Columns that are not listed keep
+# the type inferred by pandas.read_csv; text columns are cached as categories.
+SCHEMA = {
+    'UNIT': 'category',
+    'station': 'category',
+    'conds': 'category',
+    'DESCn': 'category',
+    'DATEn': 'category',
+    'TIMEn': 'category',
+    'datetime': 'category',
+    'hour': np.int8,
+    'Hour': np.int8,
+    'day_week': np.int8,
+    'weekday': np.int8,
+    'rain': np.int8,
+    'fog': np.int8,
+    'thunder': np.int8,
+    'ENTRIESn': np.float64,
+    'EXITSn': np.float64,
+    'ENTRIESn_hourly': np.float32,
+    'EXITSn_hourly': np.float32,
+    'precipi': np.float32,
+    'pressurei': np.float32,
+    'tempi': np.float32,
+    'wspdi': np.float32,
+    'meanprecipi': np.float32,
+    'meanpressurei': np.float32,
+    'meantempi': np.float32,
+    'meanwspdi': np.float32,
+    'maxpressurei': np.float32,
+    'minpressurei': np.float32,
+    'maxdewpti': np.float32,
+    'mindewpti': np.float32,
+    'meandewpti': np.float32,
+    'meanwindspdi': np.float32,
+    'mintempi': np.float32,
+    'maxtempi': np.float32,
+    'latitude': np.float32,
+    'longitude': np.float32,
+    'weather_lat': np.float32,
+    'weather_lon': np.float32,
+}
+
+# Parse the CSV file with the types of the schema, only reading 'columns'
+# (all of them by default)
+def read_csv(csv_file, columns=None, schema=SCHEMA):
+    if columns is None:
+        header = pandas.read_csv(csv_file, nrows=0).columns
+    else:
+        header = columns
+    dtypes = dict((c, schema[c]) for c in header if c in schema)
+    return pandas.read_csv(csv_file, usecols=columns, dtype=dtypes)
+
+def _schema_key(schema):
+    return sorted((c, str(np.dtype(t)) if t != 'category' else t) for c, t in schema.items())
+
+# Identify the source file and schema a cache was built from. Caches derived
+# from the file, like cube.load_cube, are keyed with it too.
+def cache_key(csv_file, schema=SCHEMA):
+    stat = os.stat(csv_file)
+    return {'path': os.path.abspath(csv_file), 'mtime': stat.st_mtime, 'size': stat.st_size,
+            'schema_version': SCHEMA_VERSION, 'schema': _schema_key(schema)}
+
+# Directory of the cache of a CSV file: '<csv_file>.cache' next to it, or a
+# directory named after the file and a hash of its path in 'cache_dir'
+def cache_path(csv_file, cache_dir=None):
+    if cache_dir is None:
+        return csv_file + '.cache'
+    digest = hashlib.sha1(os.path.abspath(csv_file).encode('utf-8')).hexdigest()[:10]
+    return os.path.join(cache_dir, '%s.%s' % (os.path.basename(csv_file), digest))
+
+# Write every column of the frame as a .npy file; categories are stored as
+# codes with their values in meta.json
+def _write_cache(frame, path, key):
+    tmp = path + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    categories = {}
+    for i, c in enumerate(frame.columns):
+        column = frame[c]
+        if column.dtype == object:
+            column = column.astype('category')
+        if hasattr(column, 'cat'):
+            categories[c] = [v if isinstance(v, basestring) else str(v) for v in column.cat.categories]
+            values = column.cat.codes.values
+        else:
+            values = column.values
+        np.save(os.path.join(tmp, '%d.npy' % i), values)
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump({'key': key, 'columns': list(frame.columns), 'categories': categories}, f)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+
+def _read_meta(path):
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def _read_cache(path, meta, columns):
+    names = meta['columns']
+    data = {}
+    for c in columns if columns is not None else names:
+        values = np.load(os.path.join(path, '%d.npy' % names.index(c)), mmap_mode='r')
+        if c in meta['categories']:
+            data[c] = pandas.Categorical.from_codes(values, meta['categories'][c])
+        else:
+            data[c] = values
+    return pandas.DataFrame(data, columns=columns if columns is not None else names)
+
+# Load the turnstile CSV file as a typed DataFrame with only 'columns' (all
+# of them by default). The first load parses the file and writes a binary
+# cache with one memory-mappable array per column (see cache_path). Later
+# loads read the projected columns from the cache, as long as the path,
+# modification time and size of the file and the schema are the same.
+def load(csv_file, columns=None, cache=True, cache_dir=None, schema=SCHEMA):
+    if not cache:
+        return read_csv(csv_file, columns, schema)
+    path = cache_path(csv_file, cache_dir)
+    key = cache_key(csv_file, schema)
+    meta = _read_meta(path)
+    if meta is None or meta['key'] != json.loads(json.dumps(key)):
+        frame = read_csv(csv_file, None, schema)
+        _write_cache(frame, path, key)
+        meta = _read_meta(path)
+    return _read_cache(path, meta, columns)
+
+# Remove the cache of a CSV file
+def clear_cache(csv_file, cache_dir=None):
+    path = cache_path(csv_file, cache_dir)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+
+# The cached columns must keep the schema types, a second load must come from
+# the cache and give the same frame, and a new modification time of the file
+# must rebuild the cache
+def test():
+    global read_csv
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    csv_file = os.path.join(tmpdir, 'turnstile.csv')
+    pandas.DataFrame({'UNIT': ['R001', 'R002', 'R001', 'R003'],
+                      'DATEn': ['05-01-11', '05-01-11', '05-02-11', '05-02-11'],
+                      'hour': [0, 4, 8, 12],
+                      'rain': [0, 1, 1, 0],
+                      'ENTRIESn_hourly': [10.0, 0.0, 2500.5, 7.0],
+                      'tempi': [55.9, 57.2, 60.1, 61.0],
+                      'extra': [1, 2, 3, 4]},
+                     columns=['UNIT', 'DATEn', 'hour', 'rain', 'ENTRIESn_hourly', 'tempi', 'extra']
+                     ).to_csv(csv_file, index=False)
+
+    parse = read_csv
+    calls = [0]
+    def counting_read_csv(*args, **kwargs):
+        calls[0] += 1
+        return parse(*args, **kwargs)
+
+    read_csv = counting_read_csv
+    try:
+        first = load(csv_file)
+        assert calls[0] == 1
+        assert os.path.isdir(cache_path(csv_file))
+        assert dict(first.dtypes.astype(str)) == {'UNIT': 'category', 'DATEn': 'category', 'hour': 'int8',
+                                                  'rain': 'int8', 'ENTRIESn_hourly': 'float32',
+                                                  'tempi': 'float32', 'extra': 'int64'}
+        pandas.testing.assert_frame_equal(first, parse(csv_file))
+
+        second = load(csv_file)
+        assert calls[0] == 1
+        pandas.testing.assert_frame_equal(second, first)
+        pandas.testing.assert_frame_equal(load(csv_file, ['rain', 'UNIT']), first[['rain', 'UNIT']])
+        assert calls[0] == 1
+
+        with open(csv_file, 'a') as f:
+            f.write('R004,05-03-11,16,1,3.0,62.5,5\n')
+        stat = os.stat(csv_file)
+        os.utime(csv_file, (stat.st_atime, stat.st_mtime + 10))
+        third = load(csv_file)
+        assert calls[0] == 2
+        assert len(third) == 5 and third['UNIT'].iloc[-1] == 'R004'
+
+        # Only the modification time changes
+        os.utime(csv_file, (stat.st_atime, stat.st_mtime + 20))
+        pandas.testing.assert_frame_equal(load(csv_file), third)
+        assert calls[0] == 3
+    finally:
+        read_csv = parse
+        shutil.rmtree(tmpdir)
@@ -1,11 +1,15 @@
+import itertools
+import multiprocessing
 import numpy as np
 import pandas
+import scipy.linalg
 import scipy.stats
 import statsmodels.api as sm
 import matplotlib.pyplot as plt
+import loader
 
 def test():
-    data = pandas.read_csv('turnstile_weather_v2.csv')
+    data = loader.load('turnstile_weather_v2.csv', ['UNIT', 'ENTRIESn_hourly'] + FEATURES)
     p = predictions(data)
     entries = data['ENTRIESn_hourly']
 
@@ -23,27 +27,405 @@ def linear_regression(features, values):
     params = results.params[1:]    
     return intercept, params
 
-def predictions(dataframe):
-    # Select Features (try different features!)
-    features = dataframe[['rain', 'precipi', 'hour', 'weekday']]
+# Same intercept and params as linear_regression(features joined with the
+# one-hot columns of 'groups', one per sorted group value), without building
+# the one-hot columns. The groups are absorbed as fixed effects: the features
+# and values are demeaned within each group, the demeaned features are fitted
+# to get the feature params, and each group effect is the group mean of the
+# values minus the group mean of the features times those params.
+# The constant and the one-hot columns are collinear, and OLS returns the
+# minimum norm solution: the intercept is the sum of the group effects divided
+# by (number of groups + 1), and each one-hot param is the group effect minus
+# the intercept.
+# Returns the intercept, the params, the sorted group values and the group
+# index of each row.
+def linear_regression_absorbed(features, values, groups):
+    features = np.asarray(features, dtype=float)
+    values = np.asarray(values, dtype=float)
+    units, codes = np.unique(np.asarray(groups), return_inverse=True)
 
-    # Add UNIT to features using dummy variables
-    dummy_units = pandas.get_dummies(dataframe['UNIT'], prefix='unit')
-    features = features.join(dummy_units)
+    counts = np.bincount(codes).astype(float)
+    feature_means = np.column_stack([np.bincount(codes, weights=features[:, j], minlength=len(units))
+                                     for j in range(features.shape[1])]) / counts[:, None]
+    value_means = np.bincount(codes, weights=values, minlength=len(units)) / counts
+
+    feature_params = np.linalg.lstsq(features - feature_means[codes], values - value_means[codes], rcond=None)[0]
+    effects = value_means - feature_means.dot(feature_params)
+
+    intercept = effects.sum() / (len(units) + 1)
+    params = np.concatenate([feature_params, effects - intercept])
+    return intercept, params, units, codes
+
+FEATURES = ['rain', 'precipi', 'hour', 'weekday']
+
+def predictions(dataframe, feature_columns=FEATURES):
+    # Select Features (try different features! see feature_search)
+    features = dataframe[list(feature_columns)]
 
     # Values
     values = dataframe['ENTRIESn_hourly']
-    
+
     # Get the numpy arrays
     features_array = features.values
     values_array = values.values
 
-    # Perform linear regression
-    intercept, params = linear_regression(features_array, values_array)
+    # Perform linear regression, with UNIT absorbed as fixed effects instead
+    # of joined to the features as dummy variables
+    intercept, params, units, codes = linear_regression_absorbed(features_array, values_array, dataframe['UNIT'].values)
 
-    predictions = intercept + np.dot(features_array, params)
+    # Same as intercept + np.dot(features joined with the dummy units, params)
+    n = features_array.shape[1]
+    predictions = intercept + np.dot(features_array, params[:n]) + params[n:][codes]
     return predictions
 
+# Largest difference between 'a' and 'b', relative to the magnitude of 'b'
+def _max_relative_error(a, b):
+    a = np.atleast_1d(np.asarray(a, dtype=float))
+    b = np.atleast_1d(np.asarray(b, dtype=float))
+    return np.abs(a - b).max() / max(np.abs(b).max(), 1.0)
+
+# The absorbed fit must give the same intercept, params and predictions as
+# linear_regression on the features joined with the dummy units
+def test_absorbed(csv_file='turnstile_weather_v2.csv', tolerance=1e-8):
+    data = pandas.read_csv(csv_file, usecols=['UNIT', 'ENTRIESn_hourly'] + FEATURES)
+    values = data['ENTRIESn_hourly'].values
+    dense = data[FEATURES].join(pandas.get_dummies(data['UNIT'], prefix='unit')).values.astype(float)
+    dense_intercept, dense_params = linear_regression(dense, values)
+
+    intercept, params, units, codes = linear_regression_absorbed(data[FEATURES].values, values, data['UNIT'].values)
+    n = len(FEATURES)
+    assert _max_relative_error(intercept, dense_intercept) < tolerance
+    assert _max_relative_error(params[:n], dense_params[:n]) < tolerance
+    assert _max_relative_error(params, dense_params) < tolerance
+    assert _max_relative_error(predictions(data), dense_intercept + np.dot(dense, dense_params)) < tolerance
+
+# Incremental least squares over chunks of rows, for data that does not fit
+# in memory. partial_fit accumulates the sufficient statistics of each chunk
+# (X'X and X'y with the constant, the sums of the values and of their
+# squares), so memory does not depend on the number of rows, and
+# finalize returns the same (intercept, params) as linear_regression on all
+# the rows seen so far. New chunks can still be added after finalize.
+# If 'groups' are passed to partial_fit, they are absorbed as fixed effects
+# and finalize returns the same as linear_regression_absorbed; the per group
+# counts and sums are kept instead of one-hot columns.
+class StreamingOLS(object):
+
+    def __init__(self):
+        self.n = 0
+        self.xtx = None
+        self.xty = None
+        self.y_sum = 0.0
+        self.yy = 0.0
+        # Group value -> index into the per group counts and sums
+        self.group_index = {}
+        self.group_counts = None
+        self.group_x = None
+        self.group_y = None
+
+    def partial_fit(self, features, values, groups=None):
+        features = np.asarray(features, dtype=float)
+        values = np.asarray(values, dtype=float)
+        if self.xtx is None:
+            k = features.shape[1]
+            self.xtx = np.zeros((k + 1, k + 1))
+            self.xty = np.zeros(k + 1)
+            self.group_counts = np.zeros(0)
+            self.group_x = np.zeros((0, k))
+            self.group_y = np.zeros(0)
+
+        self.n += len(values)
+        self.xtx[0, 0] += len(values)
+        self.xtx[0, 1:] += features.sum(axis=0)
+        self.xtx[1:, 1:] += np.dot(features.T, features)
+        self.xtx[1:, 0] = self.xtx[0, 1:]
+        self.xty[0] += values.sum()
+        self.xty[1:] += np.dot(features.T, values)
+        self.y_sum += values.sum()
+        self.yy += np.dot(values, values)
+
+        if groups is not None:
+            self._add_groups(features, values, np.asarray(groups))
+        return self
+
+    def _add_groups(self, features, values, groups):
+        chunk_groups, chunk_codes = np.unique(groups, return_inverse=True)
+        for g in chunk_groups:
+            if g not in self.group_index:
+                self.group_index[g] = len(self.group_index)
+        new = len(self.group_index) - len(self.group_counts)
+        if new:
+            self.group_counts = np.concatenate([self.group_counts, np.zeros(new)])
+            self.group_x = np.vstack([self.group_x, np.zeros((new, features.shape[1]))])
+            self.group_y = np.concatenate([self.group_y, np.zeros(new)])
+
+        m = len(chunk_groups)
+        index = np.array([self.group_index[g] for g in chunk_groups])
+        self.group_counts[index] += np.bincount(chunk_codes, minlength=m)
+        self.group_y[index] += np.bincount(chunk_codes, weights=values, minlength=m)
+        for j in range(features.shape[1]):
+            self.group_x[index, j] += np.bincount(chunk_codes, weights=features[:, j], minlength=m)
+
+    # Feature params, intercept and (sorted group values, group effects) of
+    # the absorbed model, as in linear_regression_absorbed
+    def _solve_absorbed(self):
+        order = sorted(self.group_index, key=self.group_index.get)
+        ranks = np.argsort(order)
+        units = np.array(order)[ranks]
+        counts = self.group_counts[ranks]
+        group_x = self.group_x[ranks]
+        group_y = self.group_y[ranks]
+
+        within_xtx, within_xty, within_yy = self.within_gram()
+        feature_params = np.dot(np.linalg.pinv(within_xtx), within_xty)
+        effects = (group_y - np.dot(group_x, feature_params)) / counts
+        return feature_params, units, effects, counts, group_x, group_y
+
+    # X'X, X'y and y'y of the features and values centered within each group,
+    # or around the overall means when no groups were passed. These are the
+    # Gram matrix of the model without the constant and group params.
+    def within_gram(self):
+        if self.group_index:
+            counts, group_x, group_y = self.group_counts, self.group_x, self.group_y
+        else:
+            counts, group_x, group_y = np.array([float(self.n)]), self.xtx[:1, 1:], np.array([self.y_sum])
+        xtx = self.xtx[1:, 1:] - np.dot(group_x.T, group_x / counts[:, None])
+        xty = self.xty[1:] - np.dot(group_x.T, group_y / counts)
+        yy = self.yy - np.dot(group_y, group_y / counts)
+        return xtx, xty, yy
+
+    # Return (intercept, params) like linear_regression, or like the first two
+    # results of linear_regression_absorbed when groups were passed
+    def finalize(self):
+        if self.group_index:
+            feature_params, units, effects, counts, group_x, group_y = self._solve_absorbed()
+            intercept = effects.sum() / (len(units) + 1)
+            return intercept, np.concatenate([feature_params, effects - intercept])
+        # Minimum norm solution like sm.OLS, pinv(X'X)X'y == pinv(X)y
+        params = np.dot(np.linalg.pinv(self.xtx), self.xty)
+        return params[0], params[1:]
+
+    # Sorted group values, in the order of the group params
+    def groups(self):
+        return np.array(sorted(self.group_index))
+
+    # Same as compute_r_squared on the values and the predictions of the fit
+    def r_squared(self):
+        if self.group_index:
+            beta, units, effects, counts, group_x, group_y = self._solve_absorbed()
+            xtx = self.xtx[1:, 1:]
+            ss_res = (self.yy - 2 * np.dot(beta, self.xty[1:]) + np.dot(beta, np.dot(xtx, beta))
+                      - 2 * np.dot(effects, group_y) + 2 * np.dot(effects, np.dot(group_x, beta))
+                      + np.dot(counts, effects ** 2))
+        else:
+            intercept, params = self.finalize()
+            theta = np.concatenate([[intercept], params])
+            ss_res = self.yy - 2 * np.dot(theta, self.xty) + np.dot(theta, np.dot(self.xtx, theta))
+        ss_tot = self.yy - self.y_sum ** 2 / self.n
+        return 1 - ss_res / ss_tot
+
+# Fit a StreamingOLS over a CSV file read 'chunksize' rows at a time. Only the
+# feature, value and group columns are parsed.
+def streaming_regression(csv_file, feature_columns, value_column='ENTRIESn_hourly', group_column=None,
+                         chunksize=100000):
+    columns = list(feature_columns) + [value_column] + ([group_column] if group_column else [])
+    model = StreamingOLS()
+    for chunk in pandas.read_csv(csv_file, usecols=columns, chunksize=chunksize):
+        model.partial_fit(chunk[list(feature_columns)].values, chunk[value_column].values,
+                          chunk[group_column].values if group_column else None)
+    return model
+
+# Same fit as test, reading the CSV in chunks. The params and R^2 must match
+# linear_regression_absorbed, and without the groups linear_regression.
+def test_streaming(csv_file='turnstile_weather_v2.csv', chunksize=100000, tolerance=1e-8):
+    data = pandas.read_csv(csv_file, usecols=['UNIT', 'ENTRIESn_hourly'] + FEATURES)
+    features = data[FEATURES].values
+    values = data['ENTRIESn_hourly'].values
+
+    plain = streaming_regression(csv_file, FEATURES, chunksize=chunksize)
+    intercept, params = plain.finalize()
+    expected_intercept, expected_params = linear_regression(features, values)
+    assert _max_relative_error(intercept, expected_intercept) < tolerance
+    assert _max_relative_error(params, expected_params) < tolerance
+    expected_r_squared = compute_r_squared(values, expected_intercept + np.dot(features, expected_params))
+    assert abs(plain.r_squared() - expected_r_squared) < tolerance
+
+    model = streaming_regression(csv_file, FEATURES, group_column='UNIT', chunksize=chunksize)
+    intercept, params = model.finalize()
+    expected_intercept, expected_params, units, codes = linear_regression_absorbed(features, values,
+                                                                                   data['UNIT'].values)
+    assert _max_relative_error(intercept, expected_intercept) < tolerance
+    assert _max_relative_error(params, expected_params) < tolerance
+    assert abs(model.r_squared() - compute_r_squared(values, predictions(data))) < tolerance
+    return intercept, params, model.r_squared()
+
+# Sweep the symmetric matrix 'a' on pivot k in place (Goodnight, "A Tutorial
+# on the SWEEP Operator"). After sweeping the features of a set S of the
+# matrix [[X'X, X'y], [y'X, y'y]], the S x S block is -inv(X'X[S, S]), the
+# S x y block holds the params and the y x y entry is the residual sum of
+# squares. reverse=True undoes a sweep.
+def sweep(a, k, reverse=False):
+    d = a[k, k]
+    row = a[k].copy()
+    a -= np.outer(row, row) / d
+    a[k] = row / d if not reverse else -row / d
+    a[:, k] = a[k]
+    a[k, k] = -1 / d
+    return a
+
+# R squared of the fit of each subset of feature indices, from the within
+# Gram matrix. One Cholesky solve per subset.
+def _score_subsets(args):
+    xtx, xty, yy, ss_tot, subsets = args
+    scores = []
+    for subset in subsets:
+        s = list(subset)
+        b = xty[s]
+        try:
+            params = scipy.linalg.cho_solve(scipy.linalg.cho_factor(xtx[np.ix_(s, s)]), b)
+        except np.linalg.LinAlgError:
+            params = np.dot(np.linalg.pinv(xtx[np.ix_(s, s)]), b)
+        scores.append(1 - (yy - np.dot(b, params)) / ss_tot)
+    return scores
+
+def _stepwise(xtx, xty, yy, ss_tot, forward, max_size):
+    k = len(xty)
+    a = np.zeros((k + 1, k + 1))
+    a[:k, :k] = xtx
+    a[:k, k] = a[k, :k] = xty
+    a[k, k] = yy
+    selected = []
+    if not forward:
+        for j in range(k):
+            sweep(a, j)
+        selected = range(k)
+    path = [(tuple(selected), 1 - a[k, k] / ss_tot)]
+
+    tolerance = 1e-10 * max(np.abs(np.diag(xtx)).max(), 1)
+    while (len(selected) < max_size) if forward else (len(selected) > 1):
+        if forward:
+            # Decrease of the residual sum of squares when adding each feature
+            gains = [(a[j, k] ** 2 / a[j, j], j) for j in range(k) if j not in selected and a[j, j] > tolerance]
+            if not gains:
+                break
+            gain, j = max(gains)
+            sweep(a, j)
+            selected = selected + [j]
+        else:
+            # Increase of the residual sum of squares when removing each feature
+            loss, j = min((a[i, k] ** 2 / -a[i, i], i) for i in selected)
+            sweep(a, j, reverse=True)
+            selected = [i for i in selected if i != j]
+        path.append((tuple(selected), 1 - a[k, k] / ss_tot))
+    return path
+
+# Rank subsets of the features of a fitted StreamingOLS by R squared. The
+# Gram matrix of the fit is computed once; the groups of the fit, if any,
+# are absorbed in every subset.
+#   - method='exhaustive' scores every subset of up to 'max_size' features,
+#     in 'processes' worker processes when given
+#   - method='forward' adds, and method='backward' removes, the feature that
+#     changes the fit the most at each step, using sweep operations. Only
+#     the steps with up to 'max_size' features are returned.
+# Returns a DataFrame with the features, size, R squared and adjusted R
+# squared of each subset, best first.
+def feature_search(model, feature_names, method='exhaustive', max_size=None, processes=None):
+    xtx, xty, yy = model.within_gram()
+    ss_tot = model.yy - model.y_sum ** 2 / model.n
+    k = len(feature_names)
+    max_size = min(max_size or k, k)
+
+    if method == 'exhaustive':
+        subsets = [s for size in range(1, max_size + 1) for s in itertools.combinations(range(k), size)]
+        if processes:
+            chunks = [subsets[i::processes] for i in range(processes)]
+            pool = multiprocessing.Pool(processes)
+            try:
+                scored = pool.map(_score_subsets, [(xtx, xty, yy, ss_tot, chunk) for chunk in chunks])
+            finally:
+                pool.close()
+                pool.join()
+            results = [(s, r) for chunk, scores in zip(chunks, scored) for s, r in zip(chunk, scores)]
+        else:
+            results = list(zip(subsets, _score_subsets((xtx, xty, yy, ss_tot, subsets))))
+    elif method in ('forward', 'backward'):
+        results = _stepwise(xtx, xty, yy, ss_tot, method == 'forward', max_size)
+        results = [(s, r) for s, r in results if s and len(s) <= max_size]
+    else:
+        raise ValueError("Unknown search method: %s" % method)
+
+    # The constant, or the group params, are part of every model
+    fixed = max(len(model.group_index), 1)
+    table = pandas.DataFrame({
+        'features': [tuple(feature_names[i] for i in s) for s, r in results],
+        'size': [len(s) for s, r in results],
+        'r_squared': [r for s, r in results],
+        'adjusted_r_squared': [1 - (1 - r) * (model.n - 1) / float(model.n - len(s) - fixed) for s, r in results],
+    }, columns=['features', 'size', 'r_squared', 'adjusted_r_squared'])
+    return table.sort_values('r_squared', ascending=False).reset_index(drop=True)
+
+# Fit the candidate features of the dataframe once, with UNIT absorbed, and
+# rank their subsets (see feature_search)
+def search_features(dataframe, candidates, value_column='ENTRIESn_hourly', group_column='UNIT', **kwargs):
+    model = StreamingOLS().partial_fit(dataframe[list(candidates)].values, dataframe[value_column].values,
+                                       dataframe[group_column].values if group_column else None)
+    return feature_search(model, list(candidates), **kwargs)
+
+# Exhaustive R squared must match direct fits of each subset with the groups
+# absorbed, the stepwise paths must take the best next subset of those scores
+# at each step, and the process pool must give the same table
+def test_feature_search(rows=3000, groups=30, seed=0, tolerance=1e-8):
+    rnd = np.random.RandomState(seed)
+    names = ['a', 'b', 'c', 'd', 'e']
+    frame = pandas.DataFrame(rnd.normal(size=(rows, len(names))), columns=names)
+    frame['c'] += 0.5 * frame['a']
+    frame['UNIT'] = rnd.choice(['R%03d' % u for u in range(groups)], rows)
+    effects = dict(('R%03d' % u, rnd.normal(0, 5)) for u in range(groups))
+    frame['ENTRIESn_hourly'] = (frame[names].values.dot([3, -2, 1, 0.5, 0.05]) + frame['UNIT'].map(effects) +
+                                rnd.normal(size=rows))
+
+    values = frame['ENTRIESn_hourly'].values
+    expected = {}
+    for size in range(1, len(names) + 1):
+        for subset in itertools.combinations(names, size):
+            features = frame[list(subset)].values
+            intercept, params, units, codes = linear_regression_absorbed(features, values, frame['UNIT'].values)
+            fitted = intercept + features.dot(params[:size]) + params[size:][codes]
+            expected[subset] = compute_r_squared(values, fitted)
+
+    table = search_features(frame, names)
+    assert len(table) == len(expected)
+    for subset, r_squared in zip(table['features'], table['r_squared']):
+        assert abs(r_squared - expected[subset]) < tolerance, subset
+    assert table['r_squared'].is_monotonic_decreasing
+
+    pooled = search_features(frame, names, processes=2)
+    pandas.testing.assert_frame_equal(pooled, table)
+    limited = search_features(frame, names, max_size=2)
+    assert limited['size'].max() == 2 and len(limited) == 15
+
+    def best(subsets):
+        return max(subsets, key=lambda s: expected[s])
+
+    for method in ('forward', 'backward'):
+        path = search_features(frame, names, method=method).sort_values('size', ascending=method == 'forward')
+        steps = list(path['features'])
+        assert [len(s) for s in steps] == (list(range(1, 6)) if method == 'forward' else list(range(5, 0, -1)))
+        for subset, r_squared in zip(steps, path['r_squared']):
+            assert abs(r_squared - expected[subset]) < tolerance
+        if method == 'forward':
+            assert steps[0] == best([(n,) for n in names])
+            for previous, subset in zip(steps, steps[1:]):
+                assert set(previous) < set(subset)
+                assert subset == best([s for s in expected if len(s) == len(subset) and set(previous) < set(s)])
+        else:
+            assert steps[0] == tuple(names)
+            for previous, subset in zip(steps, steps[1:]):
+                assert set(subset) < set(previous)
+                assert subset == best([s for s in expected if len(s) == len(previous) - 1 and set(s) < set(previous)])
+        # max_size only cuts the path, it does not change the steps taken
+        capped = search_features(frame, names, method=method, max_size=3)
+        assert sorted(capped['features']) == sorted(s for s in steps if len(s) <= 3)
+
 def plot_residuals_hist(turnstile_weather, predictions):
     plt.figure()
     plt.title('Histogram of Residuals')
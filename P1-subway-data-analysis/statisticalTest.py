@@ -3,9 +3,10 @@ from pandas import *
 from ggplot import *
 import scipy
 import scipy.stats
+import loader
 
 def test():
-    data = pandas.read_csv('turnstile_data_master_with_weather.csv')
+    data = loader.load('turnstile_data_master_with_weather.csv', ['rain', 'ENTRIESn_hourly'])
     with_rain_mean, without_rain_mean, U, p = mann_whitney_plus_means(data)
     print 'mean(rain): %f' % with_rain_mean
     print 'mean(no rain): %f' % without_rain_mean
@@ -9,62 +9,77 @@
     The function takes a string with street name as an argument and should return the fixed name
     We have provided a simple test so that you see what exactly is expected
 """
-import xml.etree.cElementTree as ET
 from collections import defaultdict
-import re
 import pprint
+import sketch
+import streetnames
+from osmparse import element_tags, get_element
+from streetnames import street_type_re
 
 OSMFILE = "example.osm"
-street_type_re = re.compile(r'\b\S+\.?$', re.IGNORECASE)
 
 
 expected = ["Street", "Avenue", "Boulevard", "Drive", "Court", "Place", "Square", "Lane", "Road", 
             "Trail", "Parkway", "Commons"]
 
 # Mapping for Hong Kong
-mapping = { "St": "Street",
-            "St.": "Street",
-            "Rd": "Road",
-            "Circuit\\": "Circuit",
-            u"Street\u200e": "Street"
-            }
+mapping = streetnames.mapping
 
 
-def audit_street_type(street_types, street_name):
+# Return the street type of the name if it is not an expected one, otherwise None
+def unexpected_street_type(street_name):
     m = street_type_re.search(street_name)
     if m:
         street_type = m.group()
         if street_type not in expected:
-            street_types[street_type].add(street_name)
+            return street_type
+    return None
+
+
+def audit_street_type(street_types, street_name):
+    street_type = unexpected_street_type(street_name)
+    if street_type is not None:
+        street_types[street_type].add(street_name)
 
 
 def is_street_name(elem):
     return (elem.attrib['k'] == "addr:street")
 
 
-def audit(osmfile):
-    osm_file = open(osmfile, "r")
+def audit(osmfile, backend='etree'):
     street_types = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
+    for elem in get_element(osmfile, backend=backend):
 
         if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_street_name(tag):
-                    audit_street_type(street_types, tag.attrib['v'])
+            for k, v in element_tags(elem):
+                if k == "addr:street":
+                    audit_street_type(street_types, v)
 
     return street_types
 
 
-def update_name(name, mapping):
+# Audit the street types in bounded memory.
+# Instead of every street name of every unexpected type, a SpaceSaving sketch
+# keeps the 'capacity' most frequent types with the number of addr:street tags
+# using them and up to 'examples' street names each. Sketches of different
+# parts of a file can be merged with sketch.SpaceSaving.merge.
+def audit_top(osmfile, capacity=1000, examples=5, backend='etree'):
+    street_types = sketch.SpaceSaving(capacity, examples)
+    for elem in get_element(osmfile, backend=backend):
 
-    # YOUR CODE HERE
-    m = street_type_re.search(name)
-    if m:
-        group = m.group(0)
-        val = mapping[group]
-        name = re.sub(street_type_re, val, name)
+        if elem.tag == "node" or elem.tag == "way":
+            for k, v in element_tags(elem):
+                if k == "addr:street":
+                    street_type = unexpected_street_type(v)
+                    if street_type is not None:
+                        street_types.add(street_type, v)
 
-    return name
+    return street_types
+
+
+# Street types that are not in the mapping are left unchanged
+def update_name(name, mapping):
+    return streetnames.get_normalizer(mapping).normalize(name)
 
 
 def test():
@@ -82,5 +97,41 @@ def test():
                 assert better_name == "Baldwin Road"
 
 
+# The sketch counts bound the exact number of addr:street tags of each street
+# type, and the most frequent type is kept even when the others do not fit
+def test_audit_top(nodes=20000):
+    import os
+    import shutil
+    import tempfile
+    from collections import Counter
+    import synthetic
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        osm_file = os.path.join(tmpdir, 'sample.osm')
+        synthetic.write_osm(osm_file, nodes=nodes, ways=0, tag_density=0.5, abbreviation_ratio=0.5)
+        exact = Counter()
+        for elem in get_element(osm_file):
+            for k, v in element_tags(elem):
+                if k == 'addr:street' and unexpected_street_type(v) is not None:
+                    exact[unexpected_street_type(v)] += 1
+        assert len(exact) > 3
+
+        for capacity in (2, 3, len(exact)):
+            top = audit_top(osm_file, capacity, examples=2)
+            assert len(top) == min(capacity, len(exact))
+            for street_type, count, error in top.top():
+                assert count - error <= exact[street_type] <= count
+                assert len(top.samples[street_type]) <= 2
+                assert all(unexpected_street_type(name) == street_type for name in top.samples[street_type])
+            for street_type in set(exact) - set(top.counts):
+                assert exact[street_type] <= top.min_count()
+            assert top.top(1)[0][0] == exact.most_common(1)[0][0]
+            if capacity == len(exact):
+                assert top.counts == dict(exact) and not any(top.errors.values())
+    finally:
+        shutil.rmtree(tmpdir)
+
+
 if __name__ == '__main__':
     test()
\ No newline at end of file
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Throughput benchmark of the wrangling pipeline.
+
+Each stage (count_tags, key_type, audit, shape_element, process_map and,
+with a MongoDB host, insert_data) runs on synthetic files of several sizes.
+Every run happens in its own process, so the peak RSS of a stage is not
+hidden by an earlier one. The elements per second, peak RSS and output size
+of each stage and size are saved to a JSON baseline, and later runs fail when
+a stage is slower, uses more memory or writes more than the baseline allows.
+
+    python benchmark.py                      # compare against benchmark_baseline.json
+    python benchmark.py --update             # record a new baseline
+    python benchmark.py --sizes 10000 100000 --tolerance 0.3
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import Queue
+import resource
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+
+import audit as project_audit
+import data as project_data
+import mapparser
+import synthetic
+import tags as project_tags
+from osmparse import get_element
+
+SIZES = (10000, 100000)
+TOLERANCE = 0.25
+# Seconds to wait for the result of one stage
+TIMEOUT = 3600
+BASELINE_FILE = 'benchmark_baseline.json'
+
+
+# Each stage takes the OSM file and the MongoDB host, and returns the output
+# file it wrote or None
+def _count_tags(osm_file, host):
+    mapparser.count_tags(osm_file)
+
+def _key_type(osm_file, host):
+    project_tags.process_map(osm_file)
+
+def _audit(osm_file, host):
+    project_audit.audit(osm_file)
+
+def _shape_element(osm_file, host):
+    for element in get_element(osm_file):
+        project_data.shape_element(element)
+
+def _process_map(osm_file, host):
+    project_data.process_map(osm_file, keep=False)
+    return project_data.output_file(osm_file)
+
+# The JSON file is converted before the timed run, see _prepare
+def _insert_data(osm_file, host):
+    import dbutils
+    json_file = project_data.output_file(osm_file)
+    dbutils.get_db('osm_benchmark', host).drop_collection('nodes')
+    dbutils.load_data(json_file, 'nodes', db_name='osm_benchmark', host=host, report=None)
+
+STAGES = OrderedDict([
+    ('count_tags', _count_tags),
+    ('key_type', _key_type),
+    ('audit', _audit),
+    ('shape_element', _shape_element),
+    ('process_map', _process_map),
+    ('insert_data', _insert_data),
+])
+
+
+def _prepare(stage, osm_file):
+    if stage == 'insert_data':
+        project_data.process_map(osm_file, keep=False)
+
+
+def _run_stage(stage, osm_file, host, queue):
+    try:
+        _prepare(stage, osm_file)
+        start = time.time()
+        output = STAGES[stage](osm_file, host)
+        elapsed = time.time() - start
+    except Exception as e:
+        queue.put({'error': '%s: %r' % (stage, e)})
+        return
+    queue.put({'seconds': elapsed,
+               'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               'output_bytes': os.path.getsize(output) if output else 0})
+
+
+# Run one stage on the file in a child process and return its measurements.
+# Raises RuntimeError if the stage fails, the child dies without a result
+# (e.g. killed for using too much memory) or 'timeout' seconds pass.
+def measure(stage, osm_file, elements, host=None, timeout=TIMEOUT):
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=_run_stage, args=(stage, osm_file, host, queue))
+    p.start()
+    deadline = time.time() + timeout
+    result = None
+    while result is None:
+        try:
+            result = queue.get(timeout=1)
+        except Queue.Empty:
+            if not p.is_alive():
+                # The result may have been queued just before the child exited
+                try:
+                    result = queue.get(timeout=1)
+                except Queue.Empty:
+                    raise RuntimeError("%s: the benchmark process exited with code %s" % (stage, p.exitcode))
+            elif time.time() > deadline:
+                p.terminate()
+                p.join()
+                raise RuntimeError("%s: no result after %d seconds" % (stage, timeout))
+    p.join()
+    if 'error' in result:
+        raise RuntimeError(result['error'])
+    result['elements'] = elements
+    result['elements_per_sec'] = elements / max(result['seconds'], 1e-9)
+    return result
+
+
+# Run the stages on synthetic files with 'sizes' nodes (and a tenth as many
+# ways and a hundredth as many relations). 'options' are passed to
+# synthetic.write_osm. insert_data only runs when a MongoDB 'host' is given.
+# Returns {stage: {size: measurements}}, with the sizes as strings like in
+# the JSON baseline.
+def run(sizes=SIZES, stages=None, host=None, seed=0, timeout=TIMEOUT, **options):
+    if stages is None:
+        stages = [s for s in STAGES if s != 'insert_data' or host]
+    results = OrderedDict((stage, OrderedDict()) for stage in stages)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for size in sizes:
+            osm_file = os.path.join(tmpdir, 'benchmark_%d.osm' % size)
+            elements = synthetic.write_osm(osm_file, nodes=size, ways=size // 10, relations=size // 100,
+                                           seed=seed, **options)
+            for stage in stages:
+                result = measure(stage, osm_file, elements, host, timeout)
+                results[stage][str(size)] = result
+                print "%-14s %9d elements: %9.0f elements/s, peak RSS %7d KB, output %d bytes" % (
+                    stage, elements, result['elements_per_sec'], result['peak_rss_kb'], result['output_bytes'])
+    finally:
+        shutil.rmtree(tmpdir)
+    return results
+
+
+def save_baseline(results, path=BASELINE_FILE):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+def load_baseline(path=BASELINE_FILE):
+    with open(path) as f:
+        return json.load(f)
+
+
+# Return the regressions of 'results' against 'baseline' as messages.
+# A stage regresses when its throughput drops, or its peak RSS or output
+# size grows, by more than 'tolerance' (a fraction of the baseline value).
+# Stages and sizes missing from either side are not compared.
+def compare(results, baseline, tolerance=TOLERANCE):
+    regressions = []
+    for stage, sizes in results.iteritems():
+        for size, result in sizes.iteritems():
+            base = baseline.get(stage, {}).get(size)
+            if base is None:
+                continue
+            if result['elements_per_sec'] < base['elements_per_sec'] * (1 - tolerance):
+                regressions.append("%s (%s): %.0f elements/s, baseline %.0f" % (
+                    stage, size, result['elements_per_sec'], base['elements_per_sec']))
+            for field in ('peak_rss_kb', 'output_bytes'):
+                if result[field] > base[field] * (1 + tolerance):
+                    regressions.append("%s (%s): %s %d, baseline %d" % (stage, size, field, result[field], base[field]))
+    return regressions
+
+
+# Run the benchmark and compare it against the baseline file. The baseline is
+# written instead when it does not exist or with update=True.
+# Raises AssertionError listing the regressions.
+def check(baseline_file=BASELINE_FILE, tolerance=TOLERANCE, update=False, **kwargs):
+    results = run(**kwargs)
+    if update or not os.path.exists(baseline_file):
+        save_baseline(results, baseline_file)
+        print "Baseline written to %s" % baseline_file
+        return results
+    regressions = compare(results, load_baseline(baseline_file), tolerance)
+    assert not regressions, "Performance regressions:\n" + "\n".join(regressions)
+    print "No regression against %s (tolerance %d%%)" % (baseline_file, tolerance * 100)
+    return results
+
+
+# A stage whose process dies or hangs must be reported instead of blocking
+# the benchmark
+def test_failures():
+    def crash(osm_file, host):
+        os._exit(3)
+
+    def hang(osm_file, host):
+        time.sleep(60)
+
+    STAGES['crash'], STAGES['hang'] = crash, hang
+    try:
+        for stage, timeout, message in (('crash', TIMEOUT, 'exited with code 3'), ('hang', 2, 'no result after 2')):
+            start = time.time()
+            try:
+                measure(stage, 'unused.osm', 0, timeout=timeout)
+            except RuntimeError as e:
+                assert message in str(e), e
+            else:
+                assert False, "%s did not fail" % stage
+            assert time.time() - start < 10
+    finally:
+        del STAGES['crash'], STAGES['hang']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='number of nodes of each file')
+    parser.add_argument('--stages', nargs='+', choices=STAGES.keys())
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--update', action='store_true', help='record a new baseline')
+    parser.add_argument('--host', help='MongoDB host for the insert_data stage')
+    parser.add_argument('--timeout', type=float, default=TIMEOUT, help='seconds to wait for each stage')
+    parser.add_argument('--tag-density', type=float, default=0.2)
+    parser.add_argument('--problem-ratio', type=float, default=0.0)
+    parser.add_argument('--abbreviation-ratio', type=float)
+    args = parser.parse_args()
+    check(args.baseline, args.tolerance, args.update, sizes=args.sizes, stages=args.stages, host=args.host,
+          timeout=args.timeout, tag_density=args.tag_density, problem_ratio=args.problem_ratio,
+          abbreviation_ratio=args.abbreviation_ratio)
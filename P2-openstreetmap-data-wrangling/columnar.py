@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Columnar binary export of the shaped documents.
+
+Reloading the JSON output for analysis spends most of its time parsing JSON.
+ColumnarSink writes the documents as typed columns instead:
+
+    nodes      node_id (int64), lat, lon (float64), uid (int64),
+               timestamp (int64, seconds since the epoch), version (int32)
+    ways       way_id, way_uid, way_timestamp, way_version, and the node refs
+               as way_offsets (int64, one more than the ways) into way_refs (int64)
+    tags       tag_doc_type (int8, 0 for nodes and 1 for ways), tag_id (int64),
+               tag_key and tag_value (int32 codes into the keys and values
+               dictionaries). Address fields are stored as 'addr:<field>'.
+
+Missing uid, timestamp and version values are -1. The columns are written
+as one .npy file each, which ColumnarMap.load memory-maps, or as Parquet files
+when pyarrow is installed and format='parquet'.
+"""
+import calendar
+import json
+import os
+import time
+from array import array
+
+import numpy as np
+
+import data as project_data
+from stats import DOCUMENT_FIELDS
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+DOC_TYPES = ('node', 'way')
+
+# Column names and types of each table
+TABLES = {
+    'nodes': [('node_id', np.int64), ('lat', np.float64), ('lon', np.float64), ('uid', np.int64),
+              ('timestamp', np.int64), ('version', np.int32)],
+    'ways': [('way_id', np.int64), ('way_uid', np.int64), ('way_timestamp', np.int64),
+             ('way_version', np.int32)],
+    'way_refs': [('way_offsets', np.int64), ('way_refs', np.int64)],
+    'tags': [('tag_doc_type', np.int8), ('tag_id', np.int64), ('tag_key', np.int32), ('tag_value', np.int32)],
+}
+
+# array typecodes of the column types
+TYPECODES = {np.int64: 'l', np.float64: 'd', np.int32: 'i', np.int8: 'b'}
+
+FORMATS = ('npy', 'parquet')
+
+
+# Seconds since the epoch of an OSM timestamp ('2012-03-28T18:31:23Z'), -1 if missing
+def parse_timestamp(timestamp):
+    if not timestamp:
+        return -1
+    return calendar.timegm(time.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ'))
+
+
+def _int(value):
+    return int(value) if value else -1
+
+
+# Write shaped documents as columns to the directory 'path', for use as a
+# process_map sink. Columns are accumulated in compact arrays and written
+# when the sink is closed.
+class ColumnarSink(object):
+
+    def __init__(self, path, format='npy'):
+        if format not in FORMATS:
+            raise ValueError("Unknown columnar format: %s" % format)
+        if format == 'parquet' and pyarrow is None:
+            raise ValueError("The parquet format needs pyarrow to be installed")
+        self.path = path
+        self.format = format
+        self.columns = dict((name, array(TYPECODES[dtype]))
+                            for columns in TABLES.values() for name, dtype in columns)
+        self.columns['way_offsets'].append(0)
+        self.keys = {}
+        self.values = {}
+
+    def _code(self, dictionary, s):
+        code = dictionary.get(s)
+        if code is None:
+            code = dictionary[s] = len(dictionary)
+        return code
+
+    def _add_tag(self, doc_type, id, k, v):
+        c = self.columns
+        c['tag_doc_type'].append(doc_type)
+        c['tag_id'].append(id)
+        c['tag_key'].append(self._code(self.keys, k))
+        c['tag_value'].append(self._code(self.values, v))
+
+    def write(self, el):
+        c = self.columns
+        id = int(el['id'])
+        created = el.get('created', {})
+        uid = _int(created.get('uid'))
+        timestamp = parse_timestamp(created.get('timestamp'))
+        version = _int(created.get('version'))
+
+        if el['doc_type'] == 'node':
+            doc_type = 0
+            lat, lon = el['pos'] if 'pos' in el else (np.nan, np.nan)
+            c['node_id'].append(id)
+            c['lat'].append(lat)
+            c['lon'].append(lon)
+            c['uid'].append(uid)
+            c['timestamp'].append(timestamp)
+            c['version'].append(version)
+        else:
+            doc_type = 1
+            c['way_id'].append(id)
+            c['way_uid'].append(uid)
+            c['way_timestamp'].append(timestamp)
+            c['way_version'].append(version)
+            refs = el.get('node_refs', ())
+            c['way_refs'].extend(int(r) for r in refs)
+            c['way_offsets'].append(len(c['way_refs']))
+
+        for k, v in el.iteritems():
+            if k not in DOCUMENT_FIELDS:
+                self._add_tag(doc_type, id, k, v)
+        for k, v in el.get('address', {}).iteritems():
+            self._add_tag(doc_type, id, 'addr:' + k, v)
+
+    def close(self):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        arrays = {}
+        for columns in TABLES.values():
+            for name, dtype in columns:
+                values = self.columns[name]
+                if len(values):
+                    arrays[name] = np.frombuffer(values, dtype=values.typecode).astype(dtype, copy=False)
+                else:
+                    arrays[name] = np.zeros(0, dtype=dtype)
+
+        if self.format == 'npy':
+            for name, values in arrays.iteritems():
+                np.save(os.path.join(self.path, name + '.npy'), values)
+        else:
+            for table, columns in TABLES.iteritems():
+                if table == 'way_refs':
+                    # Columns of different lengths are stored as two tables
+                    for name, dtype in columns:
+                        pyarrow.parquet.write_table(pyarrow.Table.from_arrays([pyarrow.array(arrays[name])], [name]),
+                                                    os.path.join(self.path, name + '.parquet'))
+                else:
+                    pyarrow.parquet.write_table(
+                        pyarrow.Table.from_arrays([pyarrow.array(arrays[name]) for name, dtype in columns],
+                                                  [name for name, dtype in columns]),
+                        os.path.join(self.path, table + '.parquet'))
+
+        meta = {'format': self.format,
+                'keys': sorted(self.keys, key=self.keys.get),
+                'values': sorted(self.values, key=self.values.get)}
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+
+# The columns of a map exported by ColumnarSink, as attributes named after the
+# columns, plus the 'keys' and 'values' dictionaries of the tag codes.
+class ColumnarMap(object):
+
+    def __init__(self, columns, keys, values):
+        for name, column in columns.iteritems():
+            setattr(self, name, column)
+        self.keys = keys
+        self.values = values
+        self._key_codes = None
+
+    # Load an exported map. The .npy columns are memory-mapped unless
+    # mmap=False; Parquet files are read with memory mapping.
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        columns = {}
+        if meta['format'] == 'npy':
+            mode = 'r' if mmap else None
+            for table in TABLES.values():
+                for name, dtype in table:
+                    columns[name] = np.load(os.path.join(path, name + '.npy'), mmap_mode=mode)
+        else:
+            if pyarrow is None:
+                raise ValueError("Reading the parquet format needs pyarrow to be installed")
+            for table, table_columns in TABLES.iteritems():
+                files = [name for name, dtype in table_columns] if table == 'way_refs' else [table]
+                for f in files:
+                    t = pyarrow.parquet.read_table(os.path.join(path, f + '.parquet'), memory_map=True)
+                    for name in t.column_names:
+                        columns[name] = t.column(name).to_pandas().values
+        return cls(columns, meta['keys'], meta['values'])
+
+    def __len__(self):
+        return len(self.node_id) + len(self.way_id)
+
+    # Node ids of the i-th way
+    def refs(self, i):
+        return self.way_refs[self.way_offsets[i]:self.way_offsets[i + 1]]
+
+    # Tag code of a key, -1 if the key is not used
+    def key_code(self, k):
+        if self._key_codes is None:
+            self._key_codes = dict((key, i) for i, key in enumerate(self.keys))
+        return self._key_codes.get(k, -1)
+
+    # Return a (doc_type, id) -> value dictionary of the values of a tag key,
+    # e.g. tag('amenity')
+    def tag(self, k):
+        mask = self.tag_key == self.key_code(k)
+        return dict(((DOC_TYPES[t], i), self.values[v]) for t, i, v in
+                    zip(self.tag_doc_type[mask], self.tag_id[mask], self.tag_value[mask]))
+
+    # The nodes as a pandas DataFrame, with 'timestamp' converted to datetimes
+    def nodes_frame(self):
+        if pd is None:
+            raise ValueError("nodes_frame needs pandas to be installed")
+        frame = pd.DataFrame(dict((name, getattr(self, name)) for name, dtype in TABLES['nodes']),
+                             columns=[name for name, dtype in TABLES['nodes']])
+        frame['timestamp'] = pd.to_datetime(frame['timestamp'].where(frame['timestamp'] >= 0), unit='s')
+        return frame
+
+    # The tags as a pandas DataFrame with categorical keys and values
+    def tags_frame(self):
+        if pd is None:
+            raise ValueError("tags_frame needs pandas to be installed")
+        return pd.DataFrame({'doc_type': pd.Categorical.from_codes(self.tag_doc_type, DOC_TYPES),
+                             'id': self.tag_id,
+                             'k': pd.Categorical.from_codes(self.tag_key, self.keys),
+                             'v': pd.Categorical.from_codes(self.tag_value, self.values)},
+                            columns=['doc_type', 'id', 'k', 'v'])
+
+
+# Convert the OSM file to columns in 'path' (default '<file_in>.columns').
+# See data.process_map to write them together with the JSON output, with a
+# ColumnarSink in its 'sinks'.
+def export_map(file_in, path=None, format='npy', backend='etree'):
+    sink = ColumnarSink(path or "{0}.columns".format(file_in), format)
+    for el in project_data.iter_map(file_in, backend=backend):
+        sink.write(el)
+    sink.close()
+    return sink.path
+
+
+# Convert a process_map output file to columns in 'path'
+def load_json(json_file, path, format='npy'):
+    sink = ColumnarSink(path, format)
+    for doc in project_data.iter_json(json_file):
+        sink.write(doc)
+    sink.close()
+    return path
+
+
+# The columns of an exported sample must hold the ids, coordinates, metadata,
+# node refs and tags of the shaped documents
+def test(nodes=2000):
+    import shutil
+    import tempfile
+    import synthetic
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        osm_file = os.path.join(tmpdir, 'sample.osm')
+        synthetic.write_osm(osm_file, nodes=nodes, ways=nodes // 10, tag_density=0.5, problem_ratio=0.1)
+        docs = list(project_data.iter_map(osm_file))
+        node_docs = [d for d in docs if d['doc_type'] == 'node']
+        way_docs = [d for d in docs if d['doc_type'] == 'way']
+        tags = set()
+        for d in docs:
+            tags.update((d['doc_type'], int(d['id']), k, v) for k, v in d.iteritems() if k not in DOCUMENT_FIELDS)
+            tags.update((d['doc_type'], int(d['id']), 'addr:' + k, v) for k, v in d.get('address', {}).iteritems())
+
+        formats = ['npy']
+        if pyarrow is None:
+            print "Skipping the parquet format: pyarrow is not installed"
+        else:
+            formats.append('parquet')
+        for format in formats:
+            path = export_map(osm_file, os.path.join(tmpdir, format), format)
+            for mmap in (True, False):
+                m = ColumnarMap.load(path, mmap)
+                assert len(m) == len(docs)
+                assert m.node_id.tolist() == [int(d['id']) for d in node_docs]
+                assert m.lat.tolist() == [d['pos'][0] for d in node_docs]
+                assert m.lon.tolist() == [d['pos'][1] for d in node_docs]
+                assert m.uid.tolist() == [int(d['created']['uid']) for d in node_docs]
+                assert m.version.tolist() == [int(d['created']['version']) for d in node_docs]
+                assert m.timestamp.tolist() == [parse_timestamp(d['created']['timestamp']) for d in node_docs]
+                assert m.way_id.tolist() == [int(d['id']) for d in way_docs]
+                assert [m.refs(i).tolist() for i in range(len(way_docs))] == [
+                    [int(r) for r in d['node_refs']] for d in way_docs]
+                assert set((DOC_TYPES[t], i, m.keys[k], m.values[v]) for t, i, k, v in
+                           zip(m.tag_doc_type, m.tag_id, m.tag_key, m.tag_value)) == tags
+                assert len(m.tag_id) == len(tags)
+                assert m.tag('amenity') == dict(((t, int(i)), v) for t, i, k, v in tags if k == 'amenity')
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    test()
@@ -1,10 +1,31 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import xml.etree.cElementTree as ET
 import pprint
 import re
 import codecs
+import gzip
 import json
+import os
+import time
+from osmparse import element_refs, element_tags, get_element
+import stats as map_stats
+import streetnames
+from tags import classify_key
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 """
 Your task is to wrangle the data and transform the shape of the data
 into the model we mentioned earlier. The output should be a list of dictionaries
@@ -86,25 +107,18 @@
 """
 
 
-lower = re.compile(r'^([a-z]|_)*$')
-lower_colon = re.compile(r'^([a-z]|_)*:([a-z]|_)*$')
-problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
-
 CREATED = [ "version", "changeset", "timestamp", "user", "uid"]
 
 # Mapping for Hong Kong
-mapping = { "St": "Street",
-            "St.": "Street",
-            "Rd": "Road",
-            "Circuit\\": "Circuit",
-            u"Street\u200e": "Street"
-            }
+mapping = streetnames.mapping
 
-street_type_re = re.compile(r'\b\S+\.?$', re.IGNORECASE)
+# Renamed streets are counted in normalizer.stats and normalizer.renames
+normalizer = streetnames.get_normalizer(mapping)
 
-audited_street_count = 0
-
-def shape_element(element):
+# The element can be an Element or an osmparse.OsmRecord.
+# With a node_store (see nodestore.NodeStore), ways also get their resolved
+# 'coords', 'length' and 'bbox'.
+def shape_element(element, node_store = None):
     node = {}
     if element.tag == "node" or element.tag == "way" :
         # YOUR CODE HERE
@@ -127,72 +141,335 @@ def shape_element(element):
                     node['created'] = {}
                 node['created'][a] = val
                 
-        for t in element.findall('tag'):
-            k = t.attrib['k'].strip()
-            v = t.attrib['v'].strip()
-
-            p = problemchars.findall(k)
-            if(len(p) > 0):
+        for k, v in element_tags(element):
+            key = classify_key(k)
+            if key.field is None:
                 continue
+            v = v.strip()
 
-            if k.startswith('addr:'):
-                k = k[5:]
-                if ':' in k:
-                    continue
-
+            if key.address:
                 # audit street name
-                if k == 'street':
-                    v = update_name(v)
+                if key.field == 'street':
+                    v = normalizer.normalize(v)
 
-                node.setdefault('address',{})[k] = v
+                node.setdefault('address',{})[key.field] = v
             else:
-                node[k] = v
+                node[key.field] = v
                     
-        for nd in element.findall('nd'):
-            v = nd.attrib['ref'].strip()
-            node.setdefault('node_refs',[]).append(v)
+        for ref in element_refs(element):
+            node.setdefault('node_refs',[]).append(ref.strip())
+
+        if node_store is not None and element.tag == 'way':
+            node_store.resolve_ways([node])
         
         return node
     else:
         return None
 
 def update_name(name):
-    global audited_street_count
-
-    # YOUR CODE HERE
-    m = street_type_re.search(name)
-    if m:
-        group = m.group(0)
-        if group in mapping:
-            val = mapping[group]
-            newname = re.sub(street_type_re, val, name)
-            print "[%s] -> [%s]" % (name, newname)
-            audited_street_count += 1
-            name = newname
-
-    return name
-
-def process_map(file_in, pretty = False):
-    # You do not need to change this file
-    file_out = "{0}.json".format(file_in)
-    data = []
-    with codecs.open(file_out, "w", "utf-8") as fo:
-        fo.write('[\n')
-        first = True
-        for _, element in ET.iterparse(file_in):
+    return normalizer.normalize(name)
+
+# Yield the shaped document of every node and way in the OSM file.
+# Elements are cleared as soon as they are shaped, so memory use does not
+# depend on the size of the file.
+# With a node_store, nodes are added to the store and the geometry of the
+# ways is resolved 'batch_size' ways at a time.
+# 'backend' is the osmparse parser backend.
+def iter_map(file_in, node_store = None, batch_size = 1000, backend = 'etree'):
+    ways = []
+    for element in get_element(file_in, backend=backend):
+        el = shape_element(element)
+        if not el:
+            continue
+        if node_store is None:
+            yield el
+        elif el['doc_type'] == 'way':
+            ways.append(el)
+            if len(ways) >= batch_size:
+                node_store.resolve_ways(ways)
+                for w in ways:
+                    yield w
+                ways = []
+        else:
+            node_store.write(el)
+            # Keep the document order if a node comes after some ways
+            if ways:
+                node_store.resolve_ways(ways)
+                for w in ways:
+                    yield w
+                ways = []
+            yield el
+
+    if ways:
+        node_store.resolve_ways(ways)
+        for w in ways:
+            yield w
+
+# Serialize one shaped document the way it is written to the output file
+def encode_element(el, pretty = False):
+    if pretty:
+        return json.dumps(el, ensure_ascii=False, indent=2)+"\n"
+    return json.dumps(el, ensure_ascii=False) + "\n"
+
+# ujson escapes '/' by default, which would change every url
+def _ujson_encode(el):
+    return ujson.dumps(el, ensure_ascii=False, escape_forward_slashes=False).decode('utf-8') + u"\n"
+
+def _simplejson_encode(el):
+    return simplejson.dumps(el, ensure_ascii=False) + u"\n"
+
+# Return the function serializing one document for the output file.
+# 'encoder' is 'json' (the standard library, the default), 'ujson',
+# 'simplejson' or 'auto' for the fastest one installed. The faster encoders
+# write the same documents (ujson without the spaces after separators).
+# Pretty output always uses the standard library.
+def get_encoder(encoder = None, pretty = False):
+    if encoder == 'auto':
+        encoder = 'ujson' if ujson is not None else 'simplejson' if simplejson is not None else 'json'
+    if pretty or encoder in (None, 'json'):
+        return lambda el: encode_element(el, pretty)
+    if encoder == 'ujson' and ujson is not None:
+        return _ujson_encode
+    if encoder == 'simplejson' and simplejson is not None:
+        return _simplejson_encode
+    raise ValueError("Unknown or not installed JSON encoder: %s" % encoder)
+
+COMPRESSION_SUFFIXES = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+GZIP_MAGIC = '\x1f\x8b'
+ZSTD_MAGIC = '\x28\xb5\x2f\xfd'
+
+# Open a file for writing bytes, compressed with 'gzip' or 'zstd' (which needs
+# the zstandard package) or not compressed with compression=None
+def open_output(path, compression = None):
+    if compression is None:
+        return open(path, 'wb')
+    elif compression == 'gzip':
+        return gzip.open(path, 'wb', 6)
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise ValueError("zstd compression needs the zstandard package")
+        return zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+    raise ValueError("Unknown compression: %s" % compression)
+
+# Return the compression of a file, from its magic number
+def detect_compression(path):
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return 'gzip'
+    elif magic.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    return None
+
+# Open a file for reading bytes, decompressing it if it is gzip or zstd compressed
+def open_input(path):
+    compression = detect_compression(path)
+    if compression == 'gzip':
+        return gzip.open(path, 'rb')
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise ValueError("%s is zstd compressed, reading it needs the zstandard package" % path)
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+    return open(path, 'rb')
+
+# Write shaped documents to an open file as a JSON array, one document per line.
+# Documents are encoded with 'encoder' (see get_encoder) and written every
+# 'batch_size' documents with a single write.
+class JsonArraySink(object):
+    def __init__(self, fo, pretty = False, encoder = None, batch_size = 1000):
+        self.fo = fo
+        self.pretty = pretty
+        self.encode = get_encoder(encoder, pretty)
+        self.batch_size = batch_size
+        self.buffer = []
+        self.first = True
+        self.fo.write('[\n')
+
+    def write(self, el):
+        self.write_encoded(self.encode(el))
+
+    # Write a document already serialized by encode_element
+    def write_encoded(self, s):
+        if not self.first:
+            self.buffer.append(',')
+        self.buffer.append(s)
+        self.first = False
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.fo.write(u''.join(self.buffer))
+            self.buffer = []
+
+    def close(self):
+        self.buffer.append(']\n')
+        self.flush()
+
+# Write shaped documents to an open file as line-delimited JSON
+class NdjsonSink(object):
+    def __init__(self, fo, encoder = None, batch_size = 1000):
+        self.fo = fo
+        self.encode = get_encoder(encoder)
+        self.batch_size = batch_size
+        self.buffer = []
+
+    def write(self, el):
+        self.write_encoded(self.encode(el))
+
+    def write_encoded(self, s):
+        self.buffer.append(s)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.fo.write(u''.join(self.buffer))
+            self.buffer = []
+
+    def close(self):
+        self.flush()
+
+# Write a checkpoint file atomically
+def _write_checkpoint(checkpoint_file, state):
+    tmp = checkpoint_file + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, checkpoint_file)
+
+# Convert the OSM file to line-delimited JSON ('<file_in>.ndjson') with checkpoints.
+# The output is written to '<file_out>.part'. Every 'checkpoint_every' documents
+# the input byte offset of the next element, the number of documents written
+# and the output position are saved to '<file_out>.ckpt'. After a crash, a
+# rerun with resume=True truncates the output to the last checkpoint, seeks
+# the input forward and continues. The output is renamed to its final name
+# once the whole file is converted.
+# Returns the number of documents written.
+def process_map_resumable(file_in, checkpoint_every = 100000, resume = False):
+    file_out = "{0}.ndjson".format(file_in)
+    part_file = file_out + '.part'
+    checkpoint_file = file_out + '.ckpt'
+
+    state = {'input_offset': 0, 'count': 0, 'output_offset': 0}
+    if resume and os.path.exists(checkpoint_file) and os.path.exists(part_file):
+        with open(checkpoint_file) as f:
+            state = json.load(f)
+
+    with open(part_file, 'r+b' if state['output_offset'] else 'wb') as raw:
+        raw.seek(state['output_offset'])
+        raw.truncate()
+        out = NdjsonSink(codecs.getwriter('utf-8')(raw))
+        count = state['count']
+        last_checkpoint = count
+        for element in get_element(file_in, backend='expat', offset=state['input_offset']):
+            if count - last_checkpoint >= checkpoint_every:
+                out.flush()
+                raw.flush()
+                os.fsync(raw.fileno())
+                _write_checkpoint(checkpoint_file, {'input_offset': element.offset, 'count': count,
+                                                    'output_offset': raw.tell()})
+                last_checkpoint = count
             el = shape_element(element)
             if el:
+                out.write(el)
+                count += 1
+        out.close()
+        raw.flush()
+        os.fsync(raw.fileno())
+
+    os.rename(part_file, file_out)
+    if os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+    return count
+
+separator_re = re.compile(r'[\s,\[\]]*')
+
+# Yield the documents of a process_map output file one by one.
+# Both the JSON array and the line-delimited format are accepted, compressed
+# or not, and only 'chunk_size' characters are buffered beyond the document
+# being decoded.
+def iter_json(json_file, chunk_size = 1 << 20):
+    decoder = json.JSONDecoder()
+    with open_input(json_file) as raw:
+        f = codecs.getreader("utf-8")(raw)
+        buf = u''
+        pos = 0
+        eof = False
+        while True:
+            pos = separator_re.match(buf, pos).end()
+            if pos < len(buf):
+                try:
+                    doc, pos = decoder.raw_decode(buf, pos)
+                    yield doc
+                    continue
+                except ValueError:
+                    # The document is cut by the end of the buffer
+                    if eof:
+                        raise
+            elif eof:
+                return
+
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buf = buf[pos:] + chunk
+            pos = 0
+
+def print_report(count, nbytes, elapsed):
+    print "Wrote %d documents, %d bytes in %.1fs (%.0f docs/s)." % (count, nbytes, elapsed, count / max(elapsed, 1e-9))
+
+# Name of the process_map output file of 'file_in'
+def output_file(file_in, format = 'json', compression = None):
+    return "{0}.{1}{2}".format(file_in, format, COMPRESSION_SUFFIXES[compression])
+
+# Convert the OSM file to '<file_in>.json'.
+# Every shaped document is also passed to the 'write' method of each of the
+# extra 'sinks', which are closed at the end.
+# With keep=False the documents are not held in memory and the number of
+# documents written is returned instead of the list of documents.
+# With a node_store the geometry of the ways is resolved (see iter_map).
+# With stats=True, summary statistics are written to '<file_out>.stats.json'
+# (see stats.MapStats).
+# format='ndjson' writes line-delimited JSON to '<file_in>.ndjson' instead of
+# a JSON array, and compression='gzip' or 'zstd' compresses the output, which
+# gets a '.gz' or '.zst' suffix. 'encoder' selects the JSON encoder (see
+# get_encoder). 'report' is called with the number of documents, the size of
+# the output file and the elapsed seconds at the end, e.g. print_report.
+def process_map(file_in, pretty = False, keep = True, sinks = (), node_store = None, backend = 'etree',
+                stats = False, format = 'json', compression = None, encoder = None, report = None):
+    # You do not need to change this file
+    if format not in ('json', 'ndjson'):
+        raise ValueError("Unknown output format: %s" % format)
+    if pretty and format == 'ndjson':
+        raise ValueError("Line-delimited output cannot be pretty printed")
+    file_out = output_file(file_in, format, compression)
+    if stats:
+        sinks = list(sinks) + [map_stats.MapStats(file_out + '.stats.json')]
+    data = []
+    count = 0
+    start = time.time()
+    with open_output(file_out, compression) as raw:
+        fo = codecs.getwriter("utf-8")(raw)
+        if format == 'ndjson':
+            out = NdjsonSink(fo, encoder)
+        else:
+            out = JsonArraySink(fo, pretty, encoder)
+        for el in iter_map(file_in, node_store, backend=backend):
+            out.write(el)
+            for sink in sinks:
+                sink.write(el)
+            if keep:
                 data.append(el)
-                if not first:
-                    fo.write(',')
-                if pretty:
-                    fo.write(json.dumps(el, ensure_ascii=False, indent=2)+"\n")
-                else:
-                    fo.write(json.dumps(el, ensure_ascii=False) + "\n")
-                first = False
+            count += 1
+        out.close()
 
-        fo.write(']\n')
-    return data
+    for sink in sinks:
+        sink.close()
+    if report is not None:
+        report(count, os.path.getsize(file_out), time.time() - start)
+    return data if keep else count
 
 def test():
     # NOTE: if you are running this code on your computer, with a larger dataset, 
@@ -222,5 +499,98 @@ def test():
     assert data[-1]["node_refs"] == [ "2199822281", "2199822390",  "2199822392", "2199822369", 
                                     "2199822370", "2199822284", "2199822281"]
 
+# Peak memory of process_map(keep=False) must stay flat when the input grows.
+# The small file runs first, so the second run only raises the peak RSS
+# if memory grows with the input.
+def test_streaming(small = 20000, large = 200000, tolerance_kb = 8 * 1024):
+    import resource
+    import shutil
+    import synthetic
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    small_file = os.path.join(tmpdir, 'small.osm')
+    large_file = os.path.join(tmpdir, 'large.osm')
+    synthetic.write_osm(small_file, nodes=small, ways=small // 10)
+    synthetic.write_osm(large_file, nodes=large, ways=large // 10)
+
+    assert process_map(small_file, keep=False) > 0
+    small_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    assert process_map(large_file, keep=False) > 0
+    large_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    print "peak RSS: %d KB -> %d KB (input %d -> %d bytes)" % (
+        small_peak, large_peak, os.path.getsize(small_file), os.path.getsize(large_file))
+    shutil.rmtree(tmpdir)
+    assert large_peak - small_peak < tolerance_kb
+
+# Every encoder, output format and compression must give back the same
+# documents through iter_json, urls and non-ASCII text included
+def test_encoders():
+    import shutil
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    osm_file = os.path.join(tmpdir, 'sample.osm')
+    with codecs.open(osm_file, 'w', 'utf-8') as f:
+        f.write(u'<osm version="0.6">'
+                u'<node id="1" lat="22.2812345" lon="114.1612345" version="2" user="a/b" uid="7">'
+                u'<tag k="website" v="http://example.com/a/b?c=1&amp;d=2"/><tag k="name" v="\u5929\u661f \u78bc\u982d"/>'
+                u'<tag k="addr:street" v="Queen\'s Rd"/></node>'
+                u'<way id="2" version="1"><nd ref="1"/><nd ref="3"/><tag k="url" v="https://x.org/\\path"/></way>'
+                u'</osm>')
+    try:
+        expected = list(iter_map(osm_file))
+        encoders = ['json'] + [e for e, module in (('ujson', ujson), ('simplejson', simplejson)) if module is not None]
+        for encoder in encoders:
+            for format in ('json', 'ndjson'):
+                for compression in (None, 'gzip'):
+                    assert process_map(osm_file, keep=False, format=format, compression=compression,
+                                       encoder=encoder) == len(expected)
+                    json_file = output_file(osm_file, format, compression)
+                    assert detect_compression(json_file) == compression
+                    assert list(iter_json(json_file)) == expected, (encoder, format, compression)
+                    with open_input(json_file) as f:
+                        assert 'http://example.com/a/b' in f.read()
+    finally:
+        shutil.rmtree(tmpdir)
+
+# A conversion interrupted after some checkpoints must resume to the same output
+def test_resume(nodes = 20000):
+    global shape_element
+    import shutil
+    import synthetic
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    osm_file = os.path.join(tmpdir, 'sample.osm')
+    synthetic.write_osm(osm_file, nodes=nodes, ways=nodes // 10)
+
+    count = process_map_resumable(osm_file, checkpoint_every=1000)
+    with open(osm_file + '.ndjson', 'rb') as f:
+        expected = f.read()
+    os.remove(osm_file + '.ndjson')
+
+    # Crash in the middle of the conversion
+    shape = shape_element
+    calls = [0]
+    def crashing_shape_element(element, node_store = None):
+        calls[0] += 1
+        if calls[0] > count // 2:
+            raise IOError("simulated crash")
+        return shape(element, node_store)
+
+    shape_element = crashing_shape_element
+    try:
+        process_map_resumable(osm_file, checkpoint_every=1000)
+    except IOError:
+        pass
+    finally:
+        shape_element = shape
+    assert not os.path.exists(osm_file + '.ndjson')
+
+    assert process_map_resumable(osm_file, checkpoint_every=1000, resume=True) == count
+    with open(osm_file + '.ndjson', 'rb') as f:
+        resumed = f.read()
+    shutil.rmtree(tmpdir)
+    assert resumed == expected
+
 if __name__ == "__main__":
     test()
\ No newline at end of file
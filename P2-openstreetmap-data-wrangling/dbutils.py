@@ -1,67 +1,191 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from pymongo import MongoClient
+from pymongo import ASCENDING, DeleteOne, MongoClient, ReplaceOne, UpdateMany
+from pymongo.errors import BulkWriteError, PyMongoError
 import json
+import os
+import Queue
+import threading
+import time
+import data as project_data
+import osc
+
+DUPLICATE_KEY = 11000
+
+_clients = {}
+
+# Get the shared MongoClient for the host. The client keeps its own
+# connection pool and is safe to use from several threads.
+def get_client(host='localhost:27017'):
+    if host not in _clients:
+        _clients[host] = MongoClient(host)
+    return _clients[host]
 
 # Get the MongoDB database instance by name
-def get_db(db_name):
-    from pymongo import MongoClient
-    client = MongoClient('localhost:27017')
-    db = client[db_name]
-    return db
+def get_db(db_name, host='localhost:27017'):
+    return get_client(host)[db_name]
 
 # Insert the JSON file into a collection of the 'osm' database
 def insert_data(json_file, col_name):
-    db = get_db('osm')
-    with open(json_file) as f:
-        data = json.loads(f.read())
-        db[col_name].insert(data)
-
-# Utility function to lookup nodes by housenumber pattern and add address.place accordingly 
-def update_nodes_place(collection,place,regex='.*'):
-    result = find_nodes_by_housenumber(collection,regex)
-    for n in result:
-        id = n['id']
-        housenumber = n['address']['housenumber']
-        n['address']['place'] = place
-        collection.save(n)
-        print "Place has been added for node[%s] with housenumber[%s]." % (id, housenumber)
+    return load_data(json_file, col_name)
 
-# Utility function to lookup nodes by housenumber pattern and add address.street accordingly 
-def update_nodes_street(collection,street,regex='.*'):
-    result = find_nodes_by_housenumber(collection,regex)
-    for n in result:
-        id = n['id']
-        housenumber = n['address']['housenumber']
-        n['address']['street'] = street
-        collection.save(n)
-        print "Street has been added for node[%s] with housenumber[%s]." % (id, housenumber)
+# Print the progress of load_data
+def print_progress(inserted, elapsed):
+    print "Inserted %d documents in %.1fs (%.0f docs/s)." % (inserted, elapsed, inserted / max(elapsed, 1e-9))
 
-# Utility function to lookup nodes by document ids and add address.place accordingly 
-def update_nodes_place_by_id(collection,place,ids):
-    result = find_nodes_by_id(collection,ids)
-    for n in result:
-        id = n['id']
-        housenumber = n['address']['housenumber']
-        n['address']['place'] = place
-        collection.save(n)
-        print "Place has been added for node[%s] with housenumber[%s]." % (id, housenumber)
+# Insert one batch with unordered insert_many, retrying failed documents.
+# Documents keep the '_id' assigned on the first attempt, so documents that
+# were already written come back as duplicate key errors and are skipped.
+def _insert_batch(collection, docs, retries):
+    pending = docs
+    for attempt in range(retries + 1):
+        try:
+            collection.insert_many(pending, ordered=False)
+            return
+        except BulkWriteError as e:
+            errors = [err for err in e.details['writeErrors'] if err['code'] != DUPLICATE_KEY]
+            pending = [pending[err['index']] for err in errors]
+            if not pending:
+                return
+        except PyMongoError:
+            if attempt == retries:
+                raise
+        time.sleep(0.5 * 2 ** attempt)
+    raise BulkWriteError({'writeErrors': [], 'nInserted': len(docs) - len(pending)})
 
-# Utility function to lookup nodes by document ids and add address.street accordingly 
-def update_nodes_street_by_id(collection,street,ids):
-    result = find_nodes_by_id(collection,ids)
-    for n in result:
-        id = n['id']
-        housenumber = n['address']['housenumber']
-        n['address']['street'] = street
-        collection.save(n)
-        print "Street has been added for node[%s] with housenumber[%s]." % (id, housenumber)
+# Remove the documents of a batch that may have been partially inserted by a previous run
+def _clear_batch(collection, docs):
+    ids = {}
+    for d in docs:
+        ids.setdefault(d['doc_type'], []).append(d['id'])
+    collection.delete_many({'$or': [{'doc_type': t, 'id': {'$in': v}} for t, v in ids.iteritems()]})
 
-# This function finds all nodes with addr:housenumber but not addr:street or addr:place.
+def _read_progress(progress_file):
+    if not os.path.exists(progress_file):
+        return {'done': []}
+    with open(progress_file) as f:
+        return json.load(f)
+
+def _write_progress(progress_file, done):
+    tmp = progress_file + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'done': sorted(done)}, f)
+    os.rename(tmp, progress_file)
+
+# Stream the documents of a process_map output file (JSON array or
+# line-delimited) into a collection.
+#   - documents are sent in unordered insert_many batches of 'batch_size'
+#   - 'workers' threads share one pooled MongoClient
+#   - 'report' is called with the number of inserted documents and the elapsed
+#     seconds every 'report_every' batches
+#   - completed batches are recorded in '<json_file>.<col_name>.progress', so a
+#     run with resume=True only loads the batches that did not complete
+# Progress is only saved every 'report_every' batches, so a crashed run may
+# have inserted batches that are not recorded as done. On resume, the
+# documents of every batch that is not done are deleted before it is loaded.
+# Returns a dictionary with the number of inserted documents, the failed
+# batches as (batch number, error) pairs and the throughput. The errors are
+# also printed with the final report.
+def load_data(json_file, col_name, db_name='osm', host='localhost:27017', batch_size=1000,
+              workers=4, retries=3, resume=False, report=print_progress, report_every=100):
+    collection = get_db(db_name, host)[col_name]
+    progress_file = '%s.%s.progress' % (json_file, col_name)
+    done = set(_read_progress(progress_file)['done']) if resume else set()
+
+    lock = threading.Lock()
+    tasks = Queue.Queue(maxsize=workers * 2)
+    state = {'inserted': 0, 'completed': 0, 'failed': []}
+    start = time.time()
+
+    def work():
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            number, docs = task
+            try:
+                if resume:
+                    _clear_batch(collection, docs)
+                _insert_batch(collection, docs, retries)
+            except Exception as e:
+                with lock:
+                    state['failed'].append((number, '%s: %s' % (e.__class__.__name__, e)))
+                continue
+            with lock:
+                done.add(number)
+                state['inserted'] += len(docs)
+                state['completed'] += 1
+                if state['completed'] % report_every == 0:
+                    _write_progress(progress_file, done)
+                    if report:
+                        report(state['inserted'], time.time() - start)
+
+    threads = [threading.Thread(target=work) for _ in range(workers)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    batch = []
+    number = 0
+    for doc in project_data.iter_json(json_file):
+        batch.append(doc)
+        if len(batch) == batch_size:
+            if number not in done:
+                tasks.put((number, batch))
+            batch = []
+            number += 1
+    if batch and number not in done:
+        tasks.put((number, batch))
+
+    for t in threads:
+        tasks.put(None)
+    for t in threads:
+        t.join()
+
+    elapsed = time.time() - start
+    _write_progress(progress_file, done)
+    if report:
+        report(state['inserted'], elapsed)
+        for number, error in sorted(state['failed']):
+            print "Batch %d failed: %s" % (number, error)
+    return {'inserted': state['inserted'],
+            'failed': sorted(state['failed']),
+            'seconds': elapsed,
+            'docs_per_sec': state['inserted'] / max(elapsed, 1e-9)}
+
+# Apply an OSM change file (.osc) to a collection loaded from the process_map output.
+# Created and modified elements are upserted and deleted ones removed, in ordered
+# bulk_write batches of 'batch_size' operations. Use ensure_indexes first so the
+# doc_type/id filters do not scan the collection.
+# Returns the number of upserted, modified and deleted documents.
+def apply_osc(osc_file, collection, batch_size=1000):
+    stats = {'upserted': 0, 'modified': 0, 'deleted': 0}
+
+    def flush(requests):
+        result = collection.bulk_write(requests, ordered=True)
+        stats['upserted'] += result.upserted_count
+        stats['modified'] += result.modified_count
+        stats['deleted'] += result.deleted_count
+
+    requests = []
+    for key, doc in osc.load_changes(osc_file).iteritems():
+        doc_filter = {'doc_type': key[0], 'id': key[1]}
+        if doc is None:
+            requests.append(DeleteOne(doc_filter))
+        else:
+            requests.append(ReplaceOne(doc_filter, doc, upsert=True))
+        if len(requests) == batch_size:
+            flush(requests)
+            requests = []
+    if requests:
+        flush(requests)
+    return stats
+
+# Filter of the nodes with addr:housenumber but not addr:street or addr:place.
 # The housenumber must match the regular expression argument. By default it matches any string.
-def find_nodes_by_housenumber(collection,regex='.*'):
-    result = collection.find({
+def housenumber_filter(regex='.*'):
+    return {
         'doc_type':'node',
         '$and':[
         {'address.housenumber':{'$exists':1}},
@@ -69,14 +193,263 @@ def find_nodes_by_housenumber(collection,regex='.*'):
         ],
         'address.street':{'$exists':0},
         'address.place':{'$exists':0}
-        })
-    return result
+        }
 
-# This function finds all nodes with id in the passed array.
-def find_nodes_by_id(collection,ids):
-    result = collection.find({
+# Filter of the nodes with id in the passed array.
+def id_filter(ids):
+    return {
         'doc_type':'node',
         'id':{'$in':ids}
-        })
+        }
+
+# Set address.<field> on every document matching the filter with a single update_many.
+# Returns the matched and modified document counts.
+def _set_address(collection, filter, field, value):
+    result = collection.update_many(filter, {'$set': {'address.' + field: value}})
+    return result.matched_count, result.modified_count
+
+# Utility function to lookup nodes by housenumber pattern and add address.place accordingly.
+# With a gazetteer (see gazetteer.AddressGazetteer) the target ids are resolved
+# in memory and updated by id, and the gazetteer is kept up to date.
+def update_nodes_place(collection,place,regex='.*',gazetteer=None):
+    if gazetteer is not None:
+        return _set_address_by_gazetteer(collection, gazetteer, 'place', place, regex)
+    return _set_address(collection, housenumber_filter(regex), 'place', place)
+
+# Utility function to lookup nodes by housenumber pattern and add address.street accordingly 
+def update_nodes_street(collection,street,regex='.*',gazetteer=None):
+    if gazetteer is not None:
+        return _set_address_by_gazetteer(collection, gazetteer, 'street', street, regex)
+    return _set_address(collection, housenumber_filter(regex), 'street', street)
+
+def _set_address_by_gazetteer(collection, gazetteer, field, value, regex):
+    ids = gazetteer.find_nodes_by_housenumber(regex)
+    if not ids:
+        return 0, 0
+    result = _set_address(collection, id_filter(ids), field, value)
+    gazetteer.set_field(field, value, ids)
     return result
 
+# Utility function to lookup nodes by document ids and add address.place accordingly 
+def update_nodes_place_by_id(collection,place,ids):
+    return _set_address(collection, id_filter(ids), 'place', place)
+
+# Utility function to lookup nodes by document ids and add address.street accordingly 
+def update_nodes_street_by_id(collection,street,ids):
+    return _set_address(collection, id_filter(ids), 'street', street)
+
+# Apply a list of address fix-ups in one bulk_write round trip.
+# Each fix-up is a (filter, field, value) tuple, for example
+#   (housenumber_filter('^1[0-9]$'), 'street', 'Nathan Road')
+# Fix-ups are applied in order. Returns the matched and modified document counts.
+def update_addresses(collection, fixes):
+    requests = [UpdateMany(f, {'$set': {'address.' + field: value}}) for f, field, value in fixes]
+    if not requests:
+        return 0, 0
+    result = collection.bulk_write(requests, ordered=True)
+    return result.matched_count, result.modified_count
+
+# Create the indexes used by the fix-up filters, so they do not scan the whole collection
+def ensure_indexes(collection):
+    collection.create_index([('doc_type', ASCENDING), ('id', ASCENDING)])
+    for field in ('address.housenumber', 'address.street', 'address.place'):
+        collection.create_index([(field, ASCENDING)])
+
+# This function finds all nodes with addr:housenumber but not addr:street or addr:place.
+# The housenumber must match the regular expression argument. By default it matches any string.
+def find_nodes_by_housenumber(collection,regex='.*'):
+    return collection.find(housenumber_filter(regex))
+
+# This function finds all nodes with id in the passed array.
+def find_nodes_by_id(collection,ids):
+    return collection.find(id_filter(ids))
+
+# A load that crashes between two progress writes must resume to exactly one
+# copy of every document. Runs against mongomock.
+def test_resume(nodes=300, batch_size=10, report_every=8, crash_after=14):
+    global _insert_batch, _write_progress
+    import mongomock
+    import shutil
+    import synthetic
+    import tempfile
+
+    tmpdir = tempfile.mkdtemp()
+    osm_file = os.path.join(tmpdir, 'sample.osm')
+    synthetic.write_osm(osm_file, nodes=nodes, ways=0)
+    project_data.process_map(osm_file, keep=False)
+    json_file = project_data.output_file(osm_file)
+    host = 'mongomock:%s' % tmpdir
+    _clients[host] = mongomock.MongoClient()
+    collection = get_db('osm', host)['nodes']
+
+    # Simulate a crash: once 'crash_after' batches were inserted nothing else
+    # reaches the database or the progress file
+    insert, write_progress = _insert_batch, _write_progress
+    calls = [0]
+    def crashing_insert_batch(collection, docs, retries):
+        calls[0] += 1
+        if calls[0] <= crash_after:
+            insert(collection, docs, retries)
+    def crashing_write_progress(progress_file, done):
+        if calls[0] < crash_after:
+            write_progress(progress_file, done)
+
+    _insert_batch, _write_progress = crashing_insert_batch, crashing_write_progress
+    try:
+        load_data(json_file, 'nodes', host=host, batch_size=batch_size, workers=1, report=None,
+                  report_every=report_every)
+    finally:
+        _insert_batch, _write_progress = insert, write_progress
+    assert collection.count_documents({}) == crash_after * batch_size
+
+    # mongomock is not thread safe, so the resume also uses a single worker
+    result = load_data(json_file, 'nodes', host=host, batch_size=batch_size, workers=1, resume=True,
+                       report=None, report_every=report_every)
+    del _clients[host]
+    shutil.rmtree(tmpdir)
+    assert not result['failed']
+    assert collection.count_documents({}) == nodes
+    assert len(set(d['id'] for d in collection.find())) == nodes
+
+# apply_osc must leave the same documents as osc.apply_to_json on the example
+# change file, which also deletes an id that is not in the collection
+def test_apply_osc():
+    import mongomock
+    import shutil
+    import tempfile
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        osm_file = os.path.join(tmpdir, 'base.osm')
+        shutil.copy(osc.EXAMPLE_BASE, osm_file)
+        docs = project_data.process_map(osm_file)
+        collection = mongomock.MongoClient()['osm']['nodes']
+        ensure_indexes(collection)
+        collection.insert_many([dict(d) for d in docs])
+
+        json_file = project_data.output_file(osm_file)
+        osc.apply_to_json(osc.EXAMPLE_OSC, json_file)
+        expected = dict(((d['doc_type'], d['id']), d) for d in project_data.iter_json(json_file))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    assert apply_osc(osc.EXAMPLE_OSC, collection, batch_size=2) == {'upserted': 1, 'modified': 2, 'deleted': 1}
+    result = dict(((d['doc_type'], d['id']), d) for d in collection.find({}, {'_id': 0}))
+    assert sorted(result) == [('node', '1'), ('node', '2'), ('node', '4'), ('way', '10')]
+    assert result == expected
+    assert result['node', '1']['amenity'] == 'bar'
+    assert result['way', '10']['node_refs'] == ['1', '2', '4']
+
+# A batch that fails is reported with its error, and the other batches load
+def test_failed_batch(nodes=50, batch_size=10):
+    global _insert_batch
+    import mongomock
+    import shutil
+    import synthetic
+    import tempfile
+
+    tmpdir = tempfile.mkdtemp()
+    osm_file = os.path.join(tmpdir, 'sample.osm')
+    synthetic.write_osm(osm_file, nodes=nodes, ways=0)
+    project_data.process_map(osm_file, keep=False)
+    host = 'mongomock:%s' % tmpdir
+    _clients[host] = mongomock.MongoClient()
+
+    insert = _insert_batch
+    def failing_insert_batch(collection, docs, retries):
+        if docs[0]['id'] == str(2 * batch_size + 1):
+            raise BulkWriteError({'writeErrors': [{'index': 0, 'code': 2, 'errmsg': 'bad document'}]})
+        insert(collection, docs, retries)
+
+    _insert_batch = failing_insert_batch
+    try:
+        result = load_data(project_data.output_file(osm_file), 'nodes', host=host, batch_size=batch_size,
+                           workers=1, report=None)
+    finally:
+        _insert_batch = insert
+        del _clients[host]
+        shutil.rmtree(tmpdir)
+    assert result['inserted'] == nodes - batch_size
+    [(number, error)] = result['failed']
+    assert number == 2 and error.startswith('BulkWriteError') and 'bad document' in error, error
+
+# The fix-up functions must report the matched and modified documents and set
+# the address fields of the right nodes, by housenumber pattern, through a
+# gazetteer and by id. Runs against mongomock.
+def test_update_addresses():
+    import mongomock
+    from gazetteer import AddressGazetteer
+
+    def make_docs():
+        return [{'doc_type': 'node', 'id': '1', 'address': {'housenumber': '12'}},
+                {'doc_type': 'node', 'id': '2', 'address': {'housenumber': '15'}},
+                {'doc_type': 'node', 'id': '3', 'address': {'housenumber': '120'}},
+                {'doc_type': 'node', 'id': '4', 'address': {'housenumber': '13', 'street': 'Nathan Road'}},
+                {'doc_type': 'node', 'id': '5', 'address': {'housenumber': '14', 'place': 'Mong Kok'}},
+                {'doc_type': 'node', 'id': '6'},
+                {'doc_type': 'way', 'id': '1', 'address': {'housenumber': '16'}}]
+
+    def addresses(collection):
+        return dict(((d['doc_type'], d['id']), d.get('address'))
+                    for d in collection.find({}, {'_id': 0, 'doc_type': 1, 'id': 1, 'address': 1}))
+
+    for use_gazetteer in (False, True):
+        collection = mongomock.MongoClient()['osm']['nodes']
+        ensure_indexes(collection)
+        indexes = [info['key'] for info in collection.index_information().values()]
+        for key in ([('doc_type', 1), ('id', 1)], [('address.housenumber', 1)],
+                    [('address.street', 1)], [('address.place', 1)]):
+            assert key in indexes, key
+        docs = make_docs()
+        collection.insert_many([dict(d) for d in docs])
+        gazetteer = None
+        if use_gazetteer:
+            gazetteer = AddressGazetteer()
+            for d in docs:
+                gazetteer.write(d)
+
+        # Only nodes 1 and 2 have a housenumber matching the pattern and no street or place
+        assert update_nodes_street(collection, 'Hennessy Road', '^1[0-9]$', gazetteer) == (2, 2)
+        assert update_nodes_street(collection, 'Hennessy Road', '^1[0-9]$', gazetteer) == (0, 0)
+        assert update_nodes_place(collection, 'Wan Chai', '^12', gazetteer) == (1, 1)
+        result = addresses(collection)
+        assert result['node', '1'] == {'housenumber': '12', 'street': 'Hennessy Road'}
+        assert result['node', '2'] == {'housenumber': '15', 'street': 'Hennessy Road'}
+        assert result['node', '3'] == {'housenumber': '120', 'place': 'Wan Chai'}
+        assert result['node', '4'] == {'housenumber': '13', 'street': 'Nathan Road'}
+        assert result['node', '5'] == {'housenumber': '14', 'place': 'Mong Kok'}
+        assert result['way', '1'] == {'housenumber': '16'}
+        if use_gazetteer:
+            assert gazetteer.find_nodes_by_housenumber() == []
+
+    # By id: the way with the same id and unknown ids are not matched, and a
+    # value that is already set is matched but not modified
+    collection = mongomock.MongoClient()['osm']['nodes']
+    collection.insert_many(make_docs())
+    assert update_nodes_place_by_id(collection, 'Mong Kok', ['1', '5', '99']) == (2, 1)
+    assert update_nodes_street_by_id(collection, 'Nathan Road', ['1', '4', '6']) == (3, 2)
+    result = addresses(collection)
+    assert result['node', '1'] == {'housenumber': '12', 'place': 'Mong Kok', 'street': 'Nathan Road'}
+    assert result['node', '5'] == {'housenumber': '14', 'place': 'Mong Kok'}
+    assert result['node', '6'] == {'street': 'Nathan Road'}
+    assert result['way', '1'] == {'housenumber': '16'}
+
+    # In one bulk write, later fix-ups see the changes of earlier ones
+    collection = mongomock.MongoClient()['osm']['nodes']
+    collection.insert_many(make_docs())
+    assert update_addresses(collection, []) == (0, 0)
+    assert update_addresses(collection, [(housenumber_filter('^1[0-9]$'), 'street', 'Hennessy Road'),
+                                         (housenumber_filter('^1'), 'place', 'Wan Chai'),
+                                         (id_filter(['2', '4']), 'street', 'Hennessy Road')]) == (5, 4)
+    result = addresses(collection)
+    assert result['node', '1'] == {'housenumber': '12', 'street': 'Hennessy Road'}
+    assert result['node', '2'] == {'housenumber': '15', 'street': 'Hennessy Road'}
+    assert result['node', '3'] == {'housenumber': '120', 'place': 'Wan Chai'}
+    assert result['node', '4'] == {'housenumber': '13', 'street': 'Hennessy Road'}
+    assert result['way', '1'] == {'housenumber': '16'}
+
+if __name__ == '__main__':
+    test_resume()
+    test_failed_batch()
+    test_apply_osc()
+    test_update_addresses()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Address gazetteer built from the 'address' of the shaped documents.
+
+The housenumber, street and place values are kept in sorted lists, so prefix
+and range lookups are binary searches instead of regular expression scans of
+the whole collection. A flag per entry records whether the element has a
+street and a place, which gives the "missing street/place" candidates of the
+fix-up workflow directly.
+
+AddressGazetteer is a process_map sink. dbutils.update_nodes_* accept a
+gazetteer to resolve their target ids through it.
+"""
+import bisect
+import cPickle as pickle
+import re
+
+import data as project_data
+
+FIELDS = ('housenumber', 'street', 'place')
+
+HAS_STREET = 1
+HAS_PLACE = 2
+
+# Characters that end the literal prefix of a regular expression
+regex_special = re.compile(r'[.^$*+?{}\[\]\\|()]')
+
+
+# Return the literal prefix a string must start with to match an anchored regex
+def literal_prefix(regex):
+    # An alternation can match without the prefix
+    if not regex.startswith('^') or '|' in regex:
+        return u''
+    m = regex_special.search(regex, 1)
+    end = m.start() if m else len(regex)
+    # A quantifier after the last literal character makes it optional
+    if m and regex[end] in '*?{':
+        end -= 1
+    return regex[1:max(end, 1)]
+
+
+class AddressGazetteer(object):
+
+    def __init__(self):
+        self.doc_types = []
+        self.ids = []
+        self.flags = bytearray()
+        self.values = dict((f, []) for f in FIELDS)
+        # Per field: sorted (value, entry) pairs and the sorted values alone for bisect
+        self._index = None
+
+    def write(self, el):
+        address = el.get('address')
+        if not address:
+            return
+        self.doc_types.append(el['doc_type'])
+        self.ids.append(el['id'])
+        self.flags.append((HAS_STREET if 'street' in address else 0) | (HAS_PLACE if 'place' in address else 0))
+        for f in FIELDS:
+            self.values[f].append(address.get(f))
+        self._index = None
+
+    def close(self):
+        pass
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _build(self):
+        if self._index is None:
+            self._index = {}
+            for f in FIELDS:
+                pairs = sorted((v, i) for i, v in enumerate(self.values[f]) if v is not None)
+                self._index[f] = ([v for v, i in pairs], [i for v, i in pairs])
+        return self._index
+
+    # Entries with a value of 'field' in [lo, hi)
+    def _range(self, field, lo, hi):
+        keys, entries = self._build()[field]
+        start = bisect.bisect_left(keys, lo)
+        end = len(keys) if hi is None else bisect.bisect_left(keys, hi, start)
+        return entries[start:end]
+
+    def _prefix(self, field, prefix):
+        if not prefix:
+            return self._build()[field][1]
+        return self._range(field, prefix, prefix + u'\uffff')
+
+    # Ids of the elements whose 'field' starts with 'prefix'
+    def lookup_prefix(self, field, prefix):
+        return [self.ids[i] for i in self._prefix(field, prefix)]
+
+    # Ids of the elements whose 'field' is in [lo, hi), hi=None for no upper bound
+    def lookup_range(self, field, lo, hi=None):
+        return [self.ids[i] for i in self._range(field, lo, hi)]
+
+    # Same ids as dbutils.find_nodes_by_housenumber: nodes with a housenumber
+    # matching the regex but no street or place. The literal prefix of an
+    # anchored regex narrows the candidates with a binary search first.
+    def find_nodes_by_housenumber(self, regex='.*'):
+        pattern = re.compile(regex)
+        keys = self.values['housenumber']
+        return [self.ids[i] for i in self._prefix('housenumber', literal_prefix(regex))
+                if not self.flags[i] and self.doc_types[i] == 'node' and pattern.search(keys[i])]
+
+    # Record that addresses were fixed, so later lookups stay consistent
+    def set_field(self, field, value, ids):
+        ids = set(ids)
+        flag = {'street': HAS_STREET, 'place': HAS_PLACE}.get(field, 0)
+        for i, id in enumerate(self.ids):
+            if id in ids and self.doc_types[i] == 'node':
+                self.flags[i] |= flag
+                if field in self.values:
+                    self.values[field][i] = value
+        if field in self.values:
+            self._index = None
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump((self.doc_types, self.ids, self.flags, self.values), f, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        gazetteer = cls()
+        with open(path, 'rb') as f:
+            gazetteer.doc_types, gazetteer.ids, gazetteer.flags, gazetteer.values = pickle.load(f)
+        return gazetteer
+
+    # Build the gazetteer from a process_map output file
+    @classmethod
+    def from_json(cls, json_file):
+        gazetteer = cls()
+        for doc in project_data.iter_json(json_file):
+            gazetteer.write(doc)
+        return gazetteer
+
+
+# Regexes of the lookup test: anchored and unanchored, with and without a
+# literal prefix, with quantifiers and alternations after the first characters
+TEST_PATTERNS = [u'.*', u'^1', u'^12', u'^12$', u'^1[0-9]$', u'^12?', u'^1*2', u'^12{2}', u'^12+',
+                 u'^(12|3)', u'^12|^3', u'^\\d+[A-Z]$', u'A$', u'1-3', u'^$']
+
+
+# find_nodes_by_housenumber and the prefix lookups must return the same ids
+# as filtering every entry, before and after fixing some addresses
+def test(entries=3000, seed=0):
+    import os
+    import random
+    import tempfile
+
+    rnd = random.Random(seed)
+    docs = []
+    for i in xrange(entries):
+        address = {'housenumber': rnd.choice([u'%d' % rnd.randint(1, 150), u'%d%s' % (rnd.randint(1, 40), rnd.choice(u'AB')),
+                                              u'%d-%d' % (rnd.randint(1, 9), rnd.randint(1, 9)), u''])}
+        if rnd.random() < 0.4:
+            address['street'] = rnd.choice([u'Nathan Road', u'Hennessy Road'])
+        if rnd.random() < 0.2:
+            address['place'] = u'Mong Kok'
+        docs.append({'doc_type': rnd.choice(['node', 'node', 'way']), 'id': str(i + 1), 'address': address})
+    docs.append({'doc_type': 'node', 'id': str(entries + 1)})
+
+    def brute_force(regex):
+        pattern = re.compile(regex)
+        return [d['id'] for d in docs if d['doc_type'] == 'node' and 'address' in d and
+                'street' not in d['address'] and 'place' not in d['address'] and
+                pattern.search(d['address']['housenumber'])]
+
+    gazetteer = AddressGazetteer()
+    for d in docs:
+        gazetteer.write(d)
+    assert len(gazetteer) == entries
+
+    for regex in TEST_PATTERNS:
+        assert sorted(gazetteer.find_nodes_by_housenumber(regex)) == sorted(brute_force(regex)), regex
+    for prefix in (u'', u'1', u'12', u'3-', u'9999'):
+        assert sorted(gazetteer.lookup_prefix('housenumber', prefix)) == sorted(
+            d['id'] for d in docs if 'address' in d and d['address']['housenumber'].startswith(prefix))
+    assert sorted(gazetteer.lookup_range('street', u'I')) == sorted(
+        d['id'] for d in docs if d.get('address', {}).get('street', u'') >= u'I')
+
+    # Fix the street of some nodes, like dbutils.update_nodes_street
+    ids = gazetteer.find_nodes_by_housenumber(u'^1')
+    gazetteer.set_field('street', u'Queen\'s Road', ids)
+    for d in docs:
+        if d['doc_type'] == 'node' and d['id'] in ids:
+            d['address']['street'] = u'Queen\'s Road'
+
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        gazetteer.save(path)
+        loaded = AddressGazetteer.load(path)
+    finally:
+        os.remove(path)
+    for g in (gazetteer, loaded):
+        for regex in TEST_PATTERNS:
+            assert sorted(g.find_nodes_by_housenumber(regex)) == sorted(brute_force(regex)), regex
+        assert sorted(g.lookup_prefix('street', u'Queen')) == sorted(ids)
+
+
+if __name__ == '__main__':
+    test()
@@ -10,16 +10,18 @@
 
 Note that your code will be tested with a different data file than the 'example.osm'
 """
-import xml.etree.cElementTree as ET
 import pprint
+from osmparse import element_names, get_element
 
-def count_tags(filename):
+def count_tags(filename, backend='etree'):
         # YOUR CODE HERE
+        # The root element is yielded first, as a record without children
         tags = {}
-        for event,elem in ET.iterparse(filename, events=('start',)):
-            if not elem.tag in tags:
-                tags[elem.tag] = 0
-            tags[elem.tag] += 1
+        for elem in get_element(filename, tags=None, backend=backend, with_root=True):
+            for tag in element_names(elem):
+                if not tag in tags:
+                    tags[tag] = 0
+                tags[tag] += 1
 
         return tags
 
@@ -36,7 +38,60 @@ def test():
                      'tag': 7,
                      'way': 1}
 
-    
+
+# The root element is counted from the file, whatever its name and the backend
+def test_root():
+    import os
+    import tempfile
+    from osmparse import available_backends
+    fd, path = tempfile.mkstemp(suffix='.xml')
+    with os.fdopen(fd, 'w') as f:
+        f.write('<data version="0.6"><node id="1" lat="1" lon="2"><tag k="a" v="b"/></node>'
+                '<way id="2"><nd ref="1"/></way></data>')
+    try:
+        for backend in available_backends():
+            assert count_tags(path, backend=backend) == {'data': 1, 'node': 1, 'tag': 1, 'way': 1, 'nd': 1}
+    finally:
+        os.remove(path)
+
+
+# Every backend gives the same counts, including the children of elements that
+# are not nodes, ways or relations and the descendants of nested children
+def test_backends():
+    import os
+    import shutil
+    import tempfile
+    import synthetic
+    from osmparse import available_backends
+    from scanner import TagCounter, scan
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        nested_file = os.path.join(tmpdir, 'nested.osm')
+        with open(nested_file, 'w') as f:
+            f.write('<osm><bounds minlat="1" minlon="2" maxlat="3" maxlon="4"/>'
+                    '<changeset id="1"><tag k="comment" v="fix"/>'
+                    '<discussion><comment uid="1"><text>ok</text></comment></discussion></changeset>'
+                    '<node id="1" lat="1" lon="2"><tag k="a" v="b"/></node>'
+                    '<way id="2"><nd ref="1"/><tag k="highway" v="path"/></way>'
+                    '<relation id="3"><member type="way" ref="2" role=""/><tag k="type" v="route"/></relation>'
+                    '</osm>')
+        osm_file = os.path.join(tmpdir, 'sample.osm')
+        synthetic.write_osm(osm_file, nodes=2000, ways=200, relations=20, problem_ratio=0.1)
+
+        expected = {'osm': 1, 'bounds': 1, 'changeset': 1, 'discussion': 1, 'comment': 1, 'text': 1,
+                    'tag': 4, 'node': 1, 'way': 1, 'nd': 1, 'relation': 1, 'member': 1}
+        for backend in available_backends():
+            assert count_tags(nested_file, backend=backend) == expected, backend
+            for filename in (nested_file, osm_file):
+                tags = count_tags(filename, backend=backend)
+                assert tags == count_tags(filename), (backend, filename)
+                assert scan(filename, [TagCounter()], backend=backend)['tags'] == tags, (backend, filename)
+        tags = count_tags(osm_file)
+        assert (tags['osm'], tags['bounds'], tags['node'], tags['way'], tags['relation']) == (1, 1, 2000, 200, 20)
+    finally:
+        shutil.rmtree(tmpdir)
+
 
 if __name__ == "__main__":
     test()
\ No newline at end of file
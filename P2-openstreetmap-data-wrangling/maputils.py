@@ -1,62 +1,207 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import xml.etree.ElementTree as ET  # Use cElementTree or lxml if too slow
+import xml.etree.cElementTree as ET
 import audit as project_audit
+from osmparse import element_members, element_refs, element_tags, get_element
 import data as project_data
 from collections import defaultdict
+import random
 
-def get_element(osm_file, tags=('node', 'way', 'relation')):
-    """Yield element if it is the right type of tag
+def _in_bbox(element, bbox):
+    minlat, minlon, maxlat, maxlon = bbox
+    lat = float(element.attrib['lat'])
+    lon = float(element.attrib['lon'])
+    return minlat <= lat <= maxlat and minlon <= lon <= maxlon
 
-    Reference:
-    http://stackoverflow.com/questions/3095434/inserting-newlines-in-xml-file-generated-via-xml-etree-elementtree-in-python
-    """
-    context = ET.iterparse(osm_file, events=('start', 'end'))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
 
+# Select the top level elements of the sample.
+# Only the ids of the selected elements (and the references of the selected
+# ways and relations) are kept, so memory depends on the size of the sample.
+def _select(input_file, k, size, bbox, seed, backend):
+    selected = {'node': set(), 'way': set(), 'relation': set()}
+    refs = {}
+    members = {}
+    reservoir = []
+    rnd = random.Random(seed)
+
+    for i, element in enumerate(get_element(input_file, backend=backend)):
+        tag = element.tag
+        id = element.attrib['id']
+        if bbox is not None:
+            if tag == 'node':
+                keep = _in_bbox(element, bbox)
+            elif tag == 'way':
+                keep = any(ref in selected['node'] for ref in element_refs(element))
+            else:
+                keep = any(m['ref'] in selected[m['type']] for m in element_members(element))
+        elif size is not None:
+            # Reservoir sampling over all top level elements
+            if len(reservoir) < size:
+                keep = True
+                reservoir.append((tag, id))
+            else:
+                j = rnd.randint(0, i)
+                keep = j < size
+                if keep:
+                    old_tag, old_id = reservoir[j]
+                    selected[old_tag].discard(old_id)
+                    if old_tag == 'way':
+                        refs.pop(old_id, None)
+                    elif old_tag == 'relation':
+                        members.pop(old_id, None)
+                    reservoir[j] = (tag, id)
+        else:
+            keep = i % k == 0
+
+        if keep:
+            selected[tag].add(id)
+            if tag == 'way':
+                refs[id] = element_refs(element)
+            elif tag == 'relation':
+                members[id] = [(m['type'], m['ref']) for m in element_members(element)]
+
+    # Every node referenced by a sampled way is part of the sample
+    for way_refs in refs.itervalues():
+        selected['node'].update(way_refs)
+
+    # Relations are only kept if all their members are in the sample
+    for id, relation_members in members.iteritems():
+        if not all(ref in selected[t] for t, ref in relation_members):
+            selected['relation'].discard(id)
+
+    return selected
+
+
+# Get a sample from the full OSM file, which is written to 'output_file'.
+# By default one of every k=20 top level elements is kept. Alternatively:
+#    - size: keep a uniform random sample of 'size' top level elements (reservoir sampling)
+#    - bbox: keep the nodes inside (minlat, minlon, maxlat, maxlon) and the ways
+#      and relations referencing them
+# Every node referenced by a sampled way is written as well, so the sample has no
+# broken ways. Elements are written in the order of the input file.
+# 'backend' is the osmparse backend used to select the sample; elements are
+# always written with ElementTree.
+# Returns the number of written elements keyed by tag.
+def get_sample(input_file, output_file, k=20, size=None, bbox=None, seed=0, backend='etree'):
+    selected = _select(input_file, k, size, bbox, seed, backend)
+    written = {'node': 0, 'way': 0, 'relation': 0}
 
-# Get a sample from the full OSM file by writing one of every 20 elements
-def get_sample(input_file, output_file):
     with open(output_file, 'wb') as output:
         output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
         output.write('<osm>\n  ')
 
-        # Write every 20th top level element
-        for i, element in enumerate(get_element(input_file)):
-            if i % 20 == 0:
+        for element in get_element(input_file):
+            if element.attrib['id'] in selected[element.tag]:
                 output.write(ET.tostring(element, encoding='utf-8'))
+                written[element.tag] += 1
 
         output.write('</osm>')
 
+    return written
+
 # Audit the OSM file.
 # This function returns:
 #    - a dictionary of street names keyed by street type, and
-#    - a dictionary of counts keyed by street type
-def audit2(osmfile):
-    osm_file = open(osmfile, "r")
+#    - a dictionary of the number of distinct street names keyed by street type
+# See audit.audit_top to audit in bounded memory, which counts addr:street
+# tags instead of distinct names.
+def audit2(osmfile, backend='etree'):
     street_types = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
+    for elem in get_element(osmfile, backend=backend):
 
         if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if project_audit.is_street_name(tag):
-                    project_audit.audit_street_type(street_types, tag.attrib['v'])
+            for k, v in element_tags(elem):
+                if k == "addr:street":
+                    project_audit.audit_street_type(street_types, v)
 
-    type_count = {}
-    for s in street_types:
-        if s not in type_count:
-            type_count[s] = 0
-        type_count[s] = len(street_types[s])
+    type_count = dict((s, len(names)) for s, names in street_types.iteritems())
 
     return street_types, type_count
 
 # Convert the input OSM file to JSON file.
 # The process will replace abbreviated street types to full name.
 # For example, 'Taikoo Shing Rd' -> 'Taikoo Shing Road'
-def convert_map(input_file):
-    project_data.process_map(input_file, True)
+# The documents are not kept in memory. See data.process_map for the output
+# format and compression options; pretty printing makes the output much larger.
+def convert_map(input_file, pretty=False, format='json', compression=None, encoder=None):
+    return project_data.process_map(input_file, pretty, keep=False, format=format, compression=compression,
+                                    encoder=encoder, report=project_data.print_report)
+
+# Every way and relation of a sample must have all its nodes and members, a
+# 'size' sample must not exceed 'size' top level elements, and a 'bbox' sample
+# must keep exactly the nodes inside it and the nodes of the ways it keeps.
+# The expat backend must select the same sample as ElementTree.
+def test_get_sample(nodes=2000, ways=300, relations=60):
+    import os
+    import shutil
+    import tempfile
+    import synthetic
+
+    def read(osm_file):
+        elements = {'node': {}, 'way': {}, 'relation': {}}
+        for element in get_element(osm_file):
+            if element.tag == 'node':
+                elements['node'][element.attrib['id']] = (float(element.attrib['lat']), float(element.attrib['lon']))
+            elif element.tag == 'way':
+                elements['way'][element.attrib['id']] = element_refs(element)
+            else:
+                elements['relation'][element.attrib['id']] = [(m['type'], m['ref']) for m in element_members(element)]
+        return elements
+
+    def check_complete(sample):
+        for refs in sample['way'].itervalues():
+            assert all(ref in sample['node'] for ref in refs)
+        for members in sample['relation'].itervalues():
+            assert all(ref in sample[t] for t, ref in members)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        osm_file = os.path.join(tmpdir, 'full.osm')
+        sample_file = os.path.join(tmpdir, 'sample.osm')
+        synthetic.write_osm(osm_file, nodes=nodes, ways=ways, relations=relations)
+        full = read(osm_file)
+
+        samples = {}
+        for backend in ('etree', 'expat'):
+            for name, kwargs in (('k', {'k': 7}), ('size', {'size': 150, 'seed': 1}),
+                                 ('bbox', {'bbox': (22.2, 113.9, 22.3, 114.1)})):
+                written = get_sample(osm_file, sample_file, backend=backend, **kwargs)
+                sample = read(sample_file)
+                assert written == dict((tag, len(sample[tag])) for tag in sample)
+                check_complete(sample)
+                for tag in sample:
+                    assert set(sample[tag]) <= set(full[tag])
+                samples[backend, name] = sample
+        for name in ('k', 'size', 'bbox'):
+            assert samples['etree', name] == samples['expat', name], name
+
+        # Every k-th top level element, except relations with members outside the sample
+        ids = [(tag, id) for tag in ('node', 'way', 'relation') for id in sorted(full[tag], key=int)]
+        sample = samples['etree', 'k']
+        every_k = ids[::7]
+        assert set(sample['way']) == set(id for tag, id in every_k if tag == 'way')
+        assert set(sample['relation']) == set(id for tag, id in every_k if tag == 'relation' and
+                                              all(ref in sample[t] for t, ref in full['relation'][id]))
+        assert set(id for tag, id in every_k if tag == 'node') <= set(sample['node'])
+
+        # The nodes only needed by the sampled ways are not sampled elements
+        sample = samples['etree', 'size']
+        way_nodes = set(ref for refs in sample['way'].itervalues() for ref in refs)
+        sampled_nodes = set(sample['node']) - way_nodes
+        assert len(sampled_nodes) + len(sample['way']) + len(sample['relation']) <= 150
+        assert len(sample['node']) + len(sample['way']) > 150
+
+        minlat, minlon, maxlat, maxlon = (22.2, 113.9, 22.3, 114.1)
+        inside = set(id for id, (lat, lon) in full['node'].iteritems()
+                     if minlat <= lat <= maxlat and minlon <= lon <= maxlon)
+        kept_ways = set(id for id, refs in full['way'].iteritems() if any(ref in inside for ref in refs))
+        sample = samples['etree', 'bbox']
+        assert inside and sample['relation'] and set(sample['way']) == kept_ways
+        assert set(sample['node']) == inside | set(ref for id in kept_ways for ref in full['way'][id])
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    test_get_sample()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compact node id -> (lat, lon) store used to resolve the geometry of ways.
+
+Way documents only carry the ids of their nodes in 'node_refs'. The store
+keeps the node positions in a sorted int64 id array and two float64 arrays
+instead of a dictionary of strings, and resolves many ids at once with a
+single np.searchsorted call.
+
+The store is filled during the node phase of the parse (OSM files list all
+nodes before the ways) and sorted on the first lookup. Nodes added after a
+lookup are sorted into a separate run; a run is only merged into the previous
+one once it is at least half as large, so files where nodes and ways
+interleave do not re-sort the whole store at every lookup. It can be saved as
+.npy files and memory-mapped, so large extracts do not need to fit in RAM.
+"""
+import os
+from array import array
+
+import numpy as np
+
+from spatial import haversine
+
+
+# Merge the sorted run 'b' into the sorted run 'a', each an (ids, lats, lons)
+# tuple. Nodes of 'b' go after the nodes of 'a' with the same id.
+def _merge_runs(a, b):
+    positions = np.searchsorted(a[0], b[0], side='right') + np.arange(len(b[0]))
+    from_a = np.ones(len(a[0]) + len(b[0]), dtype=bool)
+    from_a[positions] = False
+    merged = []
+    for x, y in zip(a, b):
+        m = np.empty(len(from_a), dtype=x.dtype)
+        m[from_a] = x
+        m[positions] = y
+        merged.append(m)
+    return tuple(merged)
+
+
+# With a 'path', the sorted arrays are written there when the store is
+# finalized and memory-mapped back instead of being kept in RAM.
+class NodeStore(object):
+
+    def __init__(self, path=None):
+        self.path = path
+        self._ids = array('l')
+        self._lats = array('d')
+        self._lons = array('d')
+        # Sorted runs of the nodes added since the last merge into the
+        # sorted arrays, oldest first, each less than half the previous size
+        self._runs = []
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.lats = np.zeros(0)
+        self.lons = np.zeros(0)
+
+    def add(self, id, lat, lon):
+        self._ids.append(id)
+        self._lats.append(lat)
+        self._lons.append(lon)
+
+    # Add the position of a shaped node document
+    def write(self, el):
+        if el.get('doc_type') == 'node' and 'pos' in el:
+            self.add(int(el['id']), el['pos'][0], el['pos'][1])
+
+    def close(self):
+        pass
+
+    def __len__(self):
+        return len(self.ids) + sum(len(run[0]) for run in self._runs) + len(self._ids)
+
+    # Sort the nodes added since the last lookup into a new run, and merge
+    # each run into the previous one (the last into the sorted arrays) while
+    # it is at least half as large
+    def _add_run(self):
+        if not len(self._ids):
+            return
+        ids = np.frombuffer(self._ids, dtype=np.int_).astype(np.int64)
+        order = np.argsort(ids, kind='mergesort')
+        self._runs.append((ids[order], np.frombuffer(self._lats)[order], np.frombuffer(self._lons)[order]))
+        self._ids, self._lats, self._lons = array('l'), array('d'), array('d')
+        while len(self._runs) > 1 and 2 * len(self._runs[-1][0]) >= len(self._runs[-2][0]):
+            run = self._runs.pop()
+            self._runs[-1] = _merge_runs(self._runs[-1], run)
+        if 2 * len(self._runs[0][0]) >= len(self.ids):
+            self._merge_sorted()
+
+    # Merge the runs into the sorted arrays
+    def _merge_sorted(self):
+        merged = (self.ids, self.lats, self.lons)
+        for run in self._runs:
+            merged = _merge_runs(merged, run)
+        self.ids, self.lats, self.lons = merged
+        self._runs = []
+        if self.path is not None:
+            self._write(self.path)
+            loaded = NodeStore.load(self.path)
+            self.ids, self.lats, self.lons = loaded.ids, loaded.lats, loaded.lons
+
+    # Merge all the added nodes into the sorted arrays
+    def finalize(self):
+        self._add_run()
+        if self._runs:
+            self._merge_sorted()
+
+    # Return the latitudes and longitudes of an array of node ids, and a mask
+    # of the ids that were found. Positions of missing ids are NaN. The
+    # sorted arrays and then each run are searched; the first match is kept.
+    def lookup(self, ids):
+        self._add_run()
+        ids = np.asarray(ids, dtype=np.int64)
+        lats = np.full(len(ids), np.nan)
+        lons = np.full(len(ids), np.nan)
+        found = np.zeros(len(ids), dtype=bool)
+        for run_ids, run_lats, run_lons in [(self.ids, self.lats, self.lons)] + self._runs:
+            if not len(run_ids):
+                continue
+            idx = np.minimum(np.searchsorted(run_ids, ids), len(run_ids) - 1)
+            match = (run_ids[idx] == ids) & ~found
+            lats[match] = run_lats[idx[match]]
+            lons[match] = run_lons[idx[match]]
+            found |= match
+        return lats, lons, found
+
+    # Add 'coords', 'length' (in meters) and 'bbox' ([minlat, minlon, maxlat, maxlon])
+    # to way documents. All the node refs of the ways are resolved in one lookup.
+    # Nodes missing from the store are left out of the geometry.
+    def resolve_ways(self, ways):
+        ways = [w for w in ways if w.get('node_refs')]
+        if not ways:
+            return
+        counts = [len(w['node_refs']) for w in ways]
+        refs = np.fromiter((int(r) for w in ways for r in w['node_refs']), dtype=np.int64, count=sum(counts))
+        lats, lons, found = self.lookup(refs)
+
+        start = 0
+        for w, n in zip(ways, counts):
+            end = start + n
+            ok = found[start:end]
+            way_lats = lats[start:end][ok]
+            way_lons = lons[start:end][ok]
+            start = end
+            if not len(way_lats):
+                continue
+            w['coords'] = np.column_stack([way_lats, way_lons]).tolist()
+            w['length'] = float(haversine(way_lats[:-1], way_lons[:-1], way_lats[1:], way_lons[1:]).sum())
+            w['bbox'] = [float(way_lats.min()), float(way_lons.min()), float(way_lats.max()), float(way_lons.max())]
+
+    # Save the store to a directory of .npy files
+    def save(self, path):
+        self.finalize()
+        self._write(path)
+
+    def _write(self, path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for name in ('ids', 'lats', 'lons'):
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+
+    # Load a store saved by 'save', memory-mapped unless mmap=False
+    @classmethod
+    def load(cls, path, mmap=True):
+        store = cls(path if mmap else None)
+        mode = 'r' if mmap else None
+        for name in ('ids', 'lats', 'lons'):
+            setattr(store, name, np.load(os.path.join(path, name + '.npy'), mmap_mode=mode))
+        return store
+
+
+# Nodes and lookups interleaved one by one, as data.iter_map does when nodes
+# come after ways, must give the same positions as a dictionary, while the
+# sorted arrays are only rewritten a logarithmic number of times
+def test_interleaved(nodes=5000, seed=0):
+    import random
+    import shutil
+    import tempfile
+
+    class CountingStore(NodeStore):
+        writes = 0
+
+        def _write(self, path):
+            CountingStore.writes += 1
+            NodeStore._write(self, path)
+
+    rnd = random.Random(seed)
+    ids = rnd.sample(xrange(1, 10 * nodes), nodes)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        store = CountingStore(tmpdir)
+        positions = {}
+        for i, id in enumerate(ids):
+            positions[id] = (rnd.uniform(-90, 90), rnd.uniform(-180, 180))
+            store.add(id, *positions[id])
+            refs = [rnd.choice(ids[:i + 1]) for _ in range(3)] + [0]
+            lats, lons, found = store.lookup(refs)
+            assert found.tolist() == [True, True, True, False]
+            assert zip(lats[:3], lons[:3]) == [positions[r] for r in refs[:3]]
+            assert len(store) == i + 1
+        assert CountingStore.writes <= 2 * np.log2(nodes)
+        assert len(store._runs) <= np.log2(nodes) + 1
+
+        store.finalize()
+        assert store.ids.tolist() == sorted(ids)
+        loaded = NodeStore.load(tmpdir, mmap=False)
+        assert loaded.lookup(ids)[2].all()
+        assert zip(*loaded.lookup(ids)[:2]) == [positions[id] for id in ids]
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    test_interleaved()
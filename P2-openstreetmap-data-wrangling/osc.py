@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Incremental updates from OSM change files (.osc).
+
+An osmChange file lists the elements created, modified and deleted since an
+extract was made, in <create>, <modify> and <delete> blocks. The changed
+elements are shaped with data.shape_element and applied as upserts and
+deletes to the process_map output, so a daily refresh does not need a new
+extract and a full conversion. See dbutils.apply_osc to apply them to
+MongoDB instead.
+"""
+import codecs
+import os
+import xml.etree.cElementTree as ET
+
+import data as project_data
+
+ACTIONS = ('create', 'modify', 'delete')
+
+
+# Yield (action, element) for every node, way and relation of the change file.
+# Each action block is cleared as its elements are processed.
+def iter_changes(osc_file):
+    action = None
+    for event, elem in ET.iterparse(osc_file, events=('start', 'end')):
+        if event == 'start':
+            if elem.tag in ACTIONS:
+                action = elem
+        elif elem.tag in ACTIONS:
+            action = None
+        elif action is not None and elem.tag in ('node', 'way', 'relation'):
+            yield action.tag, elem
+            action.clear()
+
+
+# Return the net changes of the file as a dictionary keyed by (doc_type, id).
+# The value is the shaped document to upsert, or None if the element is deleted.
+# Later changes of the same element replace earlier ones. Relations are not
+# part of the process_map output and are skipped.
+def load_changes(osc_file):
+    changes = {}
+    for action, elem in iter_changes(osc_file):
+        if elem.tag == 'relation':
+            continue
+        key = (elem.tag, elem.attrib['id'])
+        changes[key] = None if action == 'delete' else project_data.shape_element(elem)
+    return changes
+
+
+def _is_array(json_file):
+    with project_data.open_input(json_file) as raw:
+        for line in codecs.getreader('utf-8')(raw):
+            if line.strip():
+                return line.lstrip().startswith('[')
+    return False
+
+
+# Apply the change file to a process_map output file (JSON array or
+# line-delimited, compressed or not), keeping its format. The documents are
+# streamed through once: changed ones are replaced or dropped using the id
+# index of the changes, and created ones are appended at the end. The file is replaced atomically.
+# Returns the number of modified, deleted and created documents.
+def apply_to_json(osc_file, json_file, pretty=False):
+    changes = load_changes(osc_file)
+    stats = {'modified': 0, 'deleted': 0, 'created': 0}
+    tmp_file = json_file + '.tmp'
+
+    with project_data.open_output(tmp_file, project_data.detect_compression(json_file)) as raw:
+        fo = codecs.getwriter('utf-8')(raw)
+        if _is_array(json_file):
+            out = project_data.JsonArraySink(fo, pretty)
+        else:
+            out = project_data.NdjsonSink(fo)
+
+        for doc in project_data.iter_json(json_file):
+            key = (doc['doc_type'], doc['id'])
+            if key in changes:
+                new_doc = changes.pop(key)
+                if new_doc is None:
+                    stats['deleted'] += 1
+                    continue
+                doc = new_doc
+                stats['modified'] += 1
+            out.write(doc)
+
+        for key, doc in sorted(changes.iteritems()):
+            if doc is not None:
+                out.write(doc)
+                stats['created'] += 1
+        out.close()
+
+    os.rename(tmp_file, json_file)
+    return stats
+
+
+# Fixtures next to this module: a small extract and a change file that
+# creates, modifies and deletes elements, including an id that is not in it
+EXAMPLE_BASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'example_base.osm')
+EXAMPLE_OSC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'example.osc')
+
+
+def test():
+    import shutil
+    import tempfile
+
+    assert [(action, elem.tag, elem.attrib['id']) for action, elem in iter_changes(EXAMPLE_OSC)] == [
+        ('create', 'node', '4'), ('create', 'relation', '100'), ('modify', 'node', '1'),
+        ('modify', 'way', '10'), ('delete', 'node', '3'), ('delete', 'node', '99')]
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for format in ('json', 'ndjson'):
+            osm_file = os.path.join(tmpdir, 'base.osm')
+            shutil.copy(EXAMPLE_BASE, osm_file)
+            base = dict(((d['doc_type'], d['id']), d) for d in project_data.process_map(osm_file, format=format))
+            json_file = project_data.output_file(osm_file, format)
+
+            assert apply_to_json(EXAMPLE_OSC, json_file) == {'modified': 2, 'deleted': 1, 'created': 1}
+            assert _is_array(json_file) == (format == 'json')
+            docs = list(project_data.iter_json(json_file))
+            # Changed documents stay in place, created ones are appended
+            assert [(d['doc_type'], d['id']) for d in docs] == [
+                ('node', '1'), ('node', '2'), ('way', '10'), ('node', '4')]
+            docs = dict(((d['doc_type'], d['id']), d) for d in docs)
+
+            assert docs['node', '1'] == {
+                'doc_type': 'node', 'id': '1', 'pos': [22.2805, 114.1605], 'amenity': 'bar',
+                'created': {'version': '2', 'changeset': '20', 'timestamp': '2015-02-01T00:00:00Z',
+                            'user': 'bob', 'uid': '2'}}
+            assert docs['node', '2'] == base['node', '2']
+            assert docs['way', '10'] == {
+                'doc_type': 'way', 'id': '10', 'node_refs': ['1', '2', '4'], 'highway': 'residential',
+                'created': {'version': '2', 'changeset': '20', 'timestamp': '2015-02-01T00:00:00Z',
+                            'user': 'bob', 'uid': '2'}}
+            assert docs['node', '4'] == {
+                'doc_type': 'node', 'id': '4', 'pos': [22.283, 114.163], 'amenity': 'restaurant',
+                'address': {'street': "Queen's Road"},
+                'created': {'version': '1', 'changeset': '20', 'timestamp': '2015-02-01T00:00:00Z',
+                            'user': 'bob', 'uid': '2'}}
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Parser backends to stream the top level elements of an OSM file.
+
+Every OSM reader goes through get_element, which supports three backends:
+
+- "etree": xml.etree.cElementTree.iterparse (the default)
+- "lxml": lxml.etree.iterparse, when lxml is installed
+- "expat": a direct expat handler that does not build any tree. It yields
+  lightweight OsmRecord objects holding the attributes of the element and its
+  <tag>, <nd> and <member> children, and the names of its other descendants.
+
+Use element_tags, element_refs, element_members and element_names to read the
+children of an element, so the same code works with Element objects and
+OsmRecords.
+"""
+import os
+import time
+import xml.etree.cElementTree as ET
+import xml.parsers.expat
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+BACKENDS = ('etree', 'lxml', 'expat')
+
+READ_SIZE = 1 << 20
+
+
+# A top level element read by the expat backend
+class OsmRecord(object):
+    __slots__ = ('tag', 'attrib', 'tags', 'refs', 'members', 'others', 'offset')
+
+    def __init__(self, tag, attrib, offset=None):
+        self.tag = tag
+        self.attrib = attrib
+        # byte offset of the start tag in the file
+        self.offset = offset
+        # (k, v) pairs of the <tag> children
+        self.tags = []
+        # 'ref' of the <nd> children
+        self.refs = []
+        # attributes of the <member> children
+        self.members = []
+        # names of the other descendants, e.g. the <text> of a changeset <comment>
+        self.others = []
+
+
+def element_tags(element):
+    if isinstance(element, OsmRecord):
+        return element.tags
+    return [(t.attrib['k'], t.attrib['v']) for t in element.findall('tag')]
+
+
+def element_refs(element):
+    if isinstance(element, OsmRecord):
+        return element.refs
+    return [nd.attrib['ref'] for nd in element.findall('nd')]
+
+
+def element_members(element):
+    if isinstance(element, OsmRecord):
+        return element.members
+    return [m.attrib for m in element.findall('member')]
+
+
+# Names of the element and all its descendants. The names of an OsmRecord are
+# grouped by kind instead of being in document order.
+def element_names(element):
+    if isinstance(element, OsmRecord):
+        return ([element.tag] + ['tag'] * len(element.tags) + ['nd'] * len(element.refs) +
+                ['member'] * len(element.members) + element.others)
+    return [e.tag for e in element.iter()]
+
+
+def _iterparse_elements(iterparse, osm_file, tags, with_root):
+    context = iterparse(osm_file, events=('start', 'end'))
+    _, root = next(context)
+    if with_root:
+        yield OsmRecord(root.tag, dict(root.attrib))
+    depth = 1
+    for event, elem in context:
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        if (elem.tag in tags) if tags else depth == 1:
+            yield elem
+            root.clear()
+
+
+def _expat_records(osm_file, tags, offset, with_root):
+    records = []
+    state = {'depth': 0, 'current': None}
+    # Parsing from an offset starts with a synthetic root element
+    prefix = '<osm>' if offset else ''
+    base = offset - len(prefix)
+
+    def start(name, attrs):
+        state['depth'] += 1
+        current = state['current']
+        if state['depth'] == 1:
+            if with_root and not offset:
+                records.append(OsmRecord(name, attrs, base + parser.CurrentByteIndex))
+        elif current is not None:
+            # Only direct children are tags, refs and members, as with findall
+            child = state['depth'] == state['record_depth'] + 1
+            if child and name == 'tag':
+                current.tags.append((attrs['k'], attrs['v']))
+            elif child and name == 'nd':
+                current.refs.append(attrs['ref'])
+            elif child and name == 'member':
+                current.members.append(attrs)
+            else:
+                current.others.append(name)
+        elif (name in tags) if tags else state['depth'] == 2:
+            state['current'] = OsmRecord(name, attrs, base + parser.CurrentByteIndex)
+            state['record_depth'] = state['depth']
+
+    def end(name):
+        current = state['current']
+        if current is not None and state['depth'] == state['record_depth']:
+            records.append(current)
+            state['current'] = None
+        state['depth'] -= 1
+
+    parser = xml.parsers.expat.ParserCreate()
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+
+    f = open(osm_file, 'rb') if isinstance(osm_file, basestring) else osm_file
+    try:
+        if offset:
+            f.seek(offset)
+            parser.Parse(prefix, False)
+        while True:
+            buf = f.read(READ_SIZE)
+            parser.Parse(buf, not buf)
+            for record in records:
+                yield record
+            del records[:]
+            if not buf:
+                break
+    finally:
+        if f is not osm_file:
+            f.close()
+
+
+def get_element(osm_file, tags=('node', 'way', 'relation'), backend='etree', offset=0, with_root=False):
+    """Yield element if it is the right type of tag
+
+    With tags=None every direct child of the root element is yielded.
+    With with_root=True the root element itself (usually <osm>) is yielded
+    first, as an OsmRecord without children, whatever the backend (but not
+    when parsing from an offset).
+    The expat backend can start parsing at the byte 'offset' of a top level
+    element, as given by OsmRecord.offset.
+    The root element is cleared after each yielded element, so the parsed tree
+    never grows beyond the element being processed.
+
+    Reference:
+    http://stackoverflow.com/questions/3095434/inserting-newlines-in-xml-file-generated-via-xml-etree-elementtree-in-python
+    """
+    if offset and backend != 'expat':
+        raise ValueError("Only the expat backend can start parsing at an offset")
+    if backend == 'etree':
+        return _iterparse_elements(ET.iterparse, osm_file, tags, with_root)
+    elif backend == 'lxml':
+        if lxml_etree is None:
+            raise ValueError("The lxml backend needs lxml to be installed")
+        return _iterparse_elements(lxml_etree.iterparse, osm_file, tags, with_root)
+    elif backend == 'expat':
+        return _expat_records(osm_file, tags, offset, with_root)
+    raise ValueError("Unknown parser backend: %s" % backend)
+
+
+# Backends that can be used in this environment
+def available_backends():
+    return [b for b in BACKENDS if b != 'lxml' or lxml_etree is not None]
+
+
+# Report the elements per second of each backend, reading the tags and node
+# refs of every element. If no file is given, a synthetic file with 'nodes'
+# nodes (about 140 bytes each, so the default is a few GB) is generated.
+def benchmark(osm_file=None, nodes=20000000, backends=None):
+    generated = osm_file is None
+    if generated:
+        import synthetic
+        osm_file = 'benchmark.osm'
+        synthetic.write_osm(osm_file, nodes=nodes, ways=nodes // 10)
+
+    results = {}
+    try:
+        for backend in backends or available_backends():
+            start = time.time()
+            count = 0
+            for element in get_element(osm_file, backend=backend):
+                element_tags(element)
+                element_refs(element)
+                count += 1
+            elapsed = time.time() - start
+            results[backend] = count / max(elapsed, 1e-9)
+            print "%s: %d elements in %.1fs (%.0f elements/s)" % (backend, count, elapsed, results[backend])
+    finally:
+        if generated:
+            os.remove(osm_file)
+    return results
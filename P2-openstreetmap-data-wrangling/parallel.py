@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Multi-process conversion of the OSM file to JSON.
+
+The file is split into byte ranges that start on a top level <node>, <way> or
+<relation> tag. Each range is parsed and shaped by data.shape_element in a
+process pool, and the results are written back in document order, so the
+output is the same as the one of data.process_map byte for byte.
+"""
+import codecs
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+from cStringIO import StringIO
+
+import audit as project_audit
+import data as project_data
+import sketch
+from osmparse import element_tags, get_element
+
+top_level_re = re.compile(r'<(node|way|relation)[\s/>]')
+
+CHUNK_SIZE = 32 * 1024 * 1024
+SCAN_SIZE = 1024 * 1024
+
+
+# Return the offset of the first top level tag at or after 'offset',
+# or None if there is none before 'limit'.
+def _next_element(f, offset, limit):
+    f.seek(offset)
+    while offset < limit:
+        # Keep a small overlap so a tag split between two reads is still found
+        buf = f.read(SCAN_SIZE + 16)
+        if not buf:
+            break
+        m = top_level_re.search(buf)
+        if m:
+            return offset + m.start()
+        offset += SCAN_SIZE
+        f.seek(offset)
+    return None
+
+
+# Split the OSM file into byte ranges of about 'chunk_size' bytes.
+# Each range starts on a top level element and the last one ends before </osm>.
+def split_ranges(file_in, chunk_size=CHUNK_SIZE):
+    size = os.path.getsize(file_in)
+    with open(file_in, 'rb') as f:
+        f.seek(max(0, size - SCAN_SIZE))
+        tail = f.read()
+        closing = tail.rfind('</osm>')
+        end = size - len(tail) + closing if closing >= 0 else size
+
+        starts = []
+        offset = 0
+        while offset < end:
+            start = _next_element(f, offset, end)
+            if start is None or start >= end:
+                break
+            if not starts or start > starts[-1]:
+                starts.append(start)
+            offset = max(start + 1, offset + chunk_size)
+
+    return zip(starts, starts[1:] + [end])
+
+
+# Parse and shape one byte range, returning the serialized documents
+def _shape_range(args):
+    file_in, start, end, pretty, backend = args
+    with open(file_in, 'rb') as f:
+        f.seek(start)
+        chunk = f.read(end - start)
+
+    result = []
+    for element in get_element(StringIO('<osm>' + chunk + '</osm>'), backend=backend):
+        el = project_data.shape_element(element)
+        if el:
+            result.append(project_data.encode_element(el, pretty))
+    return result
+
+
+# Convert the OSM file to '<file_in>.json' using a pool of 'processes' workers.
+# 'backend' is the osmparse parser backend used by the workers.
+# Returns the number of documents written.
+def process_map(file_in, pretty=False, processes=None, chunk_size=CHUNK_SIZE, backend='etree'):
+    file_out = "{0}.json".format(file_in)
+    tasks = [(file_in, start, end, pretty, backend) for start, end in split_ranges(file_in, chunk_size)]
+
+    count = 0
+    pool = multiprocessing.Pool(processes)
+    try:
+        with codecs.open(file_out, "w", "utf-8") as fo:
+            out = project_data.JsonArraySink(fo, pretty)
+            for encoded in pool.imap(_shape_range, tasks):
+                for s in encoded:
+                    out.write_encoded(s)
+                count += len(encoded)
+            out.close()
+    finally:
+        pool.close()
+        pool.join()
+
+    return count
+
+
+# Audit the street types of one byte range into a SpaceSaving sketch
+def _audit_range(args):
+    file_in, start, end, capacity, examples, backend = args
+    with open(file_in, 'rb') as f:
+        f.seek(start)
+        chunk = f.read(end - start)
+
+    street_types = sketch.SpaceSaving(capacity, examples)
+    for element in get_element(StringIO('<osm>' + chunk + '</osm>'), backend=backend):
+        if element.tag == 'node' or element.tag == 'way':
+            for k, v in element_tags(element):
+                if k == 'addr:street':
+                    street_type = project_audit.unexpected_street_type(v)
+                    if street_type is not None:
+                        street_types.add(street_type, v)
+    return street_types
+
+
+# Same as audit.audit_top, with the byte ranges audited by a process pool and
+# the sketches merged
+def audit_top(file_in, capacity=1000, examples=5, processes=None, chunk_size=CHUNK_SIZE, backend='etree'):
+    tasks = [(file_in, start, end, capacity, examples, backend)
+             for start, end in split_ranges(file_in, chunk_size)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        return reduce(lambda a, b: a.merge(b), pool.imap(_audit_range, tasks),
+                      sketch.SpaceSaving(capacity, examples))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def test():
+    import synthetic
+
+    tmpdir = tempfile.mkdtemp()
+    osm_file = os.path.join(tmpdir, 'sample.osm')
+    synthetic.write_osm(osm_file, nodes=20000, ways=2000)
+
+    project_data.process_map(osm_file, keep=False)
+    with open(osm_file + '.json', 'rb') as f:
+        serial = f.read()
+
+    # Small chunks so the file is split into many ranges
+    process_map(osm_file, processes=4, chunk_size=64 * 1024)
+    with open(osm_file + '.json', 'rb') as f:
+        parallel = f.read()
+
+    shutil.rmtree(tmpdir)
+    assert serial == parallel
+
+
+# Merging the sketches of the byte ranges keeps the most frequent street type
+# and bounds the exact counts, given by a serial audit with room for every type
+def test_audit_top(nodes=20000):
+    import synthetic
+    tmpdir = tempfile.mkdtemp()
+    try:
+        osm_file = os.path.join(tmpdir, 'sample.osm')
+        synthetic.write_osm(osm_file, nodes=nodes, ways=0, tag_density=0.5, abbreviation_ratio=0.5)
+        exact = project_audit.audit_top(osm_file, capacity=100).counts
+        assert len(split_ranges(osm_file, 32 * 1024)) > 4
+
+        for capacity in (2, 3, len(exact)):
+            top = audit_top(osm_file, capacity, processes=2, chunk_size=32 * 1024)
+            assert len(top) == min(capacity, len(exact))
+            for street_type, count, error in top.top():
+                assert count - error <= exact[street_type] <= count
+            for street_type in set(exact) - set(top.counts):
+                assert exact[street_type] <= top.min_count()
+            assert top.top(1)[0][0] == max(exact, key=exact.get)
+            if capacity == len(exact):
+                assert top.counts == exact and not any(top.errors.values())
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Single-pass scan engine for the OSM file.
+
+mapparser.count_tags, tags.process_map, users.process_map, audit.audit and
+maputils.audit2 each parse the whole file on their own. The scan engine parses
+the file once and feeds every element to a list of analyzers, then returns the
+result of each analyzer in a dictionary keyed by the analyzer name.
+
+An analyzer is an object with a 'name', a 'process(elem)' method called with
+every direct child of the root element (with all its children parsed) and a
+'result()' method. Elements come from osmparse.get_element, so they are
+Element objects or OsmRecords depending on the parser backend.
+"""
+import pprint
+import time
+from collections import defaultdict
+
+import audit as project_audit
+import mapparser
+import maputils
+import tags as project_tags
+import users as project_users
+from osmparse import OsmRecord, element_tags, get_element
+
+
+class Analyzer(object):
+    name = None
+
+    def process(self, elem):
+        pass
+
+    def result(self):
+        return None
+
+
+# Count the number of times each tag is encountered, same as mapparser.count_tags
+class TagCounter(Analyzer):
+    name = 'tags'
+
+    def __init__(self):
+        self.tags = {}
+
+    def _add(self, tag, n=1):
+        self.tags[tag] = self.tags.get(tag, 0) + n
+
+    def process(self, elem):
+        if isinstance(elem, OsmRecord):
+            self._add(elem.tag)
+            for tag, children in (('tag', elem.tags), ('nd', elem.refs), ('member', elem.members)):
+                if children:
+                    self._add(tag, len(children))
+            for tag in elem.others:
+                self._add(tag)
+        else:
+            for e in elem.iter():
+                self._add(e.tag)
+
+    def result(self):
+        return self.tags
+
+
+# Classify the 'k' value of every <tag>, same as tags.process_map
+class KeyTypeClassifier(Analyzer):
+    name = 'key_types'
+
+    def __init__(self):
+        self.keys = {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0}
+
+    def process(self, elem):
+        for k, v in element_tags(elem):
+            self.keys[project_tags.classify_key(k).kind] += 1
+
+    def result(self):
+        return self.keys
+
+
+# Collect the unique user IDs, same as users.process_map
+class UserCollector(Analyzer):
+    name = 'users'
+
+    def __init__(self):
+        self.users = set()
+
+    def process(self, elem):
+        if elem.tag in ('node', 'way', 'relation'):
+            self.users.add(elem.attrib['uid'])
+
+    def result(self):
+        return self.users
+
+
+# Collect street names keyed by unexpected street type, same as audit.audit.
+# The counts returned by maputils.audit2 are kept in the same pass.
+class StreetTypeAuditor(Analyzer):
+    name = 'street_types'
+
+    def __init__(self):
+        self.street_types = defaultdict(set)
+
+    def process(self, elem):
+        if elem.tag == 'node' or elem.tag == 'way':
+            for k, v in element_tags(elem):
+                if k == 'addr:street':
+                    project_audit.audit_street_type(self.street_types, v)
+
+    def result(self):
+        type_count = dict((s, len(names)) for s, names in self.street_types.iteritems())
+        return self.street_types, type_count
+
+
+def default_analyzers():
+    return [TagCounter(), KeyTypeClassifier(), UserCollector(), StreetTypeAuditor()]
+
+
+# Parse the OSM file once with the given osmparse backend and feed each
+# element to the analyzers, starting with the root element.
+def scan(filename, analyzers=None, backend='etree'):
+    if analyzers is None:
+        analyzers = default_analyzers()
+    processors = [a.process for a in analyzers]
+
+    for elem in get_element(filename, tags=None, backend=backend, with_root=True):
+        for f in processors:
+            f(elem)
+
+    return dict((a.name, a.result()) for a in analyzers)
+
+
+# Compare the scan engine against running the existing functions one after another.
+# Returns the elapsed seconds of both approaches.
+def benchmark(filename, backend='etree'):
+    start = time.time()
+    mapparser.count_tags(filename, backend=backend)
+    project_tags.process_map(filename, backend=backend)
+    project_users.process_map(filename, backend=backend)
+    project_audit.audit(filename, backend=backend)
+    maputils.audit2(filename, backend=backend)
+    sequential = time.time() - start
+
+    start = time.time()
+    scan(filename, backend=backend)
+    single_pass = time.time() - start
+
+    print "sequential: %.2fs, single pass: %.2fs, speedup: %.1fx" % (
+        sequential, single_pass, sequential / max(single_pass, 1e-9))
+    return {'sequential': sequential, 'single_pass': single_pass}
+
+
+def test():
+    results = scan('example.osm')
+    pprint.pprint(results)
+    assert scan('example.osm', backend='expat') == results
+
+    assert results['tags'] == mapparser.count_tags('example.osm')
+    assert results['key_types'] == project_tags.process_map('example.osm')
+    assert results['users'] == project_users.process_map('example.osm')
+    street_types, type_count = results['street_types']
+    assert street_types == project_audit.audit('example.osm')
+    assert (street_types, type_count) == maputils.audit2('example.osm')
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Bounded-memory heavy hitters for auditing.
+
+SpaceSaving keeps at most 'capacity' counters (Metwally et al., "Efficient
+Computation of Frequent and Top-k Elements in Data Streams"). Items that are
+frequent enough are always kept; the count of an item is never under-estimated
+and is over-estimated by at most its 'error'. Each counter also keeps a few
+example values, e.g. street names for a street type.
+
+Summaries of different parts of a file can be merged (Agarwal et al.,
+"Mergeable Summaries"), so chunks can be audited in parallel.
+"""
+import heapq
+
+
+class SpaceSaving(object):
+
+    def __init__(self, capacity=1000, examples=5):
+        self.capacity = capacity
+        self.examples = examples
+        self.counts = {}
+        self.errors = {}
+        self.samples = {}
+        # One (count, item) entry per counter. Counts are not updated in the
+        # heap when they grow; stale entries are fixed when they reach the top.
+        self._heap = []
+
+    def __len__(self):
+        return len(self.counts)
+
+    def _min_item(self):
+        while True:
+            count, item = self._heap[0]
+            if self.counts[item] == count:
+                return item
+            heapq.heapreplace(self._heap, (self.counts[item], item))
+
+    # Smallest count kept, the upper bound of the count of any item that is not kept
+    def min_count(self):
+        if len(self.counts) < self.capacity:
+            return 0
+        return self.counts[self._min_item()]
+
+    def add(self, item, example=None, n=1):
+        if item in self.counts:
+            self.counts[item] += n
+        elif len(self.counts) < self.capacity:
+            self.counts[item] = n
+            self.errors[item] = 0
+            self.samples[item] = set()
+            heapq.heappush(self._heap, (n, item))
+        else:
+            # Replace the smallest counter, the new item inherits its count as error
+            old = self._min_item()
+            count = self.counts.pop(old)
+            del self.errors[old]
+            del self.samples[old]
+            self.counts[item] = count + n
+            self.errors[item] = count
+            self.samples[item] = set()
+            heapq.heapreplace(self._heap, (count + n, item))
+
+        if example is not None:
+            samples = self.samples[item]
+            if len(samples) < self.examples:
+                samples.add(example)
+
+    # Return a new summary of both streams
+    def merge(self, other):
+        merged = SpaceSaving(max(self.capacity, other.capacity), max(self.examples, other.examples))
+        self_min = self.min_count()
+        other_min = other.min_count()
+
+        items = []
+        for item in set(self.counts) | set(other.counts):
+            count = self.counts.get(item, self_min) + other.counts.get(item, other_min)
+            error = self.errors.get(item, self_min) + other.errors.get(item, other_min)
+            items.append((count, error, item))
+
+        for count, error, item in heapq.nlargest(merged.capacity, items):
+            merged.counts[item] = count
+            merged.errors[item] = error
+            samples = self.samples.get(item, set()) | other.samples.get(item, set())
+            merged.samples[item] = set(sorted(samples)[:merged.examples])
+            merged._heap.append((count, item))
+        heapq.heapify(merged._heap)
+        return merged
+
+    # The k most frequent items as (item, count, error) tuples, most frequent first
+    def top(self, k=None):
+        items = sorted(self.counts.iteritems(), key=lambda x: (-x[1], x[0]))
+        return [(item, count, self.errors[item]) for item, count in items[:k]]
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+In-memory spatial index over the positions of the shaped nodes.
+
+Nodes are bucketed in a regular lat/lon grid. The ids and positions are stored
+in NumPy arrays sorted by grid cell. Only the occupied cells are kept: their
+sorted cell numbers, and an offsets array giving the slice of each (like the
+row pointers of a CSR matrix), so a fine grid over a sparse area stays small.
+Bounding box, radius and k-nearest queries only look at the cells they overlap.
+
+The index can be built while data.process_map runs, by passing a
+GridIndexBuilder in its 'sinks', or from the JSON output afterwards. It is
+saved as plain .npy files, so later sessions memory-map it instead of
+re-importing the data.
+"""
+import json
+import math
+import os
+import pprint
+import random
+from array import array
+
+import numpy as np
+
+import data as project_data
+
+EARTH_RADIUS = 6371008.8
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+
+# Great circle distance in meters between points, element-wise over arrays
+def haversine(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = [np.radians(x) for x in (lat1, lon1, lat2, lon2)]
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class GridIndex(object):
+
+    # 'cells' are the sorted numbers (row * ncols + col) of the occupied cells,
+    # and the nodes of cells[i] are at offsets[i]:offsets[i + 1]
+    def __init__(self, ids, lats, lons, cells, offsets, minlat, minlon, cell_size, nrows, ncols):
+        self.ids = ids
+        self.lats = lats
+        self.lons = lons
+        self.cells = cells
+        self.offsets = offsets
+        self.minlat = minlat
+        self.minlon = minlon
+        self.cell_size = cell_size
+        self.nrows = nrows
+        self.ncols = ncols
+
+    # Build the index from arrays of node ids and positions.
+    # 'cell_size' is the size of a grid cell in degrees.
+    @classmethod
+    def from_arrays(cls, ids, lats, lons, cell_size=0.01):
+        ids = np.asarray(ids, dtype=np.int64)
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        if len(ids) == 0:
+            return cls(ids, lats, lons, np.zeros(0, dtype=np.int64), np.zeros(1, dtype=np.int64),
+                       0.0, 0.0, cell_size, 1, 1)
+
+        minlat, minlon = lats.min(), lons.min()
+        nrows = int((lats.max() - minlat) // cell_size) + 1
+        ncols = int((lons.max() - minlon) // cell_size) + 1
+        rows = ((lats - minlat) // cell_size).astype(np.int64)
+        cols = ((lons - minlon) // cell_size).astype(np.int64)
+        cells = rows * ncols + cols
+
+        order = np.argsort(cells, kind='mergesort')
+        cells = cells[order]
+        starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+        offsets = np.append(starts, len(cells)).astype(np.int64)
+        return cls(ids[order], lats[order], lons[order], cells[starts], offsets, minlat, minlon, cell_size,
+                   nrows, ncols)
+
+    # Build the index from a process_map output file
+    @classmethod
+    def from_json(cls, json_file, cell_size=0.01):
+        builder = GridIndexBuilder(cell_size=cell_size)
+        for doc in project_data.iter_json(json_file):
+            builder.write(doc)
+        return builder.build()
+
+    def __len__(self):
+        return len(self.ids)
+
+    # Positions in the sorted arrays of the nodes in the cells overlapping the bounding box
+    def _candidates(self, minlat, minlon, maxlat, maxlon):
+        r0 = max(int((minlat - self.minlat) // self.cell_size), 0)
+        r1 = min(int((maxlat - self.minlat) // self.cell_size), self.nrows - 1)
+        c0 = max(int((minlon - self.minlon) // self.cell_size), 0)
+        c1 = min(int((maxlon - self.minlon) // self.cell_size), self.ncols - 1)
+        if r0 > r1 or c0 > c1:
+            return np.zeros(0, dtype=np.int64)
+
+        # The cells of one row of the grid are contiguous in the sorted arrays
+        rows = np.arange(r0, r1 + 1, dtype=np.int64) * self.ncols
+        starts = self.offsets[np.searchsorted(self.cells, rows + c0)]
+        ends = self.offsets[np.searchsorted(self.cells, rows + c1 + 1)]
+        lengths = ends - starts
+        return np.arange(lengths.sum()) + np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+
+    # Ids of the nodes inside the bounding box
+    def query_bbox(self, minlat, minlon, maxlat, maxlon):
+        idx = self._candidates(minlat, minlon, maxlat, maxlon)
+        lats = self.lats[idx]
+        lons = self.lons[idx]
+        inside = (lats >= minlat) & (lats <= maxlat) & (lons >= minlon) & (lons <= maxlon)
+        return np.asarray(self.ids[idx[inside]])
+
+    # Ids and distances of the nodes within 'meters' of a point, nearest first
+    def query_radius(self, lat, lon, meters):
+        dlat = meters / METERS_PER_DEGREE
+        dlon = dlat / max(math.cos(math.radians(lat)), 1e-6)
+        idx = self._candidates(lat - dlat, lon - dlon, lat + dlat, lon + dlon)
+        dist = haversine(lat, lon, self.lats[idx], self.lons[idx])
+        within = dist <= meters
+        idx, dist = idx[within], dist[within]
+        order = np.argsort(dist, kind='mergesort')
+        return np.asarray(self.ids[idx[order]]), dist[order]
+
+    # Ids and distances of the k nodes nearest to a point, nearest first.
+    # The searched square grows until it holds k nodes and the k-th distance is
+    # shorter than the distance to the edge of the square.
+    def query_knn(self, lat, lon, k):
+        k = min(k, len(self))
+        half = self.cell_size
+        while True:
+            dlon = half / max(math.cos(math.radians(lat)), 1e-6)
+            idx = self._candidates(lat - half, lon - dlon, lat + half, lon + dlon)
+            covers_all = (lat - half <= self.minlat and lon - dlon <= self.minlon and
+                          lat + half >= self.minlat + self.nrows * self.cell_size and
+                          lon + dlon >= self.minlon + self.ncols * self.cell_size)
+            if len(idx) >= k:
+                dist = haversine(lat, lon, self.lats[idx], self.lons[idx])
+                order = np.argsort(dist, kind='mergesort')[:k]
+                if covers_all or k == 0 or dist[order[-1]] <= half * METERS_PER_DEGREE:
+                    return np.asarray(self.ids[idx[order]]), dist[order]
+            elif covers_all:
+                return np.zeros(0, dtype=np.int64), np.zeros(0)
+            half *= 2
+
+    # Save the index to a directory of .npy files
+    def save(self, path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for name in ('ids', 'lats', 'lons', 'cells', 'offsets'):
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+        meta = {'minlat': self.minlat, 'minlon': self.minlon, 'cell_size': self.cell_size,
+                'nrows': self.nrows, 'ncols': self.ncols}
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+    # Load an index saved by 'save'. With mmap=True the arrays are memory-mapped
+    # and only the pages touched by the queries are read.
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        mode = 'r' if mmap else None
+        arrays = [np.load(os.path.join(path, name + '.npy'), mmap_mode=mode)
+                  for name in ('ids', 'lats', 'lons', 'cells', 'offsets')]
+        return cls(*arrays, minlat=meta['minlat'], minlon=meta['minlon'], cell_size=meta['cell_size'],
+                   nrows=meta['nrows'], ncols=meta['ncols'])
+
+
+# Collect node positions from shaped documents, for use as a process_map sink.
+# If 'path' is given the index is built and saved there when the sink is closed.
+class GridIndexBuilder(object):
+
+    def __init__(self, path=None, cell_size=0.01):
+        self.path = path
+        self.cell_size = cell_size
+        self.ids = array('l')
+        self.lats = array('d')
+        self.lons = array('d')
+
+    def write(self, el):
+        if el.get('doc_type') == 'node' and 'pos' in el:
+            self.ids.append(int(el['id']))
+            self.lats.append(el['pos'][0])
+            self.lons.append(el['pos'][1])
+
+    def close(self):
+        if self.path is not None:
+            self.build().save(self.path)
+
+    def build(self):
+        return GridIndex.from_arrays(np.frombuffer(self.ids, dtype=np.int_), np.frombuffer(self.lats),
+                                     np.frombuffer(self.lons), self.cell_size)
+
+
+def test():
+    rnd = random.Random(0)
+    builder = GridIndexBuilder(cell_size=0.02)
+    for i in range(5000):
+        builder.write({'doc_type': 'node', 'id': str(i), 'pos': [rnd.uniform(22.15, 22.52), rnd.uniform(113.82, 114.41)]})
+    index = builder.build()
+    ids = np.frombuffer(builder.ids, dtype=np.int_)
+    lats = np.frombuffer(builder.lats)
+    lons = np.frombuffer(builder.lons)
+
+    inside = (lats >= 22.25) & (lats <= 22.3) & (lons >= 114.1) & (lons <= 114.2)
+    assert sorted(index.query_bbox(22.25, 114.1, 22.3, 114.2)) == sorted(ids[inside])
+
+    dist = haversine(22.3, 114.17, lats, lons)
+    found, found_dist = index.query_radius(22.3, 114.17, 2000)
+    assert sorted(found) == sorted(ids[dist <= 2000])
+
+    found, found_dist = index.query_knn(22.3, 114.17, 10)
+    assert list(found) == list(ids[np.argsort(dist, kind='mergesort')[:10]])
+    pprint.pprint(zip(found, found_dist))
+
+    # Only occupied cells are stored, so a grid of about 2e11 cells stays small
+    fine = GridIndex.from_arrays(ids, lats, lons, cell_size=1e-6)
+    assert fine.nrows * fine.ncols > 10 ** 11
+    assert len(fine.cells) <= len(ids) and len(fine.offsets) == len(fine.cells) + 1
+    assert sorted(fine.query_bbox(22.25, 114.1, 22.3, 114.2)) == sorted(ids[inside])
+
+    # A saved index loads memory-mapped and answers the same queries
+    import shutil
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for saved in (index, fine):
+            saved.save(tmpdir)
+            loaded = GridIndex.load(tmpdir, mmap=True)
+            assert isinstance(loaded.offsets, np.memmap) and isinstance(loaded.cells, np.memmap)
+            assert (loaded.nrows, loaded.ncols, loaded.cell_size) == (saved.nrows, saved.ncols, saved.cell_size)
+            assert sorted(loaded.query_bbox(22.25, 114.1, 22.3, 114.2)) == sorted(ids[inside])
+            assert sorted(loaded.query_radius(22.3, 114.17, 2000)[0]) == sorted(ids[dist <= 2000])
+            assert list(loaded.query_knn(22.3, 114.17, 10)[0]) == list(found)
+            del loaded
+    finally:
+        shutil.rmtree(tmpdir)
+
+    empty = GridIndex.from_arrays([], [], [])
+    assert len(empty.query_bbox(22.25, 114.1, 22.3, 114.2)) == 0 and len(empty.query_knn(22.3, 114.17, 3)[0]) == 0
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+SQLite storage for the shaped OSM documents.
+
+A local alternative to MongoDB for laptops and CI. SqliteSink writes the
+documents of data.process_map (or of its JSON output, see load_data) into
+normalized tables:
+
+    nodes(id, lat, lon, visible, version, changeset, timestamp, user, uid)
+    ways(id, visible, version, changeset, timestamp, user, uid)
+    tags(doc_type, id, k, v)              address fields are stored as 'addr:<field>'
+    way_nodes(way_id, seq, node_id)
+    addresses(doc_type, id, housenumber, street, place, postcode)
+    node_rtree(id, min_lat, max_lat, min_lon, max_lon)   R*Tree on node positions
+
+Every table has a primary key, and the tags, node refs and address of a
+document are deleted before its new ones are inserted, so loading documents
+again replaces their rows instead of duplicating them or leaving stale ones.
+
+The fix-up helpers mirror the ones of dbutils, so the address clean-up
+workflow runs fully locally.
+"""
+import re
+import sqlite3
+
+import data as project_data
+from stats import DOCUMENT_FIELDS
+
+CREATED = ['version', 'changeset', 'timestamp', 'user', 'uid']
+ADDRESS_COLUMNS = ['housenumber', 'street', 'place', 'postcode']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS nodes (id INTEGER PRIMARY KEY, lat REAL, lon REAL, visible TEXT,
+    version INTEGER, changeset INTEGER, timestamp TEXT, user TEXT, uid INTEGER);
+CREATE TABLE IF NOT EXISTS ways (id INTEGER PRIMARY KEY, visible TEXT,
+    version INTEGER, changeset INTEGER, timestamp TEXT, user TEXT, uid INTEGER);
+CREATE TABLE IF NOT EXISTS tags (doc_type TEXT, id INTEGER, k TEXT, v TEXT, PRIMARY KEY (doc_type, id, k));
+CREATE TABLE IF NOT EXISTS way_nodes (way_id INTEGER, seq INTEGER, node_id INTEGER, PRIMARY KEY (way_id, seq));
+CREATE TABLE IF NOT EXISTS addresses (doc_type TEXT, id INTEGER, housenumber TEXT, street TEXT,
+    place TEXT, postcode TEXT, PRIMARY KEY (doc_type, id));
+"""
+
+# Created after the bulk load, which is faster than maintaining them row by row
+INDEXES = """
+CREATE INDEX IF NOT EXISTS tags_kv ON tags (k, v);
+CREATE INDEX IF NOT EXISTS way_nodes_node ON way_nodes (node_id);
+CREATE INDEX IF NOT EXISTS addresses_housenumber ON addresses (housenumber);
+CREATE INDEX IF NOT EXISTS addresses_street ON addresses (street);
+CREATE INDEX IF NOT EXISTS addresses_place ON addresses (place);
+"""
+
+
+def _regexp(pattern, value):
+    return value is not None and re.search(pattern, value) is not None
+
+
+# Open the database with the REGEXP function used by the housenumber filters
+def get_db(path):
+    db = sqlite3.connect(path)
+    db.row_factory = sqlite3.Row
+    db.create_function('REGEXP', 2, _regexp)
+    return db
+
+
+def _create_schema(db):
+    db.executescript(SCHEMA)
+    try:
+        db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS node_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)")
+    except sqlite3.OperationalError:
+        # SQLite built without R*Tree support
+        db.execute("CREATE INDEX IF NOT EXISTS nodes_position ON nodes (lat, lon)")
+
+
+def has_rtree(db):
+    return db.execute("SELECT 1 FROM sqlite_master WHERE name = 'node_rtree'").fetchone() is not None
+
+
+# Write shaped documents to a SQLite database, for use as a process_map sink.
+# Rows are inserted with executemany every 'batch_size' documents, in WAL mode.
+class SqliteSink(object):
+
+    def __init__(self, path, batch_size=10000):
+        self.db = get_db(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        _create_schema(self.db)
+        self.rtree = has_rtree(self.db)
+        self.batch_size = batch_size
+        self.pending = 0
+        self._reset()
+
+    def _reset(self):
+        self.rows = {'nodes': [], 'ways': [], 'tags': [], 'way_nodes': [], 'addresses': [], 'node_rtree': []}
+        # (doc_type, id) of the documents of the batch
+        self.keys = set()
+
+    def write(self, el):
+        doc_type = el['doc_type']
+        id = int(el['id'])
+        # A document written twice in a batch replaces the first one
+        if (doc_type, id) in self.keys:
+            self.flush()
+        self.keys.add((doc_type, id))
+        created = el.get('created', {})
+        meta = [el.get('visible')] + [created.get(a) for a in CREATED]
+
+        if doc_type == 'node':
+            lat, lon = el['pos'] if 'pos' in el else (None, None)
+            self.rows['nodes'].append([id, lat, lon] + meta)
+            if self.rtree and lat is not None:
+                self.rows['node_rtree'].append((id, lat, lat, lon, lon))
+        else:
+            self.rows['ways'].append([id] + meta)
+            for seq, ref in enumerate(el.get('node_refs', ())):
+                self.rows['way_nodes'].append((id, seq, int(ref)))
+
+        for k, v in el.iteritems():
+            if k not in DOCUMENT_FIELDS:
+                self.rows['tags'].append((doc_type, id, k, v))
+        address = el.get('address')
+        if address:
+            for k, v in address.iteritems():
+                self.rows['tags'].append((doc_type, id, 'addr:' + k, v))
+            self.rows['addresses'].append([doc_type, id] + [address.get(c) for c in ADDRESS_COLUMNS])
+
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        with self.db:
+            keys = sorted(self.keys)
+            self.db.executemany("DELETE FROM tags WHERE doc_type = ? AND id = ?", keys)
+            self.db.executemany("DELETE FROM addresses WHERE doc_type = ? AND id = ?", keys)
+            self.db.executemany("DELETE FROM way_nodes WHERE way_id = ?", [(id,) for t, id in keys if t == 'way'])
+            for table, rows in self.rows.iteritems():
+                if rows:
+                    placeholders = ','.join('?' * len(rows[0]))
+                    self.db.executemany("INSERT OR REPLACE INTO %s VALUES (%s)" % (table, placeholders), rows)
+        self._reset()
+        self.pending = 0
+
+    def close(self):
+        self.flush()
+        self.db.executescript(INDEXES)
+        self.db.execute("ANALYZE")
+        self.db.close()
+
+
+# Load a process_map output file (JSON array or line-delimited) into a SQLite database
+def load_data(json_file, path, batch_size=10000):
+    sink = SqliteSink(path, batch_size)
+    for doc in project_data.iter_json(json_file):
+        sink.write(doc)
+    sink.close()
+
+
+# Ids of the nodes inside the bounding box, edges included.
+# The R*Tree stores its bounds as float32 rounded outwards, so it is queried
+# for the boxes overlapping the bounding box and the exact node positions are
+# checked again.
+def query_bbox(db, minlat, minlon, maxlat, maxlon):
+    if has_rtree(db):
+        rows = db.execute("SELECT n.id FROM node_rtree r JOIN nodes n ON n.id = r.id "
+                          "WHERE r.max_lat >= ? AND r.min_lat <= ? AND r.max_lon >= ? AND r.min_lon <= ? "
+                          "AND n.lat BETWEEN ? AND ? AND n.lon BETWEEN ? AND ?",
+                          (minlat, maxlat, minlon, maxlon, minlat, maxlat, minlon, maxlon))
+    else:
+        rows = db.execute("SELECT id FROM nodes WHERE lat BETWEEN ? AND ? AND lon BETWEEN ? AND ?",
+                          (minlat, maxlat, minlon, maxlon))
+    return [r[0] for r in rows]
+
+
+HOUSENUMBER_FILTER = """doc_type = 'node' AND housenumber IS NOT NULL AND housenumber REGEXP ?
+    AND street IS NULL AND place IS NULL"""
+
+# This function finds all nodes with addr:housenumber but not addr:street or addr:place.
+# The housenumber must match the regular expression argument. By default it matches any string.
+def find_nodes_by_housenumber(db, regex='.*'):
+    return db.execute("SELECT n.*, a.housenumber FROM addresses a JOIN nodes n ON n.id = a.id WHERE " +
+                      HOUSENUMBER_FILTER, (regex,)).fetchall()
+
+# This function finds all nodes with id in the passed array.
+def find_nodes_by_id(db, ids):
+    ids = [int(i) for i in ids]
+    return db.execute("SELECT * FROM nodes WHERE id IN (%s)" % ','.join('?' * len(ids)), ids).fetchall()
+
+
+# Set an address field on the nodes matching the housenumber filter.
+# Returns the matched and modified counts, like dbutils: nodes that already
+# had the value are matched but not modified.
+def _set_address_by_housenumber(db, field, value, regex):
+    with db:
+        ids = [r[0] for r in db.execute("SELECT id FROM addresses WHERE " + HOUSENUMBER_FILTER, (regex,))]
+        return _set_address(db, field, value, ids)
+
+def _set_address(db, field, value, ids):
+    ids = sorted(set(ids))
+    if not ids:
+        return 0, 0
+    db.executemany("INSERT OR IGNORE INTO addresses (doc_type, id) SELECT 'node', id FROM nodes WHERE id = ?",
+                   [(i,) for i in ids])
+    modified = db.executemany("UPDATE addresses SET %s = ? WHERE doc_type = 'node' AND id = ? AND %s IS NOT ?"
+                              % (field, field), [(value, i, value) for i in ids]).rowcount
+    db.executemany("DELETE FROM tags WHERE doc_type = 'node' AND id = ? AND k = ?", [(i, 'addr:' + field) for i in ids])
+    db.executemany("INSERT OR REPLACE INTO tags SELECT 'node', id, ?, ? FROM addresses WHERE doc_type = 'node' AND id = ?",
+                   [('addr:' + field, value, i) for i in ids])
+    return len(ids), modified
+
+def _existing_ids(db, ids):
+    return [r[0] for r in find_nodes_by_id(db, ids)]
+
+# Utility function to lookup nodes by housenumber pattern and add address.place accordingly
+def update_nodes_place(db, place, regex='.*'):
+    return _set_address_by_housenumber(db, 'place', place, regex)
+
+# Utility function to lookup nodes by housenumber pattern and add address.street accordingly
+def update_nodes_street(db, street, regex='.*'):
+    return _set_address_by_housenumber(db, 'street', street, regex)
+
+# Utility function to lookup nodes by document ids and add address.place accordingly
+def update_nodes_place_by_id(db, place, ids):
+    with db:
+        return _set_address(db, 'place', place, _existing_ids(db, ids))
+
+# Utility function to lookup nodes by document ids and add address.street accordingly
+def update_nodes_street_by_id(db, street, ids):
+    with db:
+        return _set_address(db, 'street', street, _existing_ids(db, ids))
+
+
+# Nodes on the edges of a bounding box are found, and loading the same
+# documents twice does not duplicate any row
+def test():
+    import os
+    import shutil
+    import tempfile
+
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, 'map.db')
+    docs = [
+        {'doc_type': 'node', 'id': '1', 'pos': [22.2783151, 114.1746902], 'amenity': 'cafe',
+         'address': {'housenumber': '12', 'street': 'Nathan Road'}},
+        {'doc_type': 'node', 'id': '2', 'pos': [22.3193039, 114.1693611]},
+        {'doc_type': 'node', 'id': '3', 'pos': [22.4, 114.3]},
+        {'doc_type': 'way', 'id': '10', 'node_refs': ['1', '2', '3'], 'highway': 'residential'},
+    ]
+    for run in range(2):
+        sink = SqliteSink(path)
+        for doc in docs:
+            sink.write(doc)
+        sink.close()
+
+    db = get_db(path)
+    try:
+        assert sorted(query_bbox(db, 22.2783151, 114.1693611, 22.3193039, 114.1746902)) == [1, 2]
+        assert query_bbox(db, 22.2783152, 114.1693611, 22.3193038, 114.1746902) == []
+        for table, rows in (('nodes', 3), ('ways', 1), ('tags', 4), ('way_nodes', 3), ('addresses', 1)):
+            assert db.execute("SELECT COUNT(*) FROM %s" % table).fetchone()[0] == rows, table
+        if has_rtree(db):
+            assert db.execute("SELECT COUNT(*) FROM node_rtree").fetchone()[0] == 3
+
+        assert update_nodes_place_by_id(db, 'Mong Kok', ['1', '2', '99']) == (2, 2)
+        assert update_nodes_place_by_id(db, 'Mong Kok', ['1', '2']) == (2, 0)
+        assert update_nodes_street(db, 'Nathan Road', '^12$') == (0, 0)
+    finally:
+        db.close()
+
+    # Documents that lost their tags, refs and address, twice in one batch.
+    # Only node 2 keeps the place set above.
+    sink = SqliteSink(path)
+    for doc in [{'doc_type': 'node', 'id': '1', 'pos': [22.3, 114.2], 'amenity': 'bar'},
+                {'doc_type': 'node', 'id': '1', 'pos': [22.3, 114.2]},
+                {'doc_type': 'way', 'id': '10', 'node_refs': ['2']}]:
+        sink.write(doc)
+    sink.close()
+    db = get_db(path)
+    try:
+        for table, rows in (('nodes', 3), ('ways', 1), ('tags', 1), ('way_nodes', 1), ('addresses', 1)):
+            assert db.execute("SELECT COUNT(*) FROM %s" % table).fetchone()[0] == rows, table
+    finally:
+        db.close()
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Summary statistics materialized while the map is converted.
+
+MapStats is a process_map sink that keeps streaming aggregates of the shaped
+documents: node/way totals, per-user counts with first and last timestamps,
+tag key frequencies, amenity and cuisine histograms and the bounding box of
+the nodes. They are written to a sidecar JSON file, so reports load instantly
+instead of running aggregation pipelines over the whole collection.
+"""
+import json
+from collections import Counter
+
+# Fields of a shaped document that do not come from a <tag>
+DOCUMENT_FIELDS = set(['id', 'doc_type', 'visible', 'created', 'pos', 'node_refs', 'address',
+                       'coords', 'length', 'bbox'])
+
+
+class MapStats(object):
+
+    def __init__(self, path=None):
+        self.path = path
+        self.doc_types = Counter()
+        self.users = {}
+        self.keys = Counter()
+        self.amenities = Counter()
+        self.cuisines = Counter()
+        self.bbox = None
+
+    def write(self, el):
+        self.doc_types[el['doc_type']] += 1
+
+        created = el.get('created', {})
+        if 'uid' in created:
+            timestamp = created.get('timestamp')
+            user = self.users.get(created['uid'])
+            if user is None:
+                self.users[created['uid']] = {'user': created.get('user'), 'count': 1,
+                                              'first': timestamp, 'last': timestamp}
+            else:
+                user['count'] += 1
+                # ISO 8601 timestamps compare as strings
+                if timestamp is not None:
+                    if user['first'] is None or timestamp < user['first']:
+                        user['first'] = timestamp
+                    if user['last'] is None or timestamp > user['last']:
+                        user['last'] = timestamp
+
+        for k in el:
+            if k not in DOCUMENT_FIELDS:
+                self.keys[k] += 1
+        for k in el.get('address', ()):
+            self.keys['addr:' + k] += 1
+
+        if 'amenity' in el:
+            self.amenities[el['amenity']] += 1
+        if 'cuisine' in el:
+            self.cuisines[el['cuisine']] += 1
+
+        if 'pos' in el:
+            lat, lon = el['pos']
+            if self.bbox is None:
+                self.bbox = [lat, lon, lat, lon]
+            else:
+                b = self.bbox
+                b[0], b[1], b[2], b[3] = min(b[0], lat), min(b[1], lon), max(b[2], lat), max(b[3], lon)
+
+    def result(self):
+        return {'doc_types': dict(self.doc_types),
+                'unique_users': len(self.users),
+                'users': self.users,
+                'keys': dict(self.keys),
+                'amenities': dict(self.amenities),
+                'cuisines': dict(self.cuisines),
+                'bbox': self.bbox}
+
+    def close(self):
+        if self.path is not None:
+            save_stats(self.result(), self.path)
+
+
+def save_stats(stats, path):
+    with open(path, 'w') as f:
+        json.dump(stats, f, indent=2, sort_keys=True)
+
+
+def load_stats(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+# The n users with the most documents, as (uid, user, count) tuples
+def top_users(stats, n=10):
+    users = sorted(stats['users'].iteritems(), key=lambda x: (-x[1]['count'], x[0]))
+    return [(uid, u['user'], u['count']) for uid, u in users[:n]]
+
+
+# The n most frequent values of a histogram ('amenities', 'cuisines' or 'keys')
+def top_values(stats, histogram, n=10):
+    return Counter(stats[histogram]).most_common(n)
+
+
+# MapStats must give the same statistics as counting the shaped documents of
+# a synthetic file directly. Restaurants get a cuisine, which synthetic files
+# do not have.
+def test(nodes=3000):
+    import os
+    import shutil
+    import tempfile
+    import data as project_data
+    import synthetic
+
+    def brute_force(docs):
+        users = {}
+        for d in docs:
+            c = d.get('created', {})
+            if 'uid' in c:
+                users.setdefault(c['uid'], []).append((c.get('user'), c.get('timestamp')))
+        keys = Counter(k for d in docs for k in d if k not in DOCUMENT_FIELDS)
+        keys.update('addr:' + k for d in docs for k in d.get('address', ()))
+        lats = [d['pos'][0] for d in docs if 'pos' in d]
+        lons = [d['pos'][1] for d in docs if 'pos' in d]
+        return {'doc_types': dict(Counter(d['doc_type'] for d in docs)),
+                'unique_users': len(users),
+                'users': dict((uid, {'user': v[0][0], 'count': len(v),
+                                     'first': min(t for u, t in v), 'last': max(t for u, t in v)})
+                              for uid, v in users.items()),
+                'keys': dict(keys),
+                'amenities': dict(Counter(d['amenity'] for d in docs if 'amenity' in d)),
+                'cuisines': dict(Counter(d['cuisine'] for d in docs if 'cuisine' in d)),
+                'bbox': [min(lats), min(lons), max(lats), max(lons)]}
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        osm_file = os.path.join(tmpdir, 'sample.osm')
+        synthetic.write_osm(osm_file, nodes=nodes, ways=nodes // 10, tag_density=0.5)
+        docs = project_data.process_map(osm_file, stats=True)
+        # The sidecar file goes through JSON, like the brute force result
+        expected = json.loads(json.dumps(brute_force(docs)))
+        assert load_stats(project_data.output_file(osm_file) + '.stats.json') == expected
+    finally:
+        shutil.rmtree(tmpdir)
+
+    cuisines = ['chinese', 'thai', 'dim_sum']
+    for i, d in enumerate(docs):
+        if d.get('amenity') == 'restaurant':
+            d['cuisine'] = cuisines[i % len(cuisines)]
+    s = MapStats()
+    for d in docs:
+        s.write(d)
+    result = s.result()
+    expected = brute_force(docs)
+    assert result == expected
+    assert sorted(result['cuisines']) == sorted(cuisines)
+    assert result['doc_types'] == {'node': nodes, 'way': nodes // 10}
+    assert top_users(result, 3) == sorted(((uid, u['user'], u['count']) for uid, u in expected['users'].items()),
+                                          key=lambda x: (-x[2], x[0]))[:3]
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Street name normalizer shared by audit and data.
+
+The normalizer replaces an abbreviated street type with its full name using a
+mapping, e.g. 'Taikoo Shing Rd' -> 'Taikoo Shing Road'. Each distinct street
+name is only normalized once: results are kept in a bounded LRU cache, and
+renames are counted instead of printed.
+"""
+import re
+from collections import Counter, OrderedDict
+
+street_type_re = re.compile(r'\b\S+\.?$', re.IGNORECASE)
+
+# Mapping for Hong Kong
+mapping = { "St": "Street",
+            "St.": "Street",
+            "Rd": "Road",
+            "Circuit\\": "Circuit",
+            u"Street\u200e": "Street"
+            }
+
+
+class StreetNameNormalizer(object):
+
+    # The mapping is copied, so later changes to it do not affect cached results
+    def __init__(self, mapping, maxsize=65536):
+        self.mapping = dict(mapping)
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        # 'seen', 'renamed' and 'cache_hits' totals
+        self.stats = Counter()
+        # Number of renames keyed by the abbreviated street type
+        self.renames = Counter()
+
+    # Return (new name, replaced street type), the street type is None if the name is unchanged
+    def _normalize(self, name):
+        m = street_type_re.search(name)
+        if m:
+            street_type = m.group()
+            if street_type in self.mapping:
+                return name[:m.start()] + self.mapping[street_type] + name[m.end():], street_type
+        return name, None
+
+    def normalize(self, name):
+        self.stats['seen'] += 1
+        try:
+            result = self.cache.pop(name)
+            self.stats['cache_hits'] += 1
+        except KeyError:
+            result = self._normalize(name)
+            if len(self.cache) >= self.maxsize:
+                self.cache.popitem(last=False)
+        self.cache[name] = result
+
+        new_name, street_type = result
+        if street_type is not None:
+            self.stats['renamed'] += 1
+            self.renames[street_type] += 1
+        return new_name
+
+    # Normalize a list of names, returning the new names in the same order
+    def normalize_all(self, names):
+        normalize = self.normalize
+        return [normalize(name) for name in names]
+
+    def clear(self):
+        self.cache.clear()
+        self.stats.clear()
+        self.renames.clear()
+
+
+_normalizers = {}
+
+# Get the normalizer of a mapping, creating it on first use. Normalizers are
+# keyed by the mapping content, so a mapping changed in place gets a new one.
+def get_normalizer(mapping=mapping):
+    key = tuple(sorted(mapping.items()))
+    if key not in _normalizers:
+        _normalizers[key] = StreetNameNormalizer(mapping)
+    return _normalizers[key]
+
+
+# The cache stays within maxsize, unmapped street types are left unchanged, and
+# the counters and normalize_all agree with audit.update_name
+def test():
+    import audit
+
+    names = ["West Lexington St.", "Baldwin Rd", "Taikoo Shing Rd", "Nathan Road",
+             u"Lung Cheung Street\u200e", "Tai Hang Circuit\\", "Nam Cheong Path", "Baldwin Rd", "Nathan Road"]
+    normalizer = StreetNameNormalizer(mapping, maxsize=2)
+    normalized = normalizer.normalize_all(names)
+    assert normalized == [audit.update_name(name, mapping) for name in names]
+    assert normalized == ["West Lexington Street", "Baldwin Road", "Taikoo Shing Road", "Nathan Road",
+                          "Lung Cheung Street", "Tai Hang Circuit", "Nam Cheong Path", "Baldwin Road", "Nathan Road"]
+    assert len(normalizer.cache) == 2
+    assert list(normalizer.cache) == ["Baldwin Rd", "Nathan Road"]
+    assert normalizer.stats == Counter(seen=9, renamed=6)
+    assert normalizer.renames == Counter({"Rd": 3, "St.": 1, u"Street\u200e": 1, "Circuit\\": 1})
+
+    normalizer.normalize("Nathan Road")
+    assert normalizer.stats['cache_hits'] == 1 and normalizer.stats['seen'] == 10
+    normalizer.clear()
+    assert not normalizer.cache and not normalizer.stats and not normalizer.renames
+
+    # Changing a mapping in place is seen by the next lookup
+    changed = dict(mapping)
+    assert audit.update_name("Nathan Rd", changed) == "Nathan Road"
+    changed["Rd"] = "Rd"
+    assert audit.update_name("Nathan Rd", changed) == "Nathan Rd"
+    del changed["Rd"]
+    assert audit.update_name("Nathan Rd", changed) == "Nathan Rd"
+    assert get_normalizer(mapping) is get_normalizer(dict(mapping))
+
+
+if __name__ == '__main__':
+    test()
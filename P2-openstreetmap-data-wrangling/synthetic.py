@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Deterministic synthetic OSM files for testing and benchmarking.
+
+The files follow the layout of an Overpass API extract: all nodes first,
+then the ways referencing them, then the relations. Besides the element
+counts, the share of tagged nodes, of elements with a problematic tag key and
+of abbreviated street types can be set, to exercise the audit and cleaning
+code at any size.
+"""
+import codecs
+import random
+
+STREETS = [u"Nathan Road", u"Queen's Road Central", u"Hennessy Rd", u"Des Voeux Road",
+           u"Taikoo Shing Rd", u"Lockhart St", u"Castle Peak Road", u"Tat Chee Avenue"]
+AMENITIES = [u"restaurant", u"school", u"bank", u"cafe", u"hospital", u"parking"]
+
+# Street names with a full street type, abbreviated with the street types of
+# the streetnames mapping
+FULL_STREETS = [u"Nathan Road", u"Queen's Road Central", u"Hennessy Road", u"Des Voeux Road",
+                u"Taikoo Shing Road", u"Lockhart Street", u"Castle Peak Road", u"Tat Chee Avenue"]
+ABBREVIATIONS = {u"Road": [u"Rd"], u"Street": [u"St", u"St."]}
+
+# Keys classified as 'problemchars' by tags.key_type
+PROBLEM_KEYS = [u"name 1", u"fixme?", u"opening hours", u"contact=phone", u"addr.street", u"note#"]
+RELATION_TYPES = [u"multipolygon", u"route", u"restriction"]
+
+
+def _created(rnd, i):
+    uid = rnd.randint(1, 500)
+    return u'version="%d" changeset="%d" timestamp="2015-%02d-%02dT10:00:00Z" user="user%d" uid="%d"' % (
+        rnd.randint(1, 9), 10000000 + i, rnd.randint(1, 12), rnd.randint(1, 28), uid, uid)
+
+
+# Return a street name. With a 'ratio', the name has a full street type that
+# is abbreviated with that probability.
+def _street(rnd, ratio):
+    if ratio is None:
+        return rnd.choice(STREETS)
+    name = rnd.choice(FULL_STREETS)
+    words = name.split(u' ')
+    if words[-1] in ABBREVIATIONS and rnd.random() < ratio:
+        words[-1] = rnd.choice(ABBREVIATIONS[words[-1]])
+    return u' '.join(words)
+
+
+def _problem_tag(f, rnd, problem_ratio):
+    if problem_ratio and rnd.random() < problem_ratio:
+        f.write(u'  <tag k="%s" v="yes"/>\n' % rnd.choice(PROBLEM_KEYS))
+
+
+# Write a synthetic OSM file to 'path' and return the number of elements written.
+#   - 'nodes', 'ways' and 'relations' are the number of each element
+#   - 'tag_density' is the share of nodes with an address and an amenity
+#   - 'problem_ratio' is the share of tagged elements with an extra tag whose
+#     key has problematic characters
+#   - 'abbreviation_ratio' is the share of street names with an abbreviated
+#     street type. By default the names are picked from STREETS, some of which
+#     are abbreviated.
+# The same arguments always produce the same file.
+def write_osm(path, nodes=1000, ways=100, seed=0, relations=0, tag_density=0.2, problem_ratio=0.0,
+              abbreviation_ratio=None):
+    rnd = random.Random(seed)
+    with codecs.open(path, 'w', 'utf-8') as f:
+        f.write(u'<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write(u'<osm version="0.6" generator="synthetic">\n')
+        f.write(u' <bounds minlat="22.1505" minlon="113.8225" maxlat="22.5151" maxlon="114.4102"/>\n')
+
+        for i in xrange(nodes):
+            f.write(u' <node id="%d" visible="true" %s lat="%.7f" lon="%.7f"' % (
+                i + 1, _created(rnd, i), rnd.uniform(22.1505, 22.5151), rnd.uniform(113.8225, 114.4102)))
+            if rnd.random() < tag_density:
+                f.write(u'>\n')
+                f.write(u'  <tag k="addr:housenumber" v="%d"/>\n' % rnd.randint(1, 300))
+                f.write(u'  <tag k="addr:street" v="%s"/>\n' % _street(rnd, abbreviation_ratio).replace(u"'", u"&apos;"))
+                f.write(u'  <tag k="amenity" v="%s"/>\n' % rnd.choice(AMENITIES))
+                _problem_tag(f, rnd, problem_ratio)
+                f.write(u' </node>\n')
+            else:
+                f.write(u'/>\n')
+
+        for i in xrange(ways):
+            f.write(u' <way id="%d" visible="true" %s>\n' % (nodes + i + 1, _created(rnd, nodes + i)))
+            for _ in xrange(rnd.randint(2, 8)):
+                f.write(u'  <nd ref="%d"/>\n' % rnd.randint(1, max(nodes, 1)))
+            f.write(u'  <tag k="highway" v="residential"/>\n')
+            _problem_tag(f, rnd, problem_ratio)
+            f.write(u' </way>\n')
+
+        for i in xrange(relations):
+            id = nodes + ways + i + 1
+            f.write(u' <relation id="%d" visible="true" %s>\n' % (id, _created(rnd, id - 1)))
+            for _ in xrange(rnd.randint(2, 6)):
+                if ways and rnd.random() < 0.7:
+                    f.write(u'  <member type="way" ref="%d" role="outer"/>\n' % (nodes + rnd.randint(1, ways)))
+                else:
+                    f.write(u'  <member type="node" ref="%d" role=""/>\n' % rnd.randint(1, max(nodes, 1)))
+            f.write(u'  <tag k="type" v="%s"/>\n' % rnd.choice(RELATION_TYPES))
+            _problem_tag(f, rnd, problem_ratio)
+            f.write(u' </relation>\n')
+
+        f.write(u'</osm>\n')
+    return nodes + ways + relations
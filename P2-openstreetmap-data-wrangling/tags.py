@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import xml.etree.cElementTree as ET
 import pprint
+import random
 import re
+import time
+from collections import namedtuple
+from osmparse import element_tags, get_element
 """
 Your task is to explore the data a bit more.
 Before you process the data and add it into MongoDB, you should
@@ -23,27 +26,91 @@
 problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
 
 
+# Classification of a tag key:
+#   - kind: the key_type category of the raw key
+#   - field: the name shape_element stores the value under, None if the tag is ignored
+#   - address: True if the value goes into the "address" dictionary
+KeyClass = namedtuple('KeyClass', ['kind', 'field', 'address'])
+
+# Distinct keys seen so far. Real OSM files only have a few thousand of them,
+# so every key is classified once and later lookups are dictionary hits.
+# Once the cache holds KEY_CACHE_SIZE keys, new keys are classified without
+# being cached, so files with generated keys do not grow it without bound.
+KEY_CACHE_SIZE = 100000
+_key_cache = {}
+
+
+def _key_kind(k):
+    if lower.match(k):
+        return 'lower'
+    elif lower_colon.match(k):
+        return 'lower_colon'
+    elif problemchars.search(k):
+        return 'problemchars'
+    else:
+        return 'other'
+
+
+def _classify_key(k):
+    kind = _key_kind(k)
+    s = k.strip()
+    if problemchars.search(s):
+        return KeyClass(kind, None, False)
+    if s.startswith('addr:'):
+        # A second ":" separates the type/direction of a street, the tag is ignored
+        sub = s[5:]
+        return KeyClass(kind, None if ':' in sub else sub, True)
+    return KeyClass(kind, s, False)
+
+
+def classify_key(k):
+    try:
+        return _key_cache[k]
+    except KeyError:
+        c = _classify_key(k)
+        if len(_key_cache) < KEY_CACHE_SIZE:
+            _key_cache[k] = c
+        return c
+
+
 def key_type(element, keys):
     if element.tag == "tag":
         # YOUR CODE HERE
-        k = element.attrib['k']
-        if lower.match(k):
-            keys['lower'] += 1
-        elif lower_colon.match(k):
-            keys['lower_colon'] += 1
-        elif len(problemchars.findall(k)) > 0:
-            keys['problemchars'] += 1
-        else:
-            keys['other'] += 1
+        keys[classify_key(element.attrib['k']).kind] += 1
         
     return keys
 
 
+# Compare the per-tag cost of running the regexes on every key with the cached classifier.
+# 'tags' keys are drawn from 'distinct' different keys.
+def benchmark_key_type(tags=500000, distinct=2000):
+    rnd = random.Random(0)
+    prefixes = ['', 'addr:', 'name:', 'Name ', 'building:']
+    names = ['k%d' % i for i in range(distinct // len(prefixes) + 1)]
+    distinct_keys = [p + n for p in prefixes for n in names][:distinct]
+    keys = [rnd.choice(distinct_keys) for _ in xrange(tags)]
+
+    start = time.time()
+    for k in keys:
+        _key_kind(k)
+    uncached = time.time() - start
+
+    _key_cache.clear()
+    start = time.time()
+    for k in keys:
+        classify_key(k).kind
+    cached = time.time() - start
+
+    print "regex: %.0f ns/tag, cached: %.0f ns/tag" % (uncached / tags * 1e9, cached / tags * 1e9)
+    return {'regex': uncached / tags, 'cached': cached / tags}
 
-def process_map(filename):
+
+
+def process_map(filename, backend='etree'):
     keys = {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0}
-    for _, element in ET.iterparse(filename):
-        keys = key_type(element, keys)
+    for element in get_element(filename, backend=backend):
+        for k, v in element_tags(element):
+            keys[classify_key(k).kind] += 1
 
     return keys
 
@@ -57,5 +124,15 @@ def test():
     assert keys == {'lower': 5, 'lower_colon': 0, 'other': 1, 'problemchars': 1}
 
 
+# The cache stops growing at KEY_CACHE_SIZE keys, uncached keys are still classified
+def test_key_cache():
+    _key_cache.clear()
+    for i in xrange(KEY_CACHE_SIZE + 10):
+        assert classify_key('k%d' % i).field == 'k%d' % i
+    assert len(_key_cache) == KEY_CACHE_SIZE
+    assert classify_key('addr:street') == KeyClass('lower_colon', 'street', True)
+    _key_cache.clear()
+
+
 if __name__ == "__main__":
     test()
\ No newline at end of file
@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import xml.etree.cElementTree as ET
 import pprint
 import re
+from osmparse import get_element
 """
 Your task is to explore the data a bit more.
 The first task is a fun one - find out how many unique users
@@ -15,12 +15,10 @@ def get_user(element):
     return
 
 
-def process_map(filename):
+def process_map(filename, backend='etree'):
     users = set()
-    for _, element in ET.iterparse(filename):
-        if element.tag in ['node','way','relation']:
-            users.add(element.attrib['uid'])
-        pass
+    for element in get_element(filename, backend=backend):
+        users.add(element.attrib['uid'])
 
     return users
 